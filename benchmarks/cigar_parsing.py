@@ -0,0 +1,121 @@
+""" Compares the per-read cost of the string-based CIGAR and MD parsing in
+    transcript_utils (compute_alignment_coverage, compute_alignment_identity,
+    and compute_jI) with the fast path that works on pysam's integer CIGAR
+    tuples (parse_cigar_tuples and compute_MD_identity). The reads come from
+    --sam, or are generated: spliced alignments with soft clips, mismatches,
+    and small insertions and deletions.
+
+    Usage: python benchmarks/cigar_parsing.py [--sam FILE] [--n N]
+               [--json FILE]
+"""
+import argparse
+import json
+import random
+import time
+import pysam
+from talon import transcript_utils as tutils
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--sam", dest = "sam", type = str, default = None,
+        help = "SAM/BAM file to take the mapped reads from")
+    parser.add_argument("--n", dest = "n", type = int, default = 100000,
+        help = "Number of reads to generate or read. Default = 100000")
+    parser.add_argument("--json", dest = "json_file", type = str, default = None,
+        help = "Optional file to write the results to as JSON")
+    return parser.parse_args()
+
+def make_read(header, rnd, i):
+    """ Generates a spliced read with its MD tag """
+    cigar = []
+    md = []
+    seq_len = 0
+    run = 0
+    clip = rnd.randint(0, 50)
+    if clip:
+        cigar.append((pysam.CSOFT_CLIP, clip))
+        seq_len += clip
+    for exon in range(rnd.randint(1, 12)):
+        if exon:
+            cigar.append((pysam.CREF_SKIP, rnd.randint(100, 20000)))
+        length = rnd.randint(50, 400)
+        cigar.append((pysam.CMATCH, length))
+        seq_len += length
+        # One mismatch per exon, then an insertion or a deletion
+        mismatch = rnd.randint(1, length - 2)
+        md.append("%d%s" % (run + mismatch, "A"))
+        run = length - mismatch - 1
+        if rnd.random() < 0.5:
+            cigar.append((pysam.CINS, 2))
+            seq_len += 2
+        else:
+            cigar.append((pysam.CDEL, 2))
+            md.append("%d^AC" % run)
+            run = 0
+        cigar.append((pysam.CMATCH, 10))
+        seq_len += 10
+        run += 10
+    md.append(str(run))
+
+    read = pysam.AlignedSegment(header)
+    read.query_name = "read_%d" % i
+    read.reference_id = 0
+    read.reference_start = rnd.randint(1000, 1000000)
+    read.cigartuples = cigar
+    read.query_sequence = "A" * seq_len
+    read.set_tag("MD", "".join(md))
+    return read
+
+def get_reads(options):
+    if options.sam != None:
+        reads = []
+        with pysam.AlignmentFile(options.sam) as sam:
+            for read in sam:
+                if not read.is_unmapped and read.has_tag("MD"):
+                    reads.append(read)
+                if len(reads) == options.n:
+                    break
+        return reads
+
+    header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "chr1",
+                                                      "LN": 2000000}]})
+    rnd = random.Random(1)
+    return [ make_read(header, rnd, i) for i in range(options.n) ]
+
+def string_path(read):
+    start = read.reference_start + 1
+    cigar = read.cigarstring
+    coverage = tutils.compute_alignment_coverage(cigar)
+    identity = tutils.compute_alignment_identity(read.get_tag("MD"), read.query)
+    jI = tutils.compute_jI(start, cigar)
+    introns = [int(x) for x in jI.split(",")[1:]]
+    return coverage, identity, introns
+
+def tuple_path(read):
+    start = read.reference_start + 1
+    coverage, end, introns = tutils.parse_cigar_tuples(start, read.cigartuples)
+    identity = tutils.compute_MD_identity(read.get_tag("MD"),
+                                          read.query_alignment_length)
+    return coverage, identity, introns
+
+def main():
+    options = get_args()
+    reads = get_reads(options)
+
+    results = {}
+    for name, fn in [("string", string_path), ("cigar_tuples", tuple_path)]:
+        start = time.perf_counter()
+        for read in reads:
+            fn(read)
+        elapsed = time.perf_counter() - start
+        results[name] = {"seconds": elapsed,
+                         "us_per_read": 1e6 * elapsed / len(reads)}
+        print("%-13s %8.3f s %8.2f us/read" % \
+              (name, elapsed, 1e6 * elapsed / len(reads)))
+
+    if options.json_file != None:
+        with open(options.json_file, 'w') as f:
+            json.dump({"n": len(reads), "results": results}, f, indent = 2)
+
+if __name__ == '__main__':
+    main()
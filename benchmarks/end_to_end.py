@@ -0,0 +1,376 @@
+""" End-to-end benchmark of a TALON run on simulated long reads. Reads are
+    drawn from the transcripts of an annotation (--gtf, or one generated
+    with --genes genes) in set proportions of FSM, ISM, NIC, NNC, antisense,
+    intergenic, and monoexonic reads, and written to a sorted and indexed
+    BAM. talon_initialize_database, talon, talon_filter_transcripts, and
+    talon_abundance are then run on them in --workdir. The wall time and
+    peak RSS of each step are recorded, along with the read throughput of
+    talon and how TALON classified the reads of each simulated category
+    (and the stage timings of talon, if --talon_args includes --profile).
+    The peak RSS of a step is that of its largest process (e.g. one talon
+    worker), not the sum over processes. The results are written as JSON,
+    and --baseline compares them with an earlier results file, e.g. one made
+    on another commit with the same options.
+
+    Usage: python benchmarks/end_to_end.py [--gtf FILE] [--reads N]
+               [--genes N] [--mix FSM=0.4,ISM=0.15,...] [--threads N]
+               [--seed N] [--workdir DIR] [--talon_args='ARGS']
+               [--json FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import pysam
+
+CATEGORIES = ["FSM", "ISM", "NIC", "NNC", "antisense", "intergenic",
+              "monoexonic"]
+DEFAULT_MIX = "FSM=0.4,ISM=0.15,NIC=0.1,NNC=0.1,antisense=0.05," + \
+              "intergenic=0.05,monoexonic=0.15"
+BUILD = "bench"
+ANNOT = "bench_annot"
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+                             formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gtf", dest = "gtf", type = str, default = None,
+        help = "Annotation to simulate the reads from. Default: generate one")
+    parser.add_argument("--genes", dest = "n_genes", type = int, default = 2000,
+        help = "Number of genes in the generated annotation. Default = 2000")
+    parser.add_argument("--reads", dest = "n_reads", type = int,
+        default = 100000, help = "Number of reads. Default = 100000")
+    parser.add_argument("--mix", dest = "mix", type = str, default = DEFAULT_MIX,
+        help = "Fraction of the reads in each category. Default = " + \
+               DEFAULT_MIX)
+    parser.add_argument("--threads", "-t", dest = "threads", type = int,
+        default = 2, help = "Threads for talon. Default = 2")
+    parser.add_argument("--seed", dest = "seed", type = int, default = 1,
+        help = "Random seed. Default = 1")
+    parser.add_argument("--workdir", dest = "workdir", type = str,
+        default = "talon_benchmark",
+        help = "Scratch directory. It is emptied first. " + \
+               "Default = talon_benchmark")
+    parser.add_argument("--talon_args", dest = "talon_args", type = str,
+        default = "",
+        help = "Extra options for talon, e.g. --talon_args='--bulk_load'")
+    parser.add_argument("--json", dest = "json_file", type = str, default = None,
+        help = "File to write the results to. Default: <workdir>/results.json")
+    parser.add_argument("--baseline", dest = "baseline", type = str,
+        default = None, help = "Results file to compare with")
+    return parser.parse_args()
+
+def parse_mix(mix):
+    """ 'FSM=0.4,ISM=0.1' -> {category: fraction}, scaled to sum to one """
+    fractions = {}
+    for item in mix.split(","):
+        category, fraction = item.split("=")
+        if category not in CATEGORIES:
+            raise ValueError("Unknown read category '%s'. Choose from %s" % \
+                             (category, ", ".join(CATEGORIES)))
+        fractions[category] = float(fraction)
+    total = sum(fractions.values())
+    return { x: y/total for x, y in fractions.items() }
+
+def generate_gtf(fpath, n_genes, rnd, n_chroms = 3):
+    """ Writes an annotation of n_genes genes spread over n_chroms
+        chromosomes. Most genes are spliced and have a second transcript
+        that skips an exon. """
+    pos = {}
+    with open(fpath, 'w') as gtf:
+        for i in range(n_genes):
+            chrom = "chr%d" % (i % n_chroms + 1)
+            pos.setdefault(chrom, 10000)
+            strand = rnd.choice("+-")
+            exons = []
+            start = pos[chrom]
+            for j in range(rnd.choice([1, 2, 3, 4, 5, 6, 8, 10])):
+                length = rnd.randint(80, 400)
+                exons.append((start, start + length - 1))
+                start += length + rnd.randint(150, 5000)
+            pos[chrom] = exons[-1][1] + rnd.randint(2000, 30000)
+
+            gene_ID = "BENCHG%06d" % i
+            transcripts = [exons]
+            if len(exons) > 2:
+                skip = rnd.randint(1, len(exons) - 2)
+                transcripts.append(exons[:skip] + exons[skip + 1:])
+
+            gene_attr = 'gene_id "%s"; gene_name "%s";' % (gene_ID, gene_ID)
+            gtf.write("\t".join([chrom, "BENCH", "gene", str(exons[0][0]),
+                                 str(exons[-1][1]), ".", strand, ".",
+                                 gene_attr]) + "\n")
+            for j, transcript in enumerate(transcripts):
+                transcript_ID = "%s-%d" % (gene_ID, j + 1)
+                attr = gene_attr + ' transcript_id "%s"; transcript_name "%s";' \
+                       % (transcript_ID, transcript_ID)
+                gtf.write("\t".join([chrom, "BENCH", "transcript",
+                                     str(transcript[0][0]),
+                                     str(transcript[-1][1]), ".", strand, ".",
+                                     attr]) + "\n")
+                for k, exon in enumerate(transcript):
+                    gtf.write("\t".join([chrom, "BENCH", "exon", str(exon[0]),
+                                         str(exon[1]), ".", strand, ".",
+                                         attr + ' exon_id "%s.%d";' % \
+                                         (transcript_ID, k + 1)]) + "\n")
+
+def read_gtf(fpath):
+    """ Returns the transcripts of a GTF file as (chromosome, strand, sorted
+        list of 1-based exons) tuples """
+    exons = {}
+    with open(fpath, 'r') as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[2] != "exon":
+                continue
+            attributes = dict([ x.strip().split(" ", 1) for x in
+                                fields[8].split(";") if x.strip() != "" ])
+            transcript_ID = attributes["transcript_id"].strip('"')
+            entry = exons.setdefault(transcript_ID, (fields[0], fields[6], []))
+            entry[2].append((int(fields[3]), int(fields[4])))
+    return [ (chrom, strand, sorted(x)) for chrom, strand, x in exons.values() ]
+
+def simulate_read(category, transcripts, spliced, gene_ends, rnd):
+    """ Picks a transcript and derives the exons of a read of the category
+        from it. Returns (chromosome, strand, exons). """
+    if category in ["FSM", "intergenic", "monoexonic"]:
+        chrom, strand, exons = rnd.choice(transcripts)
+    elif category in ["ISM", "NIC"]:
+        chrom, strand, exons = rnd.choice(spliced[3])
+    else:
+        chrom, strand, exons = rnd.choice(spliced[2])
+    exons = [ list(x) for x in exons ]
+
+    if category == "ISM":
+        # Lose exons from either end, but keep at least two
+        n_lost = rnd.randint(1, len(exons) - 2)
+        exons = exons[n_lost:] if rnd.random() < 0.5 else exons[:-n_lost]
+    elif category == "NIC":
+        del exons[rnd.randint(1, len(exons) - 2)]
+    elif category == "NNC":
+        # Move one splice site into the neighbouring intron
+        i = rnd.randint(0, len(exons) - 2)
+        if rnd.random() < 0.5:
+            exons[i][1] += rnd.randint(5, 20)
+        else:
+            exons[i + 1][0] -= rnd.randint(5, 20)
+    elif category == "antisense":
+        strand = "-" if strand == "+" else "+"
+    elif category == "monoexonic":
+        exons = [rnd.choice(exons)]
+    elif category == "intergenic":
+        # Past the last gene of the chromosome
+        start = gene_ends[chrom] + rnd.randint(20000, 200000)
+        exons = [[start, start + rnd.randint(200, 1500)]]
+        if rnd.random() < 0.5:
+            intron_end = exons[0][1] + rnd.randint(200, 3000)
+            exons.append([intron_end, intron_end + rnd.randint(100, 800)])
+
+    # The read ends vary around the transcript ends
+    exons[0][0] += rnd.randint(-min(30, exons[0][0] - 1),
+                               max(0, min(30, exons[0][1] - exons[0][0] - 50)))
+    exons[-1][1] += rnd.randint(-max(0, min(30, exons[-1][1] - exons[-1][0] - 50)),
+                                30)
+    return chrom, strand, exons
+
+def write_reads(fpath, transcripts, n_reads, fractions, rnd):
+    """ Writes the simulated reads to a sorted and indexed BAM. The category
+        of each read is part of its name. Returns the number of reads of each
+        category. """
+    spliced = { n: [ x for x in transcripts if len(x[2]) >= n ] for n in [2, 3] }
+    gene_ends = {}
+    for chrom, strand, exons in transcripts:
+        gene_ends[chrom] = max(gene_ends.get(chrom, 0), exons[-1][1])
+    chroms = sorted(gene_ends)
+    header = pysam.AlignmentHeader.from_dict({
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [ {"SN": x, "LN": gene_ends[x] + 250000} for x in chroms ]})
+
+    categories = [ x for x in CATEGORIES if fractions.get(x, 0) > 0 ]
+    weights = [ fractions[x] for x in categories ]
+    counts = dict.fromkeys(categories, 0)
+    reads = []
+    for i in range(n_reads):
+        category = rnd.choices(categories, weights)[0]
+        if (category in ["ISM", "NIC"] and spliced[3] == []) or \
+           (category in ["NNC", "antisense"] and spliced[2] == []):
+            category = "FSM"
+        counts[category] += 1
+        chrom, strand, exons = simulate_read(category, transcripts, spliced,
+                                             gene_ends, rnd)
+        reads.append((chroms.index(chrom), exons[0][0], i, category, strand,
+                      exons))
+    reads.sort()
+
+    bases = "ACGT"
+    with pysam.AlignmentFile(fpath, "wb", header = header) as bam:
+        for ref, start, i, category, strand, exons in reads:
+            cigar = []
+            length = 0
+            for j, (exon_start, exon_end) in enumerate(exons):
+                if j > 0:
+                    cigar.append((pysam.CREF_SKIP,
+                                  exon_start - exons[j - 1][1] - 1))
+                cigar.append((pysam.CMATCH, exon_end - exon_start + 1))
+                length += exon_end - exon_start + 1
+            read = pysam.AlignedSegment(header)
+            read.query_name = "read_%d_%s" % (i, category)
+            read.reference_id = ref
+            read.reference_start = start - 1
+            read.is_reverse = strand == "-"
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            read.query_sequence = "".join(rnd.choices(bases, k = length))
+            read.set_tag("MD", str(length))
+            bam.write(read)
+    pysam.index(fpath)
+    return counts
+
+def run_step(name, command, workdir):
+    """ Runs a command and returns its wall time and the peak RSS of its
+        largest process (itself or any process it waited for) """
+    log = os.path.join(workdir, name + ".log")
+    start = time.perf_counter()
+    with open(log, 'w') as f:
+        proc = subprocess.Popen(command, cwd = workdir, stdout = f,
+                                stderr = subprocess.STDOUT)
+        pid, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    # Same convention as Popen: negative signal number if it was killed
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1024*1024 if sys.platform == "darwin" else 1024
+    return {"command": " ".join([ shlex.quote(x) for x in command ]),
+            "seconds": seconds,
+            "peak_rss_mb": usage.ru_maxrss/scale,
+            "returncode": proc.returncode,
+            "log": log}
+
+def count_assignments(read_annot_file):
+    """ Simulated category -> TALON transcript novelty -> number of reads """
+    assignments = {}
+    with open(read_annot_file, 'r') as f:
+        columns = f.readline().rstrip("\n").split("\t")
+        name_col = columns.index("read_name")
+        novelty_col = columns.index("transcript_novelty")
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            category = fields[name_col].rsplit("_", 1)[1]
+            novelty = fields[novelty_col]
+            counts = assignments.setdefault(category, {})
+            counts[novelty] = counts.get(novelty, 0) + 1
+    return assignments
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                    cwd = os.path.dirname(os.path.abspath(__file__)),
+                    stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """ Prints the time and memory of each step next to the baseline """
+    print("%-12s %10s %10s %7s %10s %10s" % ("step", "seconds", "baseline",
+                                             "ratio", "RSS (MB)", "baseline"))
+    for name, step in results["steps"].items():
+        old = baseline["steps"].get(name)
+        if old == None:
+            continue
+        print("%-12s %10.2f %10.2f %7.2f %10.1f %10.1f" % \
+              (name, step["seconds"], old["seconds"],
+               step["seconds"]/old["seconds"], step["peak_rss_mb"],
+               old["peak_rss_mb"]))
+    if results["talon_reads_per_sec"] and baseline.get("talon_reads_per_sec"):
+        print("talon reads/s: %.1f (baseline %.1f)" % \
+              (results["talon_reads_per_sec"], baseline["talon_reads_per_sec"]))
+
+def main():
+    options = get_args()
+    fractions = parse_mix(options.mix)
+    rnd = random.Random(options.seed)
+    workdir = os.path.abspath(options.workdir)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+
+    gtf = options.gtf
+    if gtf == None:
+        gtf = os.path.join(workdir, "annotation.gtf")
+        generate_gtf(gtf, options.n_genes, rnd)
+    gtf = os.path.abspath(gtf)
+    bam = os.path.join(workdir, "reads.bam")
+    simulated = write_reads(bam, read_gtf(gtf), options.n_reads, fractions,
+                            rnd)
+    with open(os.path.join(workdir, "config.csv"), 'w') as f:
+        f.write("bench,bench,simulated,%s\n" % bam)
+
+    steps = [("initialize", ["talon_initialize_database", "--f", gtf,
+                             "--g", BUILD, "--a", ANNOT, "--l", "0",
+                             "--o", "bench"]),
+             ("talon", ["talon", "--f", "config.csv", "--db", "bench.db",
+                        "--build", BUILD, "--threads", str(options.threads),
+                        "--o", "bench"] + shlex.split(options.talon_args)),
+             ("filter", ["talon_filter_transcripts", "--db", "bench.db",
+                         "--annot", ANNOT, "--o", "whitelist.csv"]),
+             ("abundance", ["talon_abundance", "--db", "bench.db",
+                            "--annot", ANNOT, "--build", BUILD,
+                            "--whitelist", "whitelist.csv", "--o", "bench"])]
+
+    results = {"commit": get_commit(),
+               "python": sys.version.split()[0],
+               "options": vars(options),
+               "reads": options.n_reads,
+               "simulated": simulated,
+               "steps": {},
+               "talon_reads_per_sec": None,
+               "assignments": None}
+    failed = False
+    for name, command in steps:
+        step = run_step(name, command, workdir)
+        results["steps"][name] = step
+        print("%-12s %8.2f s %8.1f MB%s" % \
+              (name, step["seconds"], step["peak_rss_mb"],
+               "" if step["returncode"] == 0 else
+               "  FAILED, see " + step["log"]))
+        if step["returncode"] != 0:
+            failed = True
+            break
+
+    if "talon" in results["steps"] and not failed:
+        results["talon_reads_per_sec"] = options.n_reads/ \
+                                         results["steps"]["talon"]["seconds"]
+        results["assignments"] = count_assignments(os.path.join(workdir,
+                                             "bench_talon_read_annot.tsv"))
+        print("talon reads/s: %.1f" % results["talon_reads_per_sec"])
+
+        # Stage timings, if talon was run with --profile
+        profile = os.path.join(workdir, "bench_profile.json")
+        if os.path.exists(profile):
+            with open(profile, 'r') as f:
+                results["talon_profile"] = json.load(f)
+
+    json_file = options.json_file
+    if json_file == None:
+        json_file = os.path.join(workdir, "results.json")
+    with open(json_file, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    if options.baseline != None:
+        with open(options.baseline, 'r') as f:
+            compare(results, json.load(f))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
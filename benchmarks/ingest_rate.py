@@ -0,0 +1,108 @@
+""" Measures how fast talon.update_database ingests observed reads, in the
+    default mode and in bulk-load mode. For each mode, the database is copied
+    to a scratch directory, N synthetic observed rows (spread over the
+    known transcripts) are written as the outfiles of a run, and the update is
+    timed. --existing preloads that many observed rows into the copies first,
+    as for a database that already holds earlier datasets.
+
+    Usage: python benchmarks/ingest_rate.py --db talon.db [--n N]
+               [--existing N] [--json FILE]
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from talon import talon
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--db", dest = "database", type = str, required = True,
+        help = "TALON database to copy. It is not modified.")
+    parser.add_argument("--n", dest = "n", type = int, default = 1000000,
+        help = "Number of observed rows to ingest. Default = 1000000")
+    parser.add_argument("--existing", dest = "existing", type = int, default = 0,
+        help = "Number of observed rows to preload. Default = 0")
+    parser.add_argument("--batch_size", dest = "batch_size", type = int,
+        default = 10000, help = "Insert batch size. Default = 10000")
+    parser.add_argument("--json", dest = "json_file", type = str, default = None,
+        help = "Optional file to write the results to as JSON")
+    return parser.parse_args()
+
+def observed_line(obs_ID, transcript, dataset):
+    """ Tab-separated observed tuple, as written by a TALON run """
+    gene_ID, transcript_ID, start_vertex, end_vertex, start_exon, end_exon = \
+        transcript
+    return "\t".join([str(obs_ID), str(gene_ID), str(transcript_ID),
+                      "read_%d" % obs_ID, dataset, str(start_vertex),
+                      str(end_vertex), str(start_exon), str(end_exon), "0",
+                      "0", "1500", "0.1", "None", "None", "None", "None"])
+
+def prepare_copy(database, workdir, name, existing, transcripts):
+    """ Copies the database and preloads the existing observed rows """
+    copy = os.path.join(workdir, name + ".db")
+    shutil.copy(database, copy)
+    with sqlite3.connect(copy) as conn:
+        first_ID = conn.execute("""SELECT count FROM counters
+                                   WHERE category = 'observed'""").fetchone()[0] + 1
+        conn.executemany("""INSERT INTO observed VALUES
+                               (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            ( [None if x == "None" else x for x in
+               observed_line(first_ID + i, transcripts[i % len(transcripts)],
+                             "preloaded").split("\t")]
+              for i in range(existing) ))
+        conn.execute("""UPDATE counters SET count = count + ?
+                        WHERE category = 'observed'""", (existing,))
+    return copy
+
+def run_update(database, workdir, name, n, batch_size, bulk_load, transcripts):
+    """ Writes the outfiles of a run with n reads and times the update """
+    outfiles = talon.init_outfiles(os.path.join(workdir, name),
+                                   tmp_dir = os.path.join(workdir, name + "_tmp"))
+    talon.get_counters(database)
+    dataset_ID = talon.dataset_counter.increment()
+    with open(outfiles.observed, 'w') as f:
+        for i in range(n):
+            obs_ID = talon.observed_counter.increment()
+            f.write(observed_line(obs_ID, transcripts[i % len(transcripts)],
+                                  name) + "\n")
+
+    start = time.time()
+    talon.update_database(database, batch_size, outfiles,
+                          [(dataset_ID, name, name, "benchmark")],
+                          bulk_load = bulk_load)
+    return time.time() - start
+
+def main():
+    options = get_args()
+    with sqlite3.connect(options.database) as conn:
+        transcripts = conn.execute("""SELECT gene_ID, transcript_ID,
+                                             start_vertex, end_vertex,
+                                             start_exon, end_exon
+                                      FROM transcripts""").fetchall()
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix = "talon_ingest_")
+    try:
+        for mode, bulk_load in [("default", False), ("bulk_load", True)]:
+            copy = prepare_copy(options.database, workdir, mode,
+                                options.existing, transcripts)
+            elapsed = run_update(copy, workdir, mode, options.n,
+                                 options.batch_size, bulk_load, transcripts)
+            results[mode] = {"seconds": elapsed,
+                             "rows_per_sec": options.n / elapsed}
+            print("%-10s %10.2f s %14.0f observed rows/sec" % \
+                  (mode, elapsed, options.n / elapsed))
+    finally:
+        shutil.rmtree(workdir)
+
+    if options.json_file != None:
+        with open(options.json_file, 'w') as f:
+            json.dump({"n": options.n, "existing": options.existing,
+                       "batch_size": options.batch_size, "results": results},
+                      f, indent = 2)
+
+if __name__ == '__main__':
+    main()
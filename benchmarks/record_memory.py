@@ -0,0 +1,89 @@
+""" Compares the memory used by the known-entity records in dstruct with the
+    sqlite3.Row objects (and plain dicts) that were used before. For each
+    record type, N synthetic rows are loaded from an in-memory SQLite table
+    and kept in a list, and the memory allocated for them is measured with
+    tracemalloc.
+
+    Usage: python benchmarks/record_memory.py [--n N] [--json FILE]
+"""
+import argparse
+import json
+import sqlite3
+import tracemalloc
+from talon import dstruct
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--n", dest = "n", type = int, default = 200000,
+        help = "Number of records of each type. Default = 200000")
+    parser.add_argument("--json", dest = "json_file", type = str, default = None,
+        help = "Optional file to write the results to as JSON")
+    return parser.parse_args()
+
+def make_rows(n):
+    """ Synthetic rows for each record type, with realistic value ranges """
+    locations = [ (i, "hg38", "chr1", 10000 + 37*i) for i in range(n) ]
+    edges = [ (i, i, i + 1, "exon" if i % 2 else "intron", "+")
+              for i in range(n) ]
+    transcripts = [ (i, i // 5, 2*i, ",".join(map(str, range(2*i + 1, 2*i + 8))),
+                     2*i + 8, 3*i, 3*i + 9, 5, "chr1", 10000 + 37*i,
+                     20000 + 37*i, 10000 + 37*i, 20000 + 37*i, "+", 1)
+                    for i in range(n) ]
+    return {dstruct.LocationRecord: locations, dstruct.EdgeRecord: edges,
+            dstruct.TranscriptRecord: transcripts}
+
+def measure(load):
+    """ Returns the bytes still allocated after load() returns its records """
+    tracemalloc.start()
+    records = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return current
+
+def main():
+    options = get_args()
+    conn = sqlite3.connect(":memory:")
+    results = {}
+    for record_type, rows in make_rows(options.n).items():
+        fields = record_type.fields
+        table = record_type.__name__
+        conn.execute("CREATE TABLE %s (%s)" % (table, ", ".join(fields)))
+        conn.executemany("INSERT INTO %s VALUES (%s)" % \
+                         (table, ", ".join(["?"]*len(fields))), rows)
+        query = "SELECT * FROM %s" % table
+
+        def load_rows():
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            return cursor.execute(query).fetchall()
+
+        def load_dicts():
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            return [ dict(x) for x in cursor.execute(query).fetchall() ]
+
+        def load_records():
+            cursor = conn.cursor()
+            cursor.row_factory = lambda cur, row: record_type.from_row(row)
+            return cursor.execute(query).fetchall()
+
+        results[table] = { name: measure(load) for name, load in
+                           [("sqlite3.Row", load_rows), ("dict", load_dicts),
+                            ("record", load_records)] }
+
+    print("%-18s %14s %14s %14s %8s" % ("bytes/entity", "sqlite3.Row",
+                                        "dict", "record", "saving"))
+    for table, sizes in results.items():
+        per_entity = { name: size / options.n for name, size in sizes.items() }
+        print("%-18s %14.1f %14.1f %14.1f %7.0f%%" % (table,
+              per_entity["sqlite3.Row"], per_entity["dict"],
+              per_entity["record"],
+              100*(1 - per_entity["record"] / per_entity["sqlite3.Row"])))
+
+    if options.json_file != None:
+        with open(options.json_file, 'w') as f:
+            json.dump({"n": options.n, "bytes": results}, f, indent = 2)
+
+if __name__ == '__main__':
+    main()
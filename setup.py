@@ -48,9 +48,9 @@ setup(
     ],
     python_requires=">=3.6",
     install_requires=[
+        "numpy",
         "pandas",
         "pysam==0.15.4",
-        "pybedtools",
         "pyfaidx"
     ],
     entry_points={
@@ -65,7 +65,9 @@ setup(
             'talon_generate_report=talon.post.generate_talon_report:main',
             'talon_summarize=talon.post.summarize_datasets:main',
             'talon_fetch_reads=talon.post.get_read_annotations:main',
-            'talon_get_sjs=talon.post.get_transcript_sjs:main'
+            'talon_get_sjs=talon.post.get_transcript_sjs:main',
+            'talon_build_reference_pack=talon.reference_pack:main',
+            'talon_upgrade_database=talon.upgrade_database:main'
         ]
     }
 )
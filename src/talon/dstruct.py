@@ -1,3 +1,6 @@
+from bisect import bisect_left, bisect_right, insort
+from sys import intern
+
 class Struct(dict):
     """
     Make a dict behave as a struct.
@@ -10,3 +13,266 @@ class Struct(dict):
     def __init__(self,**kw):
         dict.__init__(self,kw)
         self.__dict__ = self
+
+class TranscriptDict(dict):
+    """
+    Dict of transcripts keyed by the frozenset of their edge IDs. It also 
+    keeps an inverted index (edge ID -> keys of the transcripts that contain 
+    that edge), which is updated whenever a new key is assigned with [].
+    Posting lists are kept in insertion order, so lookups return transcripts
+    in the same order as iterating over the dict would.
+    """
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.edge_index = {}
+        for key in self:
+            self._index_key(key)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._index_key(key)
+        dict.__setitem__(self, key, value)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def _index_key(self, key):
+        for edge in key:
+            try:
+                self.edge_index[edge].append(key)
+            except KeyError:
+                self.edge_index[edge] = [key]
+
+    def find_supersets(self, edges):
+        """ Return the keys that contain every edge in the provided frozenset.
+            Only the transcripts on the shortest posting list get checked. """
+        postings = []
+        for edge in edges:
+            if edge not in self.edge_index:
+                return []
+            postings.append(self.edge_index[edge])
+        if len(postings) == 0:
+            return list(self.keys())
+
+        shortest = min(postings, key = len)
+        return [ x for x in shortest if edges.issubset(x) ]
+
+class PositionDict(dict):
+    """
+    Dict keyed by integer position (i.e. position -> vertex) that also keeps
+    a sorted list of its keys, so that the closest position to a query can
+    be found with a binary search instead of probing the dict one position
+    at a time. New keys must be added with [] to keep the list in sync.
+    """
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.positions = sorted(self)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            insort(self.positions, key)
+        dict.__setitem__(self, key, value)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def neighbours(self, position, window_start, window_end):
+        """ Return the closest keys below and above position (None if there
+            is no such key) that lie strictly between window_start and
+            window_end. """
+        return window_neighbours(self.positions, position, window_start,
+                                 window_end)
+
+    def find_closest(self, position, window_start, window_end, direction):
+        """ Return the key closest to position (excluding position itself)
+            that lies strictly between window_start and window_end. If keys 
+            on either side are equally close, the one in the provided 
+            direction (-1 for smaller, 1 for larger) wins. Returns None if 
+            there is no key in the window. """
+        left, right = self.neighbours(position, window_start, window_end)
+
+        if left is None:
+            return right
+        if right is None:
+            return left
+
+        left_dist = position - left
+        right_dist = right - position
+        if left_dist < right_dist or (left_dist == right_dist and direction < 0):
+            return left
+        return right
+
+    def closest_in_window(self, position, window_start, window_end):
+        """ Return the key closest to position (possibly position itself)
+            among the keys from window_start to window_end, inclusive. If
+            keys on either side are equally close, the one that was added to
+            the dict first wins, as when scanning the dict in order. Returns
+            None if there is no key in the window. """
+        positions = self.positions
+        left = None
+        right = None
+
+        # Closest key at or above position that is still inside the window
+        j = bisect_left(positions, max(position, window_start))
+        if j < len(positions) and positions[j] <= window_end:
+            right = positions[j]
+
+        # Closest key below position that is still inside the window
+        if position <= window_end:
+            i = bisect_left(positions, position)
+        else:
+            i = bisect_right(positions, window_end)
+        if i > 0 and positions[i - 1] >= window_start:
+            left = positions[i - 1]
+
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if position - left != right - position:
+            return left if position - left < right - position else right
+        for key in self:
+            if key == left or key == right:
+                return key
+
+def window_neighbours(positions, position, window_start, window_end):
+    """ Given a sorted sequence of positions, return the closest ones below
+        and above position (None if there is no such position) that lie
+        strictly between window_start and window_end. """
+    left = None
+    right = None
+
+    # Closest key below position that is still inside the window
+    i = bisect_left(positions, min(position, window_end))
+    if i > 0 and positions[i - 1] > window_start:
+        left = positions[i - 1]
+
+    # Closest key above position that is still inside the window
+    j = bisect_right(positions, max(position, window_start))
+    if j < len(positions) and positions[j] < window_end:
+        right = positions[j]
+
+    return left, right
+
+class IntervalIndex(object):
+    """
+    In-memory index of interval records (dicts with at least 'chromosome'
+    and 'strand' keys, plus the interval start and end under start_key and
+    end_key). For each chromosome and strand, the records are kept in a list
+    sorted on start, along with the longest interval length seen so far. An
+    overlap query is then a binary search for the first record that could
+    reach the query start, followed by a scan up to the query end. Records
+    can be added at any time, and queries return them in the order that
+    they were added.
+    """
+    def __init__(self, records = (), start_key = 'start', end_key = 'end'):
+        self.start_key = start_key
+        self.end_key = end_key
+        self.groups = {}
+        self.all_records = []
+        for record in records:
+            self.add(record)
+
+    def __len__(self):
+        return len(self.all_records)
+
+    def add(self, record):
+        """ Add a record to the index. """
+        chrom = record['chromosome']
+        strand = record['strand']
+        start = record[self.start_key]
+        if chrom not in self.groups:
+            self.groups[chrom] = {}
+        if strand not in self.groups[chrom]:
+            self.groups[chrom][strand] = ([], [], [0])
+        starts, records, max_length = self.groups[chrom][strand]
+
+        i = bisect_right(starts, start)
+        starts.insert(i, start)
+        records.insert(i, (len(self.all_records), record))
+        max_length[0] = max(max_length[0], record[self.end_key] - start)
+        self.all_records.append(record)
+
+    def find_overlaps(self, chrom, start, end, strand = None):
+        """ Return the records on chrom that overlap the interval [start, end]
+            (inclusive on both sides), in the order they were added. If a 
+            strand is provided, only records on that strand are returned. """
+        if chrom not in self.groups:
+            return []
+        if strand == None:
+            groups = list(self.groups[chrom].values())
+        elif strand in self.groups[chrom]:
+            groups = [ self.groups[chrom][strand] ]
+        else:
+            return []
+
+        matches = []
+        for starts, records, max_length in groups:
+            i = bisect_left(starts, start - max_length[0])
+            j = bisect_right(starts, end)
+            matches.extend([ x for x in records[i:j] 
+                             if x[1][self.end_key] >= start ])
+        matches.sort(key = lambda x: x[0])
+        return [ x[1] for x in matches ]
+
+    def entries(self):
+        """ Return all records in the order they were added. """
+        return self.all_records
+
+class Record(tuple):
+    """
+    Compact, immutable stand-in for a sqlite3.Row, used to store known 
+    entities. Like a row, its values can be accessed by column name or by 
+    position, and iterating over it yields the values. Subclasses list their
+    column names in 'fields', and the columns that only take a handful of
+    distinct string values (i.e. chromosome) in 'shared_fields'. from_row
+    interns these, so that all records share one copy of each string.
+    """
+    __slots__ = ()
+    fields = ()
+    shared_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.field_index = { name: i for i, name in enumerate(cls.fields) }
+        cls.shared_index = [ cls.field_index[name] for name in cls.shared_fields ]
+
+    @classmethod
+    def from_row(cls, row):
+        """ Create a record from a database row (or any sequence of values
+            in field order) """
+        values = list(row)
+        for i in cls.shared_index:
+            if values[i] is not None:
+                values[i] = intern(values[i])
+        return cls(values)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self.field_index[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self.fields)
+
+class LocationRecord(Record):
+    """ Row of the location table """
+    __slots__ = ()
+    fields = ("location_ID", "genome_build", "chromosome", "position")
+    shared_fields = ("genome_build", "chromosome")
+
+class EdgeRecord(Record):
+    """ Row of the edge table """
+    __slots__ = ()
+    fields = ("edge_ID", "v1", "v2", "edge_type", "strand")
+    shared_fields = ("edge_type", "strand")
+
+class TranscriptRecord(Record):
+    """ Row of the transcripts table, along with the location, gene strand,
+        and known status of the transcript (see 
+        init_refs.make_region_structures) """
+    __slots__ = ()
+    fields = ("transcript_ID", "gene_ID", "start_exon", "jn_path", "end_exon",
+              "start_vertex", "end_vertex", "n_exons", "chrom", "start_pos",
+              "end_pos", "min_pos", "max_pos", "strand", "known")
+    shared_fields = ("chrom", "strand")
@@ -0,0 +1,226 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Maintains the stored genomic extents of genes and transcripts (chromosome,
+# start, and end for each genome build) along with an R*Tree over each, so
+# that the genes or transcripts overlapping a region can be found with an
+# indexed range query instead of recomputing the span of every gene or
+# transcript in the database. Each R*Tree has two dimensions: the chromosome
+# (as an integer key from the extent_chromosome table) and the genomic
+# position.
+# ---------------------------------------------------------------------
+# create_extent_tables
+# has_extents
+# update_gene_extents
+# update_transcript_extents
+# update_extents
+# gene_extent_query
+# transcripts_in_region
+
+from string import Template
+
+# For each kind of extent: the ID column, the names of the columns holding
+# the lower and upper position, and the query that computes the extents
+# ($filter restricts it to the IDs being updated).
+EXTENTS = {"gene": ("gene_ID", "start", "end",
+                    """ SELECT v.gene_ID,
+                               loc.genome_build,
+                               loc.chromosome,
+                               MIN(loc.position) as start,
+                               MAX(loc.position) as end
+                        FROM vertex as v
+                        JOIN location as loc ON loc.location_ID = v.vertex_ID
+                        $filter
+                        GROUP BY v.gene_ID, loc.genome_build """),
+           "transcript": ("transcript_ID", "min_pos", "max_pos",
+                    """ SELECT t.transcript_ID,
+                               loc1.genome_build,
+                               loc1.chromosome,
+                               MIN(loc1.position, loc2.position) as min_pos,
+                               MAX(loc1.position, loc2.position) as max_pos
+                        FROM transcripts as t
+                        JOIN location as loc1 ON loc1.location_ID = t.start_vertex
+                        JOIN location as loc2 ON loc2.location_ID = t.end_vertex
+                            AND loc2.genome_build = loc1.genome_build
+                        $filter """)}
+
+def create_extent_tables(cursor):
+    """ Creates the extent tables if they do not exist yet:
+        - extent_chromosome: integer key for each (genome build, chromosome)
+        - gene_extent: chromosome, start, and end of each gene in each build
+        - transcript_extent: chromosome, min_pos, and max_pos of each
+          transcript in each build
+        - gene_extent_rtree and transcript_extent_rtree: R*Trees over the
+          extents, keyed by extent_ID
+    """
+    cursor.execute(""" CREATE TABLE IF NOT EXISTS extent_chromosome (
+                           chrom_ID INTEGER PRIMARY KEY,
+                           genome_build TEXT,
+                           chromosome TEXT,
+
+                           UNIQUE (genome_build, chromosome)
+                           ); """)
+
+    for kind, (id_col, lower, upper, query) in EXTENTS.items():
+        key_table = "genes" if kind == "gene" else "transcripts"
+        cursor.execute(Template(""" CREATE TABLE IF NOT EXISTS ${kind}_extent (
+                           extent_ID INTEGER PRIMARY KEY,
+                           $id_col INTEGER,
+                           genome_build TEXT,
+                           chrom_ID INTEGER,
+                           $lower INTEGER,
+                           $upper INTEGER,
+
+                           UNIQUE ($id_col, genome_build),
+                           FOREIGN KEY ($id_col) REFERENCES $key_table($id_col),
+                           FOREIGN KEY (chrom_ID) REFERENCES extent_chromosome(chrom_ID)
+                           ); """).substitute({'kind': kind, 'id_col': id_col,
+                                               'lower': lower, 'upper': upper,
+                                               'key_table': key_table}))
+
+        cursor.execute(Template(""" CREATE VIRTUAL TABLE IF NOT EXISTS ${kind}_extent_rtree
+                           USING rtree_i32(extent_ID, min_chrom, max_chrom,
+                                           $lower, $upper); """).substitute(
+                           {'kind': kind, 'lower': lower, 'upper': upper}))
+    return
+
+def has_extents(cursor, kind = "gene"):
+    """ Returns True if the database has the extent tables for the kind
+        ('gene' or 'transcript'). Databases made before they were introduced
+        get them from talon_upgrade_database. """
+
+    cursor.execute(""" SELECT COUNT(*) FROM sqlite_master
+                       WHERE type = 'table'
+                       AND name IN ('extent_chromosome', ?, ?) """,
+                   (kind + "_extent", kind + "_extent_rtree"))
+    return cursor.fetchone()[0] == 3
+
+def update_extents(cursor, kind, IDs = None):
+    """ Recomputes the extents of the provided genes or transcripts (kind is
+        'gene' or 'transcript') and writes them to the extent table and its
+        R*Tree. If IDs is None, the extents of all of them are computed.
+    """
+    id_col, lower, upper, query = EXTENTS[kind]
+    names = {'kind': kind, 'id_col': id_col, 'lower': lower, 'upper': upper}
+
+    if IDs == None:
+        id_filter = ""
+    else:
+        cursor.execute("DROP TABLE IF EXISTS temp.extent_IDs")
+        cursor.execute("CREATE TEMPORARY TABLE extent_IDs (ID INTEGER PRIMARY KEY)")
+        cursor.executemany("INSERT OR IGNORE INTO extent_IDs VALUES (?)",
+                           [ (x,) for x in IDs ])
+        table_alias = "v" if kind == "gene" else "t"
+        id_filter = "WHERE %s.%s IN (SELECT ID FROM extent_IDs)" % \
+                    (table_alias, id_col)
+
+    cursor.execute("DROP TABLE IF EXISTS temp.new_extent")
+    cursor.execute("CREATE TEMPORARY TABLE new_extent AS " + \
+                   Template(query).substitute({'filter': id_filter}))
+
+    cursor.execute(""" INSERT OR IGNORE INTO extent_chromosome
+                           (genome_build, chromosome)
+                           SELECT DISTINCT genome_build, chromosome
+                           FROM new_extent """)
+
+    # Existing extents keep their ID, so their R*Tree entry is replaced
+    cursor.execute(Template(""" INSERT OR REPLACE INTO ${kind}_extent
+                           (extent_ID, $id_col, genome_build, chrom_ID, $lower, $upper)
+                           SELECT (SELECT extent_ID FROM ${kind}_extent as e
+                                   WHERE e.$id_col = n.$id_col
+                                   AND e.genome_build = n.genome_build),
+                                  n.$id_col,
+                                  n.genome_build,
+                                  ec.chrom_ID,
+                                  n.$lower,
+                                  n.$upper
+                           FROM new_extent as n
+                           JOIN extent_chromosome as ec
+                               ON ec.genome_build = n.genome_build
+                               AND ec.chromosome = n.chromosome """).substitute(names))
+
+    cursor.execute(Template(""" INSERT OR REPLACE INTO ${kind}_extent_rtree
+                           SELECT e.extent_ID, e.chrom_ID, e.chrom_ID,
+                                  e.$lower, e.$upper
+                           FROM new_extent as n
+                           JOIN ${kind}_extent as e
+                               ON e.$id_col = n.$id_col
+                               AND e.genome_build = n.genome_build """).substitute(names))
+
+    cursor.execute("DROP TABLE IF EXISTS temp.new_extent")
+    cursor.execute("DROP TABLE IF EXISTS temp.extent_IDs")
+    return
+
+def update_gene_extents(cursor, gene_IDs = None):
+    """ Recomputes the extents of the provided genes from their vertices.
+        Genes gain vertices (and may grow) when novel transcripts are assigned
+        to them, so this is run for every gene that got a new vertex. If
+        gene_IDs is None, the extents of all genes are computed.
+    """
+    update_extents(cursor, "gene", gene_IDs)
+    return
+
+def update_transcript_extents(cursor, transcript_IDs = None):
+    """ Computes the extents of the provided transcripts from their start and
+        end vertices. A transcript's vertices never change, so this is only
+        needed for new transcripts. If transcript_IDs is None, the extents of
+        all transcripts are computed.
+    """
+    update_extents(cursor, "transcript", transcript_IDs)
+    return
+
+def chrom_key_query(build, chrom):
+    """ Scalar subquery for the extent_chromosome key of the chromosome """
+    return Template("""(SELECT chrom_ID FROM extent_chromosome
+                        WHERE genome_build = '$build'
+                        AND chromosome = '$chrom')""").substitute(
+               {'build':build, 'chrom':chrom})
+
+def gene_extent_query(build, chrom = None, start = None, end = None):
+    """ Equivalent of init_refs.gene_interval_query that reads the stored gene
+        extents. Fetches the gene ID, chromosome, start, end, and strand of
+        each gene in the build. If chrom, start, and end are provided, only
+        genes overlapping that region are selected, using the R*Tree.
+    """
+    if any(val == None for val in [chrom, start, end]):
+        query = """ SELECT ge.gene_ID,
+                           ec.chromosome,
+                           ge.start,
+                           ge.end,
+                           genes.strand
+                    FROM gene_extent as ge
+                    JOIN extent_chromosome as ec ON ec.chrom_ID = ge.chrom_ID
+                    LEFT JOIN genes ON genes.gene_ID = ge.gene_ID
+                    WHERE ge.genome_build = '$build'
+                    ORDER BY ge.gene_ID"""
+    else:
+        query = """ SELECT ge.gene_ID,
+                           ec.chromosome,
+                           ge.start,
+                           ge.end,
+                           genes.strand
+                    FROM gene_extent_rtree as r
+                    JOIN gene_extent as ge ON ge.extent_ID = r.extent_ID
+                    JOIN extent_chromosome as ec ON ec.chrom_ID = ge.chrom_ID
+                    LEFT JOIN genes ON genes.gene_ID = ge.gene_ID
+                    WHERE r.min_chrom <= $chrom_ID AND r.max_chrom >= $chrom_ID
+                        AND r.start <= $end AND r.end >= $start
+                    ORDER BY ge.gene_ID"""
+
+    return Template(query).substitute({'build':build,
+                                       'chrom_ID':chrom_key_query(build, chrom),
+                                       'start':start, 'end':end})
+
+def transcripts_in_region(build, chrom, start, end):
+    """ Subquery that selects the rows of the transcripts table whose stored
+        extent overlaps the region, using the R*Tree. It can be used in place
+        of the transcripts table in the FROM clause of a regional query.
+    """
+    query = """(SELECT t.*
+                FROM transcript_extent_rtree as r
+                JOIN transcript_extent as te ON te.extent_ID = r.extent_ID
+                JOIN transcripts as t ON t.transcript_ID = te.transcript_ID
+                WHERE r.min_chrom <= $chrom_ID AND r.max_chrom >= $chrom_ID
+                    AND r.min_pos <= $end AND r.max_pos >= $start)"""
+
+    return Template(query).substitute({'chrom_ID':chrom_key_query(build, chrom),
+                                       'start':start, 'end':end})
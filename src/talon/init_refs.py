@@ -5,14 +5,25 @@
 # structures for the TALON run.
 # ---------------------------------------------------------------------
 # make_temp_novel_gene_table
+# make_novel_gene_index
+# make_gene_span_dict
+# region_gene_query
 # make_temp_monoexonic_transcript_table
+# make_monoexon_index
 # make_location_dict
 # make_edge_dict
 # make_transcript_dict
 # make_vertex_2_gene_dict
 # make_gene_start_and_end_dict
+# make_region_structures
+# region_transcript_query
+# transcript_source
+# fetch_records
 
 from string import Template
+import time
+from . import dstruct
+from . import extent_utils
 
 def make_temp_novel_gene_table(cursor, build, chrom = None, start = None, 
                                end = None, tmp_tab = "temp_gene"):
@@ -25,52 +36,80 @@ def make_temp_novel_gene_table(cursor, build, chrom = None, start = None,
         The purpose is to track novel genes from this run in order to match
         transcripts to them when other forms of gene assignment have failed.
     """
-    if any(val == None for val in [chrom, start, end]):
-        command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
-                                   SELECT gene_ID,
-                                     chromosome,
-                                     start,
-                                     end,
-                                     strand
-                                    FROM (SELECT g.gene_ID,
-                                              loc.chromosome,
-                                              MIN(loc.position) as start,
-                                              MAX(loc.position) as end,
-                                              g.strand
-                                        FROM genes as g
-                                        LEFT JOIN vertex as v ON g.gene_ID = v.gene_ID
-                                        LEFT JOIN location as loc ON loc.location_ID = v.vertex_ID
-                                        WHERE loc.genome_build = '$build'
-                                        GROUP BY g.gene_ID); """)
-    else:
-        command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
-                                   SELECT gene_ID,
-                                     chromosome,
-                                     start,
-                                     end,
-                                     strand
-                                    FROM (SELECT g.gene_ID,
-                                              loc.chromosome,
-                                              MIN(loc.position) as start,
-                                              MAX(loc.position) as end,
-                                              g.strand
-                                        FROM genes as g
-                                        LEFT JOIN vertex as v ON g.gene_ID = v.gene_ID
-                                        LEFT JOIN location as loc ON loc.location_ID = v.vertex_ID
-                                        WHERE loc.genome_build = '$build'
-                                        GROUP BY g.gene_ID)
-                                    WHERE chromosome = '$chrom'
-                                        AND ((start <= $start AND end >= $end)
-                                          OR (start >= $start AND end <= $end)
-                                          OR (start >= $start AND start <= $end)
-                                          OR (end >= $start AND end <= $end)); """)
-
-    command = command.substitute({'tmp_tab':tmp_tab, 'build':build, 'chrom':chrom,
-                                  'start':start, 'end':end})
+    command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
+                               $query; """)
+    command = command.substitute({'tmp_tab':tmp_tab, 
+                                  'query': region_gene_query(cursor, build,
+                                                             chrom, start, end)})
     cursor.execute(command)
 
     return tmp_tab
 
+def make_novel_gene_index(cursor, build, chrom = None, start = None, 
+                          end = None):
+    """ In-memory alternative to make_temp_novel_gene_table. Returns a 
+        dstruct.IntervalIndex holding the same gene records (dicts with the 
+        fields gene_ID, chromosome, start, end, and strand), which novel genes 
+        are added to during the run.
+    """
+    cursor.execute(region_gene_query(cursor, build, chrom, start, end))
+    return dstruct.IntervalIndex([ dict(x) for x in cursor.fetchall() ])
+
+def make_gene_span_dict(cursor, build):
+    """ Format of dict:
+            Key: chromosome
+            Value: list of (start, end) tuples, one per gene in the build
+    """
+    cursor.execute(region_gene_query(cursor, build))
+    gene_spans = {}
+    for gene in cursor.fetchall():
+        try:
+            gene_spans[gene['chromosome']].append((gene['start'], gene['end']))
+        except KeyError:
+            gene_spans[gene['chromosome']] = [(gene['start'], gene['end'])]
+
+    return gene_spans
+
+def region_gene_query(cursor, build, chrom = None, start = None, end = None):
+    """ Returns the query for the genes of the build (overlapping the region,
+        if provided). This is a range query on the stored gene extents if the
+        database has them, and gene_interval_query otherwise.
+    """
+    if extent_utils.has_extents(cursor):
+        return extent_utils.gene_extent_query(build, chrom, start, end)
+    return gene_interval_query(build, chrom, start, end)
+
+def gene_interval_query(build, chrom = None, start = None, end = None):
+    """ Query that fetches the gene ID, chromosome, start, end, and strand of
+        each gene in the build. If chrom, start, and end are provided, only 
+        genes overlapping that region are selected.
+    """
+    query = """ SELECT gene_ID,
+                     chromosome,
+                     start,
+                     end,
+                     strand
+                    FROM (SELECT g.gene_ID,
+                              loc.chromosome,
+                              MIN(loc.position) as start,
+                              MAX(loc.position) as end,
+                              g.strand
+                        FROM genes as g
+                        LEFT JOIN vertex as v ON g.gene_ID = v.gene_ID
+                        LEFT JOIN location as loc ON loc.location_ID = v.vertex_ID
+                        WHERE loc.genome_build = '$build'
+                        GROUP BY g.gene_ID)"""
+    if not any(val == None for val in [chrom, start, end]):
+        query += """
+                    WHERE chromosome = '$chrom'
+                        AND ((start <= $start AND end >= $end)
+                          OR (start >= $start AND end <= $end)
+                          OR (start >= $start AND start <= $end)
+                          OR (end >= $start AND end <= $end))"""
+
+    return Template(query).substitute({'build':build, 'chrom':chrom,
+                                       'start':start, 'end':end})
+
 def make_temp_monoexonic_transcript_table(cursor, build, chrom = None,
                                           start = None, end = None,
                                           tmp_tab = "temp_monoexon"):
@@ -84,68 +123,76 @@ def make_temp_monoexonic_transcript_table(cursor, build, chrom = None,
         The purpose is to allow location-based matching for monoexonic query
         transcripts. """
 
-    if any(val == None for val in [chrom, start, end]):
-        command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
-                                   SELECT t.gene_ID,
-                                      t.transcript_ID,
-                                      loc1.chromosome,
-                                      loc1.position as start,
-                                      loc2.position as end,
-                                      genes.strand,
-                                      t.start_vertex,
-                                      t.end_vertex,
-                                      t.start_exon as exon_ID,
-                                      MIN(loc1.position, loc2.position) as min_pos,
-                                      MAX(loc1.position, loc2.position) as max_pos
-                                   FROM transcripts as t
-                                   LEFT JOIN location as loc1
-                                       ON loc1.location_ID = t.start_vertex
-                                   LEFT JOIN location as loc2
-                                       ON loc2.location_ID = t.end_vertex
-                                   LEFT JOIN genes
-                                       ON genes.gene_ID = t.gene_ID
-                                   WHERE n_exons = 1
-                                       AND loc1.genome_build = '$build'
-                                       AND loc2.genome_build = '$build' """)
-    else:
-        command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
-                                   SELECT t.gene_ID,
-                                      t.transcript_ID,
-                                      loc1.chromosome,
-                                      loc1.position as start,
-                                      loc2.position as end,
-                                      genes.strand,
-                                      t.start_vertex,
-                                      t.end_vertex,
-                                      t.start_exon as exon_ID,
-                                      MIN(loc1.position, loc2.position) as min_pos,
-                                      MAX(loc1.position, loc2.position) as max_pos
-                                   FROM transcripts as t
-                                   LEFT JOIN location as loc1
-                                       ON loc1.location_ID = t.start_vertex
-                                   LEFT JOIN location as loc2
-                                       ON loc2.location_ID = t.end_vertex
-                                   LEFT JOIN genes
-                                       ON genes.gene_ID = t.gene_ID
-                                   WHERE n_exons = 1
-                                   AND loc1.genome_build = '$build'
-                                   AND loc2.genome_build = '$build'
-                                   AND loc1.chromosome = '$chrom'
-                                   AND ((min_pos <= $start AND max_pos >= $end)
-                                       OR (min_pos >= $start AND max_pos <= $end)
-                                       OR (min_pos >= $start AND min_pos <= $end)
-                                       OR (max_pos >= $start AND max_pos <= $end))""")
-
-    command = command.substitute({'build':build, 'chrom':chrom,
-                                  'start':start, 'end':end, 
-                                  'tmp_tab':tmp_tab})
+    command = Template(""" CREATE TEMPORARY TABLE IF NOT EXISTS $tmp_tab AS
+                               $query """)
+    command = command.substitute({'tmp_tab':tmp_tab,
+                                  'query': monoexon_interval_query(build, chrom,
+                                                start, end, extents =
+                                  extent_utils.has_extents(cursor, "transcript"))})
     cursor.execute(command)
 
     return tmp_tab
 
+def make_monoexon_index(cursor, build, chrom = None, start = None, end = None):
+    """ In-memory alternative to make_temp_monoexonic_transcript_table. 
+        Returns a dstruct.IntervalIndex of the same monoexonic transcript 
+        records (as dicts), indexed on min_pos and max_pos. Novel monoexonic
+        transcripts are added to it during the run.
+    """
+    cursor.execute(monoexon_interval_query(build, chrom, start, end,
+                       extents = extent_utils.has_extents(cursor, "transcript")))
+    return dstruct.IntervalIndex([ dict(x) for x in cursor.fetchall() ],
+                                 start_key = 'min_pos', end_key = 'max_pos')
+
+def monoexon_interval_query(build, chrom = None, start = None, end = None,
+                            extents = False):
+    """ Query that fetches the monoexonic transcripts of the build, along with
+        their location and strand. If chrom, start, and end are provided, only
+        transcripts overlapping that region are selected. If extents is True,
+        the candidate transcripts are found with the stored transcript
+        extents (see extent_utils) instead of scanning the transcripts table.
+    """
+    query = """ SELECT t.gene_ID,
+                   t.transcript_ID,
+                   loc1.chromosome,
+                   loc1.position as start,
+                   loc2.position as end,
+                   genes.strand,
+                   t.start_vertex,
+                   t.end_vertex,
+                   t.start_exon as exon_ID,
+                   MIN(loc1.position, loc2.position) as min_pos,
+                   MAX(loc1.position, loc2.position) as max_pos
+                FROM $transcripts as t
+                LEFT JOIN location as loc1
+                    ON loc1.location_ID = t.start_vertex
+                LEFT JOIN location as loc2
+                    ON loc2.location_ID = t.end_vertex
+                LEFT JOIN genes
+                    ON genes.gene_ID = t.gene_ID
+                WHERE n_exons = 1
+                AND loc1.genome_build = '$build'
+                AND loc2.genome_build = '$build'"""
+    if not any(val == None for val in [chrom, start, end]):
+        query += """
+                AND loc1.chromosome = '$chrom'
+                AND ((min_pos <= $start AND max_pos >= $end)
+                    OR (min_pos >= $start AND max_pos <= $end)
+                    OR (min_pos >= $start AND min_pos <= $end)
+                    OR (max_pos >= $start AND max_pos <= $end))"""
+    query += """
+                ORDER BY t.transcript_ID"""
+
+    return Template(query).substitute({'build':build, 'chrom':chrom,
+                                       'start':start, 'end':end,
+                                       'transcripts': transcript_source(build,
+                                                 chrom, start, end, extents)})
+
 def make_location_dict(genome_build, cursor, chrom = None, start = None, end = None):
     """ Format of dict:
-        chromosome -> dict(position -> SQLite3 row from location table)
+        chromosome -> dict(position -> dstruct.LocationRecord)
+        Each per-chromosome dict is a dstruct.PositionDict, which also keeps
+        its positions in sorted order for permissive vertex searches.
 
         old:
             Key: chromosome, pos
@@ -163,8 +210,7 @@ def make_location_dict(genome_build, cursor, chrom = None, start = None, end = N
                             AND position <= $end""")
     query = query.substitute({'build':genome_build, 'chrom':chrom,
                               'start':start, 'end':end})
-    cursor.execute(query)
-    for location in cursor.fetchall():
+    for location in fetch_records(cursor, query, dstruct.LocationRecord):
         chromosome = location["chromosome"]
         position = location["position"]
         try:
@@ -172,12 +218,16 @@ def make_location_dict(genome_build, cursor, chrom = None, start = None, end = N
         except:
             location_dict[chromosome] = {position: location}
 
+    # Sort the positions of each chromosome once all of them are in
+    for chromosome in location_dict:
+        location_dict[chromosome] = dstruct.PositionDict(location_dict[chromosome])
+
     return location_dict
 
 def make_edge_dict(cursor, build = None, chrom = None, start = None, end = None):
     """ Format of dict:
             Key: vertex1_vertex2_type
-            Value: SQLite3 row from edge table
+            Value: dstruct.EdgeRecord (row of the edge table)
     """
     edge_dict = {}
     if any(val == None for val in [chrom, start, end, build]):
@@ -194,8 +244,7 @@ def make_edge_dict(cursor, build = None, chrom = None, start = None, end = None)
                          """)
         query = query.substitute({'build':build, 'chrom':chrom,
                                   'start':start, 'end':end})
-    cursor.execute(query)
-    for edge in cursor.fetchall():
+    for edge in fetch_records(cursor, query, dstruct.EdgeRecord):
         vertex_1 = edge["v1"]
         vertex_2 = edge["v2"]
         edge_type = edge["edge_type"]
@@ -208,8 +257,10 @@ def make_transcript_dict(cursor, build, chrom = None, start = None, end = None):
     """ Format of dict:
             Key: tuple consisting of edges in transcript path
             Value: SQLite3 row from transcript table
+        The dict also maintains an edge -> transcript key index that is used
+        to find ISM/FSM candidates (see dstruct.TranscriptDict).
     """
-    transcript_dict = {}
+    transcript_dict = dstruct.TranscriptDict()
     if any(val == None for val in [chrom, start, end]):
          query = Template("""SELECT t.*,
                                 loc1.chromosome as chromosome,
@@ -228,7 +279,7 @@ def make_transcript_dict(cursor, build, chrom = None, start = None, end = None):
                                 loc2.position as end_pos,
                                 MIN(loc1.position, loc2.position) as min_pos,
                                 MAX(loc1.position, loc2.position) as max_pos
-                            FROM transcripts AS t
+                            FROM $transcripts AS t
                                 LEFT JOIN location as loc1 ON t.start_vertex = loc1.location_ID
                                 LEFT JOIN location as loc2 ON t.end_vertex = loc2.location_ID
                                 WHERE loc1.genome_build = '$build' AND loc2.genome_build = '$build'
@@ -236,10 +287,14 @@ def make_transcript_dict(cursor, build, chrom = None, start = None, end = None):
                                          AND ((min_pos <= $start AND max_pos >= $end)
                                            OR (min_pos >= $start AND max_pos <= $end)
                                            OR (min_pos >= $start AND min_pos <= $end)
-                                           OR (max_pos >= $start AND max_pos <= $end))""")
+                                           OR (max_pos >= $start AND max_pos <= $end))
+                            ORDER BY t.transcript_ID""")
 
+    extents = extent_utils.has_extents(cursor, "transcript")
     query = query.substitute({'build':build, 'chrom':chrom,
-                                  'start':start, 'end':end})
+                                  'start':start, 'end':end,
+                                  'transcripts': transcript_source(build, chrom,
+                                                     start, end, extents)})
     cursor.execute(query)
     for transcript in cursor.fetchall():
         transcript_path = transcript["jn_path"]
@@ -297,7 +352,9 @@ def make_gene_start_or_end_dict(cursor, build, mode, chrom = None, start = None,
         Format of dict:
             Key: gene ID from database
             Value: dict mapping positions to start vertices (or end vertices) of
-                   KNOWN transcripts from that gene
+                   KNOWN transcripts from that gene. Each is a
+                   dstruct.PositionDict, which also keeps the positions
+                   sorted for binary search.
     """
     if mode not in ["start", "end"]:
         raise ValueError(("Incorrect mode supplied to 'make_gene_start_or_end_dict'."
@@ -349,5 +406,211 @@ def make_gene_start_or_end_dict(cursor, build, mode, chrom = None, start = None,
             output_dict[gene_ID] = {}
             output_dict[gene_ID][pos] = vertex
 
+    for gene_ID in output_dict:
+        output_dict[gene_ID] = dstruct.PositionDict(output_dict[gene_ID])
     return output_dict
 
+
+def make_region_structures(cursor, build, chrom = None, start = None, end = None,
+                           tmp_id = "1"):
+    """ Single-pass alternative to calling make_location_dict, make_edge_dict,
+        make_transcript_dict, make_vertex_2_gene_dict, and
+        make_gene_start_or_end_dict separately. The location rows of the
+        region are read once into a temporary table, and the vertex and edge
+        rows are fetched by joining against it. Transcripts overlapping the
+        region are fetched once, along with their gene strand and known
+        status, and are used to build the transcript dict, the gene start and
+        end dicts, and the monoexonic transcript records (dicts in the format
+        of monoexon_interval_query).
+
+        Returns a dstruct.Struct with the fields location_dict, edge_dict,
+        transcript_dict, vertex_2_gene, gene_starts, gene_ends, monoexons,
+        and timings (structure name -> seconds taken to build it). Locations,
+        edges, and transcripts are stored as compact dstruct records rather
+        than sqlite3.Row objects.
+    """
+    timings = {}
+    region = dstruct.Struct()
+    region_tab = "region_loc_" + tmp_id
+    whole_build = any(val == None for val in [chrom, start, end])
+
+    # Locations
+    t0 = time.time()
+    query = """SELECT * FROM location WHERE genome_build = '$build' """
+    if not whole_build:
+        query += """
+                        AND chromosome = '$chrom'
+                        AND position >= $start
+                        AND position <= $end"""
+    query = Template(query).substitute({'build':build, 'chrom':chrom,
+                                        'start':start, 'end':end})
+    cursor.execute("DROP TABLE IF EXISTS temp.%s" % region_tab)
+    cursor.execute("CREATE TEMPORARY TABLE %s AS %s" % (region_tab, query))
+    location_dict = {}
+    for location in fetch_records(cursor, "SELECT * FROM %s" % region_tab,
+                                  dstruct.LocationRecord):
+        chromosome = location["chromosome"]
+        try:
+            location_dict[chromosome][location["position"]] = location
+        except KeyError:
+            location_dict[chromosome] = {location["position"]: location}
+    for chromosome in location_dict:
+        location_dict[chromosome] = dstruct.PositionDict(location_dict[chromosome])
+    region.location_dict = location_dict
+    timings["location_dict"] = time.time() - t0
+
+    # Vertices
+    t0 = time.time()
+    cursor.execute("""SELECT v.vertex_ID,
+                             v.gene_ID,
+                             genes.strand
+                      FROM %s AS r
+                      JOIN vertex AS v ON v.vertex_ID = r.location_ID
+                      LEFT JOIN genes ON v.gene_ID = genes.gene_ID""" % region_tab)
+    vertex_2_gene = {}
+    for vertex_line in cursor.fetchall():
+        vertex = vertex_line["vertex_ID"]
+        gene_info = (vertex_line["gene_ID"], vertex_line["strand"])
+        try:
+            vertex_2_gene[vertex].add(gene_info)
+        except KeyError:
+            vertex_2_gene[vertex] = set([gene_info])
+    region.vertex_2_gene = vertex_2_gene
+    timings["vertex_2_gene"] = time.time() - t0
+
+    # Edges
+    t0 = time.time()
+    edge_dict = {}
+    for edge in fetch_records(cursor, """SELECT e.*
+                                  FROM edge AS e
+                                  JOIN %s AS r1 ON e.v1 = r1.location_ID
+                                  JOIN %s AS r2 ON e.v2 = r2.location_ID""" % \
+                                  (region_tab, region_tab), dstruct.EdgeRecord):
+        edge_dict[(edge["v1"], edge["v2"], edge["edge_type"])] = edge
+    region.edge_dict = edge_dict
+    cursor.execute("DROP TABLE IF EXISTS temp.%s" % region_tab)
+    timings["edge_dict"] = time.time() - t0
+
+    # Transcripts
+    t0 = time.time()
+    query = region_transcript_query(build, chrom, start, end,
+                    extents = extent_utils.has_extents(cursor, "transcript"))
+    transcripts = fetch_records(cursor, query, dstruct.TranscriptRecord)
+
+    transcript_dict = dstruct.TranscriptDict()
+    for transcript in transcripts:
+        transcript_path = transcript["jn_path"]
+        if transcript_path != None:
+            transcript_path = transcript_path.split(",") + \
+                              [transcript["start_exon"], transcript["end_exon"]]
+            transcript_path = frozenset([ int(x) for x in transcript_path])
+        else:
+            transcript_path = frozenset([transcript["start_exon"]])
+        transcript_dict[transcript_path] = transcript
+    region.transcript_dict = transcript_dict
+    timings["transcript_dict"] = time.time() - t0
+
+    # Starts and ends of known transcripts that fall inside the region
+    for mode in ["start", "end"]:
+        t0 = time.time()
+        output_dict = {}
+        for transcript in transcripts:
+            pos = transcript[mode + "_pos"]
+            if not transcript["known"] or \
+               (not whole_build and (pos < start or pos > end)):
+                continue
+            gene_ID = transcript["gene_ID"]
+            try:
+                output_dict[gene_ID][pos] = transcript[mode + "_vertex"]
+            except KeyError:
+                output_dict[gene_ID] = {pos: transcript[mode + "_vertex"]}
+        for gene_ID in output_dict:
+            output_dict[gene_ID] = dstruct.PositionDict(output_dict[gene_ID])
+        region["gene_" + mode + "s"] = output_dict
+        timings["gene_" + mode + "s"] = time.time() - t0
+
+    # Monoexonic transcripts
+    t0 = time.time()
+    region.monoexons = [ {'gene_ID': t["gene_ID"],
+                          'transcript_ID': t["transcript_ID"],
+                          'chromosome': t["chrom"],
+                          'start': t["start_pos"],
+                          'end': t["end_pos"],
+                          'strand': t["strand"],
+                          'start_vertex': t["start_vertex"],
+                          'end_vertex': t["end_vertex"],
+                          'exon_ID': t["start_exon"],
+                          'min_pos': t["min_pos"],
+                          'max_pos': t["max_pos"]}
+                         for t in transcripts if t["n_exons"] == 1 ]
+    timings["monoexons"] = time.time() - t0
+
+    region.timings = timings
+    return region
+
+def region_transcript_query(build, chrom = None, start = None, end = None,
+                            extents = False):
+    """ Query that fetches the transcripts of the build along with their
+        location, gene strand, and whether they are known. If chrom, start, 
+        and end are provided, only transcripts overlapping that region are
+        selected. If extents is True, the candidate transcripts are found with
+        the stored transcript extents (see extent_utils).
+    """
+    query = """SELECT t.*,
+                      loc1.chromosome as chrom,
+                      loc1.position as start_pos,
+                      loc2.position as end_pos,
+                      MIN(loc1.position, loc2.position) as min_pos,
+                      MAX(loc1.position, loc2.position) as max_pos,
+                      genes.strand as strand,
+                      EXISTS (SELECT 1 FROM transcript_annotations as ta
+                              WHERE ta.ID = t.transcript_ID
+                                  AND ta.attribute = 'transcript_status'
+                                  AND ta.value = 'KNOWN') as known
+               FROM $transcripts AS t
+                   LEFT JOIN location as loc1 ON t.start_vertex = loc1.location_ID
+                   LEFT JOIN location as loc2 ON t.end_vertex = loc2.location_ID
+                   LEFT JOIN genes ON genes.gene_ID = t.gene_ID
+               WHERE loc1.genome_build = '$build' AND loc2.genome_build = '$build'"""
+    if not any(val == None for val in [chrom, start, end]):
+        query += """
+                   AND chrom == '$chrom'
+                   AND ((min_pos <= $start AND max_pos >= $end)
+                     OR (min_pos >= $start AND max_pos <= $end)
+                     OR (min_pos >= $start AND min_pos <= $end)
+                     OR (max_pos >= $start AND max_pos <= $end))"""
+    query += """
+               ORDER BY t.transcript_ID"""
+
+    return Template(query).substitute({'build':build, 'chrom':chrom,
+                                       'start':start, 'end':end,
+                                       'transcripts': transcript_source(build,
+                                                 chrom, start, end, extents)})
+
+def transcript_source(build, chrom, start, end, extents):
+    """ Table (or subquery) that regional transcript queries select from. With
+        extents, this is the subset of transcripts whose stored extent
+        overlaps the region, found with the R*Tree, rather than the whole
+        transcripts table. The region filters of the calling query still
+        apply, so the results are the same either way.
+    """
+    if extents and not any(val == None for val in [chrom, start, end]):
+        return extent_utils.transcripts_in_region(build, chrom, start, end)
+    return "transcripts"
+
+def fetch_records(cursor, query, record_type):
+    """ Runs the query and returns the rows as instances of record_type (a
+        dstruct.Record subclass). The columns of the query must match the
+        fields of the record type. A separate cursor is used so that no
+        sqlite3.Row objects are created along the way.
+    """
+    record_cursor = cursor.connection.cursor()
+    record_cursor.row_factory = lambda cur, row: record_type.from_row(row)
+    record_cursor.execute(query)
+    columns = tuple([ x[0] for x in record_cursor.description ])
+    if columns != record_type.fields:
+        raise ValueError("Query columns %s do not match the fields of %s" % \
+                         (columns, record_type.__name__))
+    records = record_cursor.fetchall()
+    record_cursor.close()
+    return records
@@ -12,6 +12,7 @@ from optparse import OptionParser
 from . import gene as Gene
 from . import transcript as Transcript
 from . import edge as Edge
+from . import extent_utils
 import os
 import time
 
@@ -464,6 +465,71 @@ def add_location_table(database):
     conn.close()
     return
 
+def add_extents(database):
+    """ Adds the tables that store the genomic extent of each gene and
+        transcript, along with an R*Tree for range queries over each (see
+        extent_utils), and fills them with the extents of all genes and
+        transcripts in the database.
+    """
+
+    # Connecting to the database file
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+
+    extent_utils.create_extent_tables(c)
+    extent_utils.update_gene_extents(c)
+    extent_utils.update_transcript_extents(c)
+
+    conn.commit()
+    conn.close()
+    return
+
+# Secondary indexes on the columns that the queries in init_refs, query_utils,
+# and post/ filter and join on. The primary keys already cover lookups by ID
+# (including vertex_ID and the annotation ID). Each entry is
+# (index name, table, columns).
+INDEXES = [("location_build_chrom_pos_idx", "location",
+                ["genome_build", "chromosome", "position"]),
+           ("edge_v1_v2_idx", "edge", ["v1", "v2"]),
+           ("vertex_gene_idx", "vertex", ["gene_ID"]),
+           ("transcripts_start_vertex_idx", "transcripts", ["start_vertex"]),
+           ("transcripts_end_vertex_idx", "transcripts", ["end_vertex"]),
+           ("observed_dataset_idx", "observed", ["dataset"]),
+           ("abundance_dataset_idx", "abundance", ["dataset"]),
+           ("gene_annotations_attr_value_idx", "gene_annotations",
+                ["attribute", "value"]),
+           ("transcript_annotations_attr_value_idx", "transcript_annotations",
+                ["attribute", "value"]),
+           ("exon_annotations_attr_value_idx", "exon_annotations",
+                ["attribute", "value"])]
+
+def add_indexes(database):
+    """ Creates any of the secondary indexes in INDEXES that the database does
+        not have yet, then runs ANALYZE so that the query planner has
+        statistics to choose between them. Returns the names of the indexes
+        that were added.
+    """
+
+    # Connecting to the database file
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = set([ x[0] for x in c.fetchall() ])
+
+    added = []
+    for name, table, columns in INDEXES:
+        if name in existing:
+            continue
+        c.execute("CREATE INDEX %s ON %s (%s)" % (name, table,
+                                                  ", ".join(columns)))
+        added.append(name)
+
+    c.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return added
+
 
 ####################### GTF parsing section #################################
 
@@ -1014,6 +1080,11 @@ def main():
     # Populate the database tables
     populate_db(db_name, annot_name, chrom_genes, chrom_transcripts, exons, genome_build)
 
+    # Store the gene and transcript extents and index the populated tables. Doing this after the bulk insert is faster
+    # than maintaining the indexes row by row.
+    add_extents(db_name)
+    add_indexes(db_name)
+
 
 if __name__ == '__main__':
     main()
@@ -4,10 +4,12 @@
 # Functions related to processing the input SAM files and partitioning them
 # for processing in parallel
 
-import pybedtools
 import pysam
 import os
 import time
+import heapq
+from bisect import bisect_right
+from contextlib import ExitStack
 
 def convert_to_bam(sam, bam):
     """ Convert provided sam file to bam file (provided name).  """
@@ -23,9 +25,57 @@ def convert_to_bam(sam, bam):
         raise RuntimeError("Problem converting sam file '%s' to bam." % (sam))
              
 
+def index_files(fname):
+    """ Return the index files next to the provided BAM/CRAM file (e.g. 
+        reads.bam.bai or reads.bai) that exist. """
+    base = os.path.splitext(fname)[0]
+    candidates = [ prefix + ext for prefix in [fname, base]
+                   for ext in [".bai", ".csi", ".crai"] ]
+    return [ x for x in candidates if os.path.exists(x) ]
+
+def is_sorted_and_indexed(fname):
+    """ Check whether the provided BAM/CRAM file is sorted by coordinate
+        (according to the SO field of its header) and has an index. An index
+        that is older than the file is treated as missing, since the file may
+        have been replaced after it was indexed. """
+    if fname.endswith(".sam"):
+        return False
+    try:
+        with pysam.AlignmentFile(fname) as f:
+            sort_order = f.header.to_dict().get("HD", {}).get("SO")
+            if sort_order != "coordinate" or not f.has_index():
+                return False
+    except (ValueError, OSError):
+        return False
+
+    mtime = os.path.getmtime(fname)
+    return all([ os.path.getmtime(x) >= mtime for x in index_files(fname) ])
+
+def has_cram_reference(fname):
+    """ Check whether htslib will be able to find the reference sequence
+        needed to decode the provided CRAM file (including the MD tags): 
+        either through the REF_PATH or REF_CACHE environment variables, or 
+        through the UR fields of the @SQ header lines. Local UR paths have to
+        exist. """
+    if os.environ.get("REF_PATH") or os.environ.get("REF_CACHE"):
+        return True
+    with pysam.AlignmentFile(fname) as f:
+        sequences = f.header.to_dict().get("SQ", [])
+    for sequence in sequences:
+        ref = sequence.get("UR")
+        if ref == None:
+            return False
+        if ref.startswith("file:"):
+            ref = ref[len("file:"):]
+        elif "://" in ref:
+            continue
+        if not os.path.exists(ref):
+            return False
+    return len(sequences) > 0
+
 def preprocess_sam(sam_files, datasets, tmp_dir = "talon_tmp/", n_threads = 0):
     """ Copy and rename the provided SAM/BAM file(s), merge them, and index.
-        This is necessary in order to use Pybedtools commands on the reads.
+        This is necessary in order to fetch the reads by region.
         The renaming is necessary in order to label the reads according to
         their dataset."""
 
@@ -60,67 +110,174 @@ def preprocess_sam(sam_files, datasets, tmp_dir = "talon_tmp/", n_threads = 0):
                             "files have headers."))
     return merged_bam
 
-def partition_reads(sam_files, datasets, tmp_dir = "talon_tmp/", n_threads = 0):
-    """ Use bedtools merge to create non-overlapping intervals from all of the
-        transcripts in a series of SAM/BAM files. Then, iterate over the intervals
-        to extract all reads inside of them from the pysam object.
-       
+def get_read_intervals(read_files, by_locus = False, min_gap = 0,
+                       gene_spans = None, reads_per_interval = None,
+                       n_intervals = None):
+    """ Create non-overlapping intervals from all of the transcripts in the 
+        provided sorted and indexed BAM file(s) (see merge_read_spans).
+
+        By default, there is one interval per chromosome. If by_locus is set,
+        the reads are instead merged into clusters that are more than min_gap
+        bp apart, and neighbouring clusters are packed together into intervals
+        of about reads_per_interval reads (or total reads / n_intervals).
+        Clusters that are spanned by the same gene in gene_spans are never
+        split up (see pack_clusters).
+
         Returns:
-            - List of lists: sublists contain pysam reads from a given interval
-            - List of tuple intervals
-            - filename of merged bam file (to keep track of the header)
-           """
+            - List of (chrom, start, end) intervals (1-based, inclusive)
+            - List with the number of reads in each interval
+    """
+    if by_locus:
+        clusters = merge_read_spans(read_files, min_gap)
+        if n_intervals != None:
+            total_reads = sum([ x[3] for x in clusters ])
+            reads_per_interval = -(-total_reads // max(n_intervals, 1))
+        elif reads_per_interval == None:
+            reads_per_interval = 1
+        merged = pack_clusters(clusters, gene_spans, reads_per_interval)
+    else:
+        merged = merge_read_spans(read_files, 100000000)
 
-    merged_bam = preprocess_sam(sam_files, datasets, tmp_dir = tmp_dir, 
-                                n_threads = n_threads)
+    intervals = [ (x[0], x[1] + 1, x[2]) for x in merged ]
+    n_reads = [ x[3] for x in merged ]
+    return intervals, n_reads
 
-    try:
-        all_reads = pybedtools.BedTool(merged_bam).bam_to_bed()
-    except Exception as e:
-        print(e)
-        raise RuntimeError("Problem opening sam file %s" % (merged_bam))
-
-    # Must sort the Bedtool object
-    sorted_reads = all_reads.sort()
-    intervals = sorted_reads.merge(d = 100000000)
-
-    # Now open each sam file using pysam and extract the reads
-    coords = []
-    read_groups = []
-    with pysam.AlignmentFile(merged_bam) as bam:  # type: pysam.AlignmentFile
-        for interval in intervals:
-            reads = get_reads_in_interval(bam, interval.chrom,
-                                          interval.start, interval.end)
-            read_groups.append(reads)
-            coords.append((interval.chrom, interval.start + 1, interval.end))
-
-    return read_groups, coords, merged_bam
-
-def write_reads_to_file(read_groups, intervals, header_template, tmp_dir = "talon_tmp/"):
-    """ For each read group, iterate over the reads and write them to a file
-        named for the interval they belong to. This step is necessary because
-        Pysam objects cannot be pickled. """
- 
-    tmp_dir = tmp_dir + "interval_files/"
-    os.system("mkdir -p %s " % (tmp_dir))
- 
-    outbam_names = []
-    with pysam.AlignmentFile(header_template, "rb") as template:
-        for group, interval in zip(read_groups, intervals):
-            fname = tmp_dir + "_".join([str(x) for x in interval]) + ".bam"
-            outbam_names.append(fname)
-            with pysam.AlignmentFile(fname, "wb", template = template) as f:
-                for read in group:
-                    f.write(read)
-        
-    return outbam_names
-
-
-def get_reads_in_interval(sam, chrom, start, end):
-    """ Given an open pysam.AlignmentFile, return only the reads that overlap
-        the provided interval. Note that this means there may be reads that
-        extend beyond the bounds of the interval. """
-    iterator = sam.fetch(chrom, start, end)
-    reads = [ x for x in iterator ]
-    return reads
+def merge_read_spans(read_files, merge_dist):
+    """ Make one pass over the mapped reads of each chromosome in the provided
+        sorted and indexed BAM file(s), and merge the reference spans of reads 
+        that overlap or are no more than merge_dist bp apart (the same rule as
+        bedtools merge -d). Chromosomes are visited in sorted order, and the
+        index statistics are used to skip those without any mapped reads.
+
+        Returns:
+            List of (chrom, start, end, n_reads) tuples in BED-style 
+            coordinates.
+    """
+    with ExitStack() as stack:
+        sams = []
+        chroms = set()
+        for read_file in read_files:
+            try:
+                sam = stack.enter_context(pysam.AlignmentFile(read_file))
+                stats = sam.get_index_statistics()
+            except Exception as e:
+                print(e)
+                raise RuntimeError("Problem opening sam file %s" % (read_file))
+            sams.append(sam)
+            chroms.update([ x.contig for x in stats if x.mapped > 0 ])
+
+        def read_spans(sam, chrom):
+            if chrom not in sam.references:
+                return
+            for read in sam.fetch(chrom):
+                if not read.is_unmapped and read.reference_end != None:
+                    yield read.reference_start, read.reference_end
+
+        merged = []
+        for chrom in sorted(chroms):
+            current = None
+            spans = heapq.merge(*[ read_spans(sam, chrom) for sam in sams ])
+            for start, end in spans:
+                if current != None and start <= current[2] + merge_dist:
+                    current[2] = max(current[2], end)
+                    current[3] += 1
+                else:
+                    if current != None:
+                        merged.append(tuple(current))
+                    current = [chrom, start, end, 1]
+            if current != None:
+                merged.append(tuple(current))
+
+    return merged
+
+def pack_clusters(clusters, gene_spans, reads_per_interval):
+    """ Combine neighbouring read clusters on the same chromosome into 
+        intervals of at least reads_per_interval reads (except for the last 
+        one on each chromosome). An interval is never closed between two
+        clusters that overlap the same gene.
+
+        Args:
+            clusters: Sorted list of (chrom, start, end, n_reads) tuples with
+                BED-style coordinates.
+            gene_spans: Dict mapping each chromosome to a list of 
+                (start, end) gene spans (1-based, inclusive). May be None.
+            reads_per_interval: Target number of reads in each interval.
+
+        Returns:
+            List of (chrom, start, end, n_reads) intervals in BED-style 
+            coordinates.
+    """
+    if gene_spans == None:
+        gene_spans = {}
+
+    # For each chromosome, sort the genes by start and keep a running max of
+    # their ends, so that we can tell whether any gene crosses a gap.
+    gene_starts = {}
+    gene_max_ends = {}
+    for chrom, spans in gene_spans.items():
+        spans = sorted(spans)
+        gene_starts[chrom] = [ x[0] for x in spans ]
+        max_ends = []
+        max_end = 0
+        for span in spans:
+            max_end = max(max_end, span[1])
+            max_ends.append(max_end)
+        gene_max_ends[chrom] = max_ends
+
+    def gene_crosses_gap(chrom, left_end, right_start):
+        """ Check whether a gene covers both the last base on the left 
+            (left_end) and the first base on the right (right_start + 1). """
+        if chrom not in gene_starts:
+            return False
+        i = bisect_right(gene_starts[chrom], left_end)
+        return i > 0 and gene_max_ends[chrom][i - 1] >= right_start + 1
+
+    intervals = []
+    current = None
+    for chrom, start, end, n_reads in clusters:
+        if current != None and current[0] == chrom and \
+           (current[3] < reads_per_interval or \
+            gene_crosses_gap(chrom, current[2], start)):
+            current[2] = max(current[2], end)
+            current[3] += n_reads
+        else:
+            if current != None:
+                intervals.append(tuple(current))
+            current = [chrom, start, end, n_reads]
+    if current != None:
+        intervals.append(tuple(current))
+
+    return intervals
+
+def fetch_interval_reads(sam, interval):
+    """ Given an open, indexed pysam.AlignmentFile and a (chrom, start, end) 
+        interval (1-based, inclusive), iterate over the reads that start inside
+        the interval. Reads that start further left belong to an earlier 
+        interval, so they are skipped to make sure that each read is only 
+        processed once. """
+    chrom, start, end = interval
+    for read in sam.fetch(chrom, start - 1, end):
+        if read.reference_start >= start - 1:
+            yield read
+
+def fetch_merged_interval_reads(read_files, interval):
+    """ Given a list of (file, dataset) pairs, where each file is a sorted and
+        indexed BAM/CRAM, iterate over the reads that start inside the 
+        interval across all of the files, in coordinate order. This is a 
+        streaming equivalent of merging the files with samtools merge -r: 
+        each read gets an RG tag with the name of its dataset. """
+    def tag_reads(sam, dataset):
+        for read in fetch_interval_reads(sam, interval):
+            read.set_tag("RG", dataset, value_type = "Z")
+            yield read
+
+    with ExitStack() as stack:
+        streams = []
+        for read_file, dataset in read_files:
+            sam = stack.enter_context(pysam.AlignmentFile(read_file))
+            streams.append(tag_reads(sam, dataset))
 
+        # Ties go to reads on the forward strand, then to earlier files
+        for read in heapq.merge(*streams, key = lambda x: (x.reference_start,
+                                                            x.is_reverse)):
+            yield read
@@ -0,0 +1,155 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Stage timers for talon --profile. Each process has at most one active
+# Profiler, which keeps the cumulative time and number of calls of every named
+# stage. The annotation code wraps its stages in
+#     with profiling.stage("name"):
+# which only costs a function call when profiling is off. Stages may be
+# nested, and the time of a stage includes the time of the stages inside it.
+# Each worker writes a report for its interval, and the main process merges
+# them into one summary for the run.
+# ---------------------------------------------------------------------
+# enable
+# disable
+# stage
+# report_path
+# make_report
+# write_report
+# merge_reports
+# print_summary
+
+import json
+import os
+import time
+
+class Profiler(object):
+    """ Cumulative seconds and number of calls for each stage """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds):
+        try:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+        except KeyError:
+            self.seconds[name] = seconds
+            self.calls[name] = 1
+
+class Stage(object):
+    """ Context manager that adds the time spent inside it to a stage """
+    __slots__ = ("profiler", "name", "t0")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.t0)
+        return False
+
+class NoStage(object):
+    """ Stands in for Stage when profiling is off """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_STAGE = NoStage()
+
+# Active profiler of this process, or None if profiling is off
+profiler = None
+
+def enable():
+    """ Starts a new profiler for this process, replacing any previous one """
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+def disable():
+    global profiler
+    profiler = None
+
+def stage(name):
+    """ Returns a context manager that times the named stage """
+    if profiler is None:
+        return NO_STAGE
+    return Stage(profiler, name)
+
+def report_path(tmp_dir, interval_id):
+    """ Where the worker writes the report for an interval """
+    return os.path.join(tmp_dir, "profile", interval_id + ".json")
+
+def make_report(**info):
+    """ Summarizes the active profiler as a dict. The provided info is
+        included as is. If it has a 'reads' entry, the throughput is computed
+        from it and the time since the profiler was started. """
+    report = dict(info)
+    report["seconds"] = time.perf_counter() - profiler.start
+    if "reads" in report:
+        report["reads_per_sec"] = report["reads"]/report["seconds"] \
+                                  if report["seconds"] > 0 else None
+    report["stages"] = { name: {"seconds": profiler.seconds[name],
+                                "calls": profiler.calls[name]}
+                         for name in profiler.seconds }
+    return report
+
+def write_report(fpath, **info):
+    """ Writes the report of the active profiler to a JSON file """
+    os.makedirs(os.path.dirname(fpath), exist_ok = True)
+    with open(fpath, 'w') as f:
+        json.dump(make_report(**info), f, indent = 2)
+
+def merge_reports(interval_files, driver_report = None):
+    """ Combines the interval reports (in the order given) into a summary of
+        the run. The stage times and read numbers of the intervals are added
+        up under 'annotation'. Its throughput is the number of reads over the
+        summed interval times, i.e. per worker. Missing files are skipped. """
+    intervals = []
+    for fpath in interval_files:
+        if os.path.exists(fpath):
+            with open(fpath, 'r') as f:
+                intervals.append(json.load(f))
+
+    stages = {}
+    for report in intervals:
+        for name, entry in report["stages"].items():
+            total = stages.setdefault(name, {"seconds": 0, "calls": 0})
+            total["seconds"] += entry["seconds"]
+            total["calls"] += entry["calls"]
+
+    n_reads = sum([ x.get("reads", 0) for x in intervals ])
+    n_annotated = sum([ x.get("annotated", 0) for x in intervals ])
+    seconds = sum([ x["seconds"] for x in intervals ])
+    annotation = {"intervals": len(intervals),
+                  "reads": n_reads,
+                  "annotated": n_annotated,
+                  "seconds": seconds,
+                  "reads_per_sec": n_reads/seconds if seconds > 0 else None,
+                  "stages": stages}
+
+    return {"driver": driver_report, "annotation": annotation,
+            "intervals": intervals}
+
+def print_summary(summary, n_stages = 12):
+    """ Prints the slowest stages of the annotation and of the driver """
+    for part in ["annotation", "driver"]:
+        report = summary[part]
+        if report is None:
+            continue
+        print("%s: %.2f s" % (part, report["seconds"]) + \
+              (", %.1f reads/s" % report["reads_per_sec"]
+               if report.get("reads_per_sec") else ""))
+        stages = sorted(report["stages"].items(),
+                        key = lambda x: x[1]["seconds"], reverse = True)
+        for name, entry in stages[:n_stages]:
+            print("    %-22s %10.3f s %10d calls" % \
+                  (name, entry["seconds"], entry["calls"]))
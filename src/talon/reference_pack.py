@@ -0,0 +1,442 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Compiles the reference structures of a genome build (locations, vertices,
+# edges, transcripts, and gene spans) into a directory of per-chromosome
+# NumPy arrays. TALON workers memory-map these arrays to build the structures
+# for their region instead of querying the database, as long as the pack is
+# still current (i.e. the database counters have not changed since the pack
+# was made).
+# ---------------------------------------------------------------------
+# default_path
+# compile_reference_arrays
+# write_reference_pack
+# read_pack_meta
+# is_current
+# load_chrom_arrays
+# load_reference_arrays
+# load_region_structures
+# region_structures_from_arrays
+# region_monoexons
+# region_genes
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+from . import dstruct
+from . import init_refs
+
+FORMAT_VERSION = 1
+
+def get_args():
+    """ Fetches the arguments for the program """
+
+    program_desc = """Compiles the reference structures of a genome build in a
+                      TALON database into a reference pack that the talon
+                      command loads in place of querying the database."""
+    parser = argparse.ArgumentParser(description=program_desc)
+    parser.add_argument('--db', dest = 'database', metavar='FILE,', type = str,
+        help='TALON database. Created using talon_initialize_database')
+    parser.add_argument('--build', dest = 'build', metavar='STRING,', type = str,
+        help='Genome build (i.e. hg38) to use. Must be in the database.')
+    parser.add_argument("--o", dest = "outdir", type = str, default = None,
+        help = "Output directory for the pack. Default: <database>.<build>.refpack, " + \
+               "which the talon command picks up automatically.")
+
+    return parser.parse_args()
+
+def default_path(database, build):
+    """ Location where talon looks for the reference pack of a build if none
+        is provided """
+    return "%s.%s.refpack" % (database, build)
+
+def get_db_counters(cursor):
+    """ Returns the counters table of the database as a dict """
+    cursor.execute("SELECT category, count FROM counters")
+    return { category: count for category, count in cursor.fetchall() }
+
+def save_arrays(outdir, arrays):
+    """ Save each array in the dict to <outdir>/<name>.npy """
+    os.makedirs(outdir, exist_ok = True)
+    for name, values in arrays.items():
+        np.save(os.path.join(outdir, name + ".npy"), values)
+
+def load_chrom_arrays(pack_dir, chrom_dir):
+    """ Memory-map the arrays of one chromosome of the pack. Returns a dict
+        mapping array names to arrays. """
+    chrom_path = os.path.join(pack_dir, chrom_dir)
+    return { fname[:-len(".npy")]: np.load(os.path.join(chrom_path, fname),
+                                           mmap_mode = "r")
+             for fname in os.listdir(chrom_path) if fname.endswith(".npy") }
+
+def load_reference_arrays(pack_dir):
+    """ Memory-map the arrays of every chromosome in the pack. Returns a
+        dict mapping each chromosome to its arrays. """
+    meta = read_pack_meta(pack_dir)
+    return { chrom: load_chrom_arrays(pack_dir, chrom_dir)
+             for chrom, chrom_dir in meta["chromosomes"].items() }
+
+def to_str_array(values):
+    """ Store strings (or None) as a fixed-width unicode array. None is
+        stored as an empty string. """
+    return np.array([ "" if x == None else x for x in values ] or [""],
+                    dtype = str)[:len(values)]
+
+def to_str(value):
+    return None if value == "" else value
+
+def compile_reference_arrays(database, build):
+    """ Read the reference structures of the build from the database into
+        NumPy arrays. Returns the database counters, and a dict mapping each
+        chromosome to its arrays (by name). """
+
+    with sqlite3.connect(database) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        counters = get_db_counters(cursor)
+        chroms = {}
+        def columns(chrom, prefix, names):
+            if chrom not in chroms:
+                chroms[chrom] = {}
+            if prefix not in chroms[chrom]:
+                chroms[chrom][prefix] = { name: [] for name in names }
+            return chroms[chrom][prefix]
+
+        # Locations, sorted on position
+        cursor.execute("""SELECT location_ID, chromosome, position
+                          FROM location WHERE genome_build = ?
+                          ORDER BY chromosome, position""", [build])
+        for row in cursor.fetchall():
+            cols = columns(row["chromosome"], "loc", ["ID", "pos"])
+            cols["ID"].append(row["location_ID"])
+            cols["pos"].append(row["position"])
+
+        # Vertex to gene assignments, sorted on position
+        cursor.execute("""SELECT v.vertex_ID, v.gene_ID, genes.strand,
+                                 loc.chromosome, loc.position
+                          FROM location AS loc
+                          JOIN vertex AS v ON v.vertex_ID = loc.location_ID
+                          LEFT JOIN genes ON v.gene_ID = genes.gene_ID
+                          WHERE loc.genome_build = ?
+                          ORDER BY loc.chromosome, loc.position""", [build])
+        for row in cursor.fetchall():
+            cols = columns(row["chromosome"], "vtx",
+                           ["ID", "gene", "strand", "pos"])
+            cols["ID"].append(row["vertex_ID"])
+            cols["gene"].append(row["gene_ID"])
+            cols["strand"].append(row["strand"])
+            cols["pos"].append(row["position"])
+
+        # Edges, sorted on the position of the first vertex
+        cursor.execute("""SELECT e.*,
+                                 loc1.chromosome,
+                                 loc1.position as pos1,
+                                 loc2.position as pos2
+                          FROM edge AS e
+                          JOIN location AS loc1 ON e.v1 = loc1.location_ID
+                          JOIN location AS loc2 ON e.v2 = loc2.location_ID
+                          WHERE loc1.genome_build = ?
+                              AND loc2.genome_build = ?
+                              AND loc1.chromosome = loc2.chromosome
+                          ORDER BY loc1.chromosome, loc1.position""",
+                       [build, build])
+        for row in cursor.fetchall():
+            cols = columns(row["chromosome"], "edge",
+                           ["ID", "v1", "v2", "type", "strand", "pos1", "pos2"])
+            cols["ID"].append(row["edge_ID"])
+            cols["v1"].append(row["v1"])
+            cols["v2"].append(row["v2"])
+            cols["type"].append(row["edge_type"])
+            cols["strand"].append(row["strand"])
+            cols["pos1"].append(row["pos1"])
+            cols["pos2"].append(row["pos2"])
+
+        # Transcripts, in database order. Junction paths are stored as one
+        # concatenated byte string with offsets.
+        cursor.execute(init_refs.region_transcript_query(build))
+        tx_fields = ["ID", "gene", "start_exon", "end_exon", "start_vertex",
+                     "end_vertex", "n_exons", "start_pos", "end_pos",
+                     "min_pos", "max_pos", "strand", "known", "jn", "jn_null"]
+        for row in cursor.fetchall():
+            cols = columns(row["chrom"], "tx", tx_fields)
+            for name, key in [("ID", "transcript_ID"), ("gene", "gene_ID"),
+                              ("start_exon", "start_exon"),
+                              ("end_exon", "end_exon"),
+                              ("start_vertex", "start_vertex"),
+                              ("end_vertex", "end_vertex"),
+                              ("n_exons", "n_exons"),
+                              ("start_pos", "start_pos"),
+                              ("end_pos", "end_pos"), ("min_pos", "min_pos"),
+                              ("max_pos", "max_pos"), ("strand", "strand"),
+                              ("known", "known")]:
+                cols[name].append(row[key])
+            cols["jn"].append((row["jn_path"] or "").encode())
+            cols["jn_null"].append(row["jn_path"] == None)
+
+        # Gene spans
+        cursor.execute(init_refs.region_gene_query(cursor, build))
+        for row in cursor.fetchall():
+            cols = columns(row["chromosome"], "gene",
+                           ["ID", "start", "end", "strand"])
+            cols["ID"].append(row["gene_ID"])
+            cols["start"].append(row["start"])
+            cols["end"].append(row["end"])
+            cols["strand"].append(row["strand"])
+
+    chrom_arrays = {}
+    for chrom in sorted(chroms):
+        arrays = {}
+        for prefix, names in [("loc", ["ID", "pos"]),
+                              ("vtx", ["ID", "gene", "strand", "pos"]),
+                              ("edge", ["ID", "v1", "v2", "type", "strand",
+                                        "pos1", "pos2"]),
+                              ("tx", tx_fields),
+                              ("gene", ["ID", "start", "end", "strand"])]:
+            cols = chroms[chrom].get(prefix, { name: [] for name in names })
+            for name in names:
+                values = cols[name]
+                if name in ["strand", "type"]:
+                    arrays[prefix + "_" + name] = to_str_array(values)
+                elif name == "jn":
+                    arrays["tx_jn"] = np.frombuffer(b"".join(values),
+                                                    dtype = np.uint8)
+                    arrays["tx_jn_offsets"] = np.cumsum([0] + \
+                                  [ len(x) for x in values ], dtype = np.int64)
+                elif name in ["jn_null", "known"]:
+                    arrays[prefix + "_" + name] = np.array(values, dtype = bool)
+                else:
+                    arrays[prefix + "_" + name] = np.array(values,
+                                                           dtype = np.int64)
+        chrom_arrays[chrom] = arrays
+
+    return counters, chrom_arrays
+
+def write_reference_pack(database, build, outdir):
+    """ Compile the reference structures of the build into outdir. Arrays
+        are written to one subdirectory per chromosome, and the build, the
+        database counters, and the chromosome directory names are recorded
+        in meta.json. """
+
+    counters, chrom_arrays = compile_reference_arrays(database, build)
+    os.makedirs(outdir, exist_ok = True)
+    chrom_dirs = {}
+    for i, chrom in enumerate(sorted(chrom_arrays)):
+        chrom_dirs[chrom] = str(i)
+        save_arrays(os.path.join(outdir, chrom_dirs[chrom]), chrom_arrays[chrom])
+
+    meta = {"format_version": FORMAT_VERSION, "build": build,
+            "counters": counters, "chromosomes": chrom_dirs}
+    with open(os.path.join(outdir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent = 2)
+
+    return meta
+
+def read_pack_meta(pack_dir):
+    """ Returns the contents of the pack's meta.json, or None if there is
+        no pack in the directory """
+    try:
+        with open(os.path.join(pack_dir, "meta.json"), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def is_current(pack_dir, database, build):
+    """ A pack can be used in place of the database if it was made for the
+        build with the current format, and none of the database counters
+        have changed since. """
+    meta = read_pack_meta(pack_dir)
+    if meta == None or meta.get("format_version") != FORMAT_VERSION or \
+       meta.get("build") != build:
+        return False
+
+    with sqlite3.connect(database) as conn:
+        counters = get_db_counters(conn.cursor())
+    return counters == meta["counters"]
+
+def load_region_structures(pack_dir, build, chrom, start, end):
+    """ Pack-based equivalent of init_refs.make_region_structures. Returns a
+        dstruct.Struct with the same fields (with dstruct record types in
+        place of database rows), plus the gene records overlapping the
+        region under 'genes'. """
+
+    chrom_dir = read_pack_meta(pack_dir)["chromosomes"].get(chrom)
+    arrays = None
+    if chrom_dir != None:
+        arrays = load_chrom_arrays(pack_dir, chrom_dir)
+    return region_structures_from_arrays(arrays, build, chrom, start, end)
+
+def region_structures_from_arrays(arrays, build, chrom, start, end):
+    """ Builds the structures of load_region_structures from the arrays of
+        the chromosome (None if the chromosome has none). """
+    timings = {}
+    region = dstruct.Struct()
+
+    if arrays == None:
+        for name in ["location_dict", "edge_dict", "vertex_2_gene",
+                     "gene_starts", "gene_ends"]:
+            region[name] = {}
+            timings[name] = 0.0
+        region.transcript_dict = dstruct.TranscriptDict()
+        region.monoexons = []
+        region.genes = []
+        timings["transcript_dict"] = timings["monoexons"] = 0.0
+        region.timings = timings
+        return region
+
+    # Locations
+    t0 = time.time()
+    positions = arrays["loc_pos"]
+    i = np.searchsorted(positions, start, side = "left")
+    j = np.searchsorted(positions, end, side = "right")
+    region.location_dict = {}
+    if j > i:
+        region.location_dict[chrom] = dstruct.PositionDict(
+             { pos: dstruct.LocationRecord((loc_ID, build, chrom, pos))
+               for loc_ID, pos in zip(arrays["loc_ID"][i:j].tolist(),
+                                      positions[i:j].tolist()) })
+    timings["location_dict"] = time.time() - t0
+
+    # Vertices
+    t0 = time.time()
+    positions = arrays["vtx_pos"]
+    i = np.searchsorted(positions, start, side = "left")
+    j = np.searchsorted(positions, end, side = "right")
+    vertex_2_gene = {}
+    for vertex, gene, strand in zip(arrays["vtx_ID"][i:j].tolist(),
+                                    arrays["vtx_gene"][i:j].tolist(),
+                                    arrays["vtx_strand"][i:j].tolist()):
+        try:
+            vertex_2_gene[vertex].add((gene, to_str(strand)))
+        except KeyError:
+            vertex_2_gene[vertex] = set([(gene, to_str(strand))])
+    region.vertex_2_gene = vertex_2_gene
+    timings["vertex_2_gene"] = time.time() - t0
+
+    # Edges with both vertices in the region
+    t0 = time.time()
+    pos1 = arrays["edge_pos1"]
+    i = np.searchsorted(pos1, start, side = "left")
+    j = np.searchsorted(pos1, end, side = "right")
+    pos2 = arrays["edge_pos2"][i:j]
+    keep = np.nonzero((pos2 >= start) & (pos2 <= end))[0] + i
+    edge_dict = {}
+    for edge in zip(arrays["edge_ID"][keep].tolist(), arrays["edge_v1"][keep].tolist(),
+                    arrays["edge_v2"][keep].tolist(),
+                    arrays["edge_type"][keep].tolist(),
+                    arrays["edge_strand"][keep].tolist()):
+        edge = dstruct.EdgeRecord.from_row(edge[:4] + (to_str(edge[4]),))
+        edge_dict[(edge[1], edge[2], edge[3])] = edge
+    region.edge_dict = edge_dict
+    timings["edge_dict"] = time.time() - t0
+
+    # Transcripts overlapping the region
+    t0 = time.time()
+    keep = np.nonzero((arrays["tx_min_pos"] <= end) & \
+                      (arrays["tx_max_pos"] >= start))[0]
+    jn = arrays["tx_jn"]
+    offsets = arrays["tx_jn_offsets"]
+    jn_null = arrays["tx_jn_null"][keep].tolist()
+    jn_paths = [ None if null else bytes(jn[offsets[k]:offsets[k+1]]).decode()
+                 for k, null in zip(keep.tolist(), jn_null) ]
+    cols = [ arrays["tx_" + name][keep].tolist() for name in
+             ["ID", "gene", "start_exon", "end_exon", "start_vertex",
+              "end_vertex", "n_exons", "start_pos", "end_pos", "min_pos",
+              "max_pos", "strand", "known"] ]
+    transcripts = [ dstruct.TranscriptRecord.from_row((t_ID, gene, start_exon,
+                                       jn_path, end_exon, start_vertex,
+                                       end_vertex, n_exons, chrom, start_pos,
+                                       end_pos, min_pos, max_pos,
+                                       to_str(strand), int(known)))
+                    for jn_path, (t_ID, gene, start_exon, end_exon,
+                                  start_vertex, end_vertex, n_exons, start_pos,
+                                  end_pos, min_pos, max_pos, strand, known)
+                    in zip(jn_paths, zip(*cols)) ]
+
+    transcript_dict = dstruct.TranscriptDict()
+    for transcript in transcripts:
+        transcript_path = transcript["jn_path"]
+        if transcript_path != None:
+            transcript_path = transcript_path.split(",") + \
+                              [transcript["start_exon"], transcript["end_exon"]]
+            transcript_path = frozenset([ int(x) for x in transcript_path])
+        else:
+            transcript_path = frozenset([transcript["start_exon"]])
+        transcript_dict[transcript_path] = transcript
+    region.transcript_dict = transcript_dict
+    timings["transcript_dict"] = time.time() - t0
+
+    # Starts and ends of known transcripts that fall inside the region
+    for mode in ["start", "end"]:
+        t0 = time.time()
+        output_dict = {}
+        for transcript in transcripts:
+            pos = transcript[mode + "_pos"]
+            if not transcript["known"] or pos < start or pos > end:
+                continue
+            gene_ID = transcript["gene_ID"]
+            try:
+                output_dict[gene_ID][pos] = transcript[mode + "_vertex"]
+            except KeyError:
+                output_dict[gene_ID] = {pos: transcript[mode + "_vertex"]}
+        for gene_ID in output_dict:
+            output_dict[gene_ID] = dstruct.PositionDict(output_dict[gene_ID])
+        region["gene_" + mode + "s"] = output_dict
+        timings["gene_" + mode + "s"] = time.time() - t0
+
+    # Monoexonic transcripts
+    t0 = time.time()
+    region.monoexons = region_monoexons(arrays, chrom, start, end)
+    timings["monoexons"] = time.time() - t0
+
+    region.genes = region_genes(arrays, chrom, start, end)
+
+    region.timings = timings
+    return region
+
+def region_monoexons(arrays, chrom, start, end):
+    """ Returns the monoexonic transcripts overlapping the region as dicts, in
+        the format of init_refs.monoexon_interval_query """
+    keep = np.nonzero((arrays["tx_n_exons"] == 1) & \
+                      (arrays["tx_min_pos"] <= end) & \
+                      (arrays["tx_max_pos"] >= start))[0]
+    cols = [ arrays["tx_" + name][keep].tolist() for name in
+             ["gene", "ID", "start_pos", "end_pos", "strand", "start_vertex",
+              "end_vertex", "start_exon", "min_pos", "max_pos"] ]
+    return [ {'gene_ID': gene_ID, 'transcript_ID': t_ID, 'chromosome': chrom,
+              'start': start_pos, 'end': end_pos, 'strand': to_str(strand),
+              'start_vertex': start_vertex, 'end_vertex': end_vertex,
+              'exon_ID': exon_ID, 'min_pos': min_pos, 'max_pos': max_pos}
+             for gene_ID, t_ID, start_pos, end_pos, strand, start_vertex,
+                 end_vertex, exon_ID, min_pos, max_pos in zip(*cols) ]
+
+def region_genes(arrays, chrom, start, end):
+    """ Returns the genes overlapping the region as dicts, in the format of
+        init_refs.gene_interval_query """
+    keep = np.nonzero((arrays["gene_start"] <= end) & \
+                      (arrays["gene_end"] >= start))[0]
+    return [ {'gene_ID': gene_ID, 'chromosome': chrom, 'start': g_start,
+              'end': g_end, 'strand': to_str(strand)}
+             for gene_ID, g_start, g_end, strand in
+             zip(arrays["gene_ID"][keep].tolist(),
+                 arrays["gene_start"][keep].tolist(),
+                 arrays["gene_end"][keep].tolist(),
+                 arrays["gene_strand"][keep].tolist()) ]
+
+def main():
+    options = get_args()
+    outdir = options.outdir
+    if outdir == None:
+        outdir = default_path(options.database, options.build)
+
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    print("[ %s ] Writing reference pack for %s to %s" % \
+          (ts, options.build, outdir))
+    meta = write_reference_pack(options.database, options.build, outdir)
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    print("[ %s ] DONE (%d chromosomes)" % (ts, len(meta["chromosomes"])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Reference structures that are built once in the main process and shared
+# with the worker processes. The known locations, edges, transcripts, vertex
+# to gene assignments, and gene starts/ends of the build are held in
+# read-only NumPy arrays (memory-mapped from a reference pack, or compiled
+# from the database), which forked workers inherit without copying. For each
+# interval, a worker wraps the arrays in the dict classes below. These keep
+# the novel entities of the interval in the dict itself (a small overlay) and
+# look up everything else in the shared arrays.
+# ---------------------------------------------------------------------
+# SharedReference
+# SharedPositionDict
+# SharedEdgeDict
+# SharedTranscriptDict
+# SharedVertexGeneDict
+# SharedGeneLocations
+# make_overlay_structures
+
+import time
+import numpy as np
+from . import dstruct
+from . import reference_pack as refpack
+
+class SharedReference(object):
+    """
+    Whole-build reference arrays. chrom_arrays maps each chromosome to its
+    arrays in the reference pack format (see
+    reference_pack.compile_reference_arrays). Lookup arrays spanning the
+    whole build are derived from them once, here.
+    """
+    def __init__(self, build, chrom_arrays):
+        self.build = build
+        self.chrom_arrays = chrom_arrays
+        self.chroms = sorted(chrom_arrays)
+
+        def concat(name):
+            if len(self.chroms) == 0:
+                return np.array([], dtype = np.int64)
+            return np.concatenate([ chrom_arrays[c][name] for c in self.chroms ])
+
+        # Edges, sorted on (v1, v2)
+        v1 = concat("edge_v1")
+        v2 = concat("edge_v2")
+        order = np.lexsort((v2, v1))
+        self.edge_v1 = v1[order]
+        self.edge_v2 = v2[order]
+        self.edge_ID = concat("edge_ID")[order]
+        self.edge_type = concat("edge_type")[order]
+        self.edge_strand = concat("edge_strand")[order]
+
+        # Vertex to gene assignments, sorted on vertex ID
+        vertex_IDs = concat("vtx_ID")
+        order = np.argsort(vertex_IDs, kind = "stable")
+        self.vtx_ID = vertex_IDs[order]
+        self.vtx_gene = concat("vtx_gene")[order]
+        self.vtx_strand = concat("vtx_strand")[order]
+
+        # Transcripts, in database order within each chromosome
+        self.tx = { name: concat("tx_" + name) for name in
+                    ["ID", "gene", "start_exon", "end_exon", "start_vertex",
+                     "end_vertex", "n_exons", "start_pos", "end_pos",
+                     "min_pos", "max_pos", "strand", "known", "jn_null"] }
+        self.tx_chrom = np.repeat(np.arange(len(self.chroms)),
+                                  [ len(chrom_arrays[c]["tx_ID"]) for c in self.chroms ])
+        self.tx_jn = concat("tx_jn").astype(np.uint8)
+        jn_lengths = [ np.diff(chrom_arrays[c]["tx_jn_offsets"])
+                       for c in self.chroms ]
+        self.tx_jn_offsets = np.cumsum(np.concatenate([[0]] + jn_lengths),
+                                       dtype = np.int64)
+        jn = self.tx_jn.tobytes()
+        offsets = self.tx_jn_offsets.tolist()
+        jn_paths = [ jn[offsets[k]:offsets[k+1]].decode()
+                     for k in range(len(offsets) - 1) ]
+
+        # Transcript keys (the edge sets), as in a TranscriptDict: if two
+        # transcripts share a key, the key keeps its first position and takes
+        # the later transcript.
+        key_to_tx = {}
+        for t, (jn_path, jn_null, start_exon, end_exon) in enumerate(zip(jn_paths,
+                                      self.tx["jn_null"].tolist(),
+                                      self.tx["start_exon"].tolist(),
+                                      self.tx["end_exon"].tolist())):
+            if jn_null:
+                key = frozenset([start_exon])
+            else:
+                key = frozenset([ int(x) for x in jn_path.split(",") ] + \
+                                [start_exon, end_exon])
+            key_to_tx[key] = t
+        self.key_tx = np.array(list(key_to_tx.values()), dtype = np.int64)
+        key_edges = [ sorted(key) for key in key_to_tx ]
+        key_to_tx = jn_paths = None
+        lengths = [ len(x) for x in key_edges ]
+        self.key_offsets = np.cumsum([0] + lengths, dtype = np.int64)
+        self.key_edges = np.array([ e for x in key_edges for e in x ],
+                                  dtype = np.int64)
+
+        # Inverted index: edge -> keys that contain it, in key order
+        key_of_edge = np.repeat(np.arange(len(lengths), dtype = np.int64),
+                                lengths)
+        order = np.argsort(self.key_edges, kind = "stable")
+        sorted_edges = self.key_edges[order]
+        self.post_keys = key_of_edge[order]
+        self.post_edges, first = np.unique(sorted_edges, return_index = True)
+        self.post_offsets = np.append(first, len(sorted_edges)).astype(np.int64)
+
+        # Starts and ends of known transcripts, grouped by gene
+        known = np.nonzero(self.tx["known"])[0]
+        order = known[np.argsort(self.tx["gene"][known], kind = "stable")]
+        self.known_gene = self.tx["gene"][order]
+        self.known_pos = { mode: self.tx[mode + "_pos"][order]
+                           for mode in ["start", "end"] }
+        self.known_vertex = { mode: self.tx[mode + "_vertex"][order]
+                              for mode in ["start", "end"] }
+
+    @classmethod
+    def from_pack(cls, pack_dir, build):
+        """ Memory-maps the arrays of a reference pack """
+        return cls(build, refpack.load_reference_arrays(pack_dir))
+
+    @classmethod
+    def from_database(cls, database, build):
+        """ Compiles the arrays from the database """
+        counters, chrom_arrays = refpack.compile_reference_arrays(database, build)
+        return cls(build, chrom_arrays)
+
+    def transcript_record(self, t):
+        """ Returns transcript t as a dstruct.TranscriptRecord """
+        tx = self.tx
+        jn_path = None
+        if not tx["jn_null"][t]:
+            jn_path = self.tx_jn[self.tx_jn_offsets[t]:
+                                 self.tx_jn_offsets[t+1]].tobytes().decode()
+        return dstruct.TranscriptRecord.from_row((int(tx["ID"][t]),
+                    int(tx["gene"][t]),
+                    int(tx["start_exon"][t]), jn_path, int(tx["end_exon"][t]),
+                    int(tx["start_vertex"][t]), int(tx["end_vertex"][t]),
+                    int(tx["n_exons"][t]), self.chroms[self.tx_chrom[t]],
+                    int(tx["start_pos"][t]), int(tx["end_pos"][t]),
+                    int(tx["min_pos"][t]), int(tx["max_pos"][t]),
+                    refpack.to_str(str(tx["strand"][t])), int(tx["known"][t])))
+
+class SharedPositionDict(dstruct.PositionDict):
+    """
+    PositionDict for one chromosome whose known locations are in the shared
+    arrays. Novel locations are added to the dict as usual.
+    """
+    def __init__(self, build, chrom, IDs, positions):
+        dstruct.PositionDict.__init__(self)
+        self.build = build
+        self.chrom = chrom
+        self.base_IDs = IDs
+        self.base_positions = positions
+
+    def _base_index(self, position):
+        i = np.searchsorted(self.base_positions, position)
+        if i < len(self.base_positions) and self.base_positions[i] == position:
+            return i
+        return None
+
+    def __contains__(self, position):
+        return dict.__contains__(self, position) or \
+               self._base_index(position) != None
+
+    def __missing__(self, position):
+        i = self._base_index(position)
+        if i == None:
+            raise KeyError(position)
+        return dstruct.LocationRecord((int(self.base_IDs[i]), self.build,
+                                       self.chrom, position))
+
+    def neighbours(self, position, window_start, window_end):
+        left, right = dstruct.PositionDict.neighbours(self, position,
+                                                      window_start, window_end)
+        base_left, base_right = dstruct.window_neighbours(self.base_positions,
+                                                          position, window_start,
+                                                          window_end)
+        if base_left != None and (left == None or base_left > left):
+            left = int(base_left)
+        if base_right != None and (right == None or base_right < right):
+            right = int(base_right)
+        return left, right
+
+class SharedEdgeDict(dict):
+    """
+    Edge dict keyed by (v1, v2, edge_type) whose known edges are in the
+    shared arrays. Novel edges are added to the dict as usual.
+    """
+    def __init__(self, shared):
+        dict.__init__(self)
+        self.shared = shared
+
+    def _base_index(self, key):
+        v1, v2, edge_type = key
+        shared = self.shared
+        i = np.searchsorted(shared.edge_v1, v1, side = "left")
+        j = np.searchsorted(shared.edge_v1, v1, side = "right")
+        k = i + np.searchsorted(shared.edge_v2[i:j], v2, side = "left")
+        while k < j and shared.edge_v2[k] == v2:
+            if shared.edge_type[k] == edge_type:
+                return k
+            k += 1
+        return None
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._base_index(key) != None
+
+    def __missing__(self, key):
+        k = self._base_index(key)
+        if k == None:
+            raise KeyError(key)
+        shared = self.shared
+        return dstruct.EdgeRecord.from_row((int(shared.edge_ID[k]), key[0],
+                                   key[1], key[2],
+                                   refpack.to_str(str(shared.edge_strand[k]))))
+
+class SharedTranscriptDict(dstruct.TranscriptDict):
+    """
+    TranscriptDict whose known transcripts are in the shared arrays. Novel
+    transcripts are added to the dict (and its edge index) as usual, and are
+    returned after the known ones by find_supersets.
+    """
+    def __init__(self, shared):
+        dstruct.TranscriptDict.__init__(self)
+        self.shared = shared
+
+    def _base_key(self, k):
+        shared = self.shared
+        return frozenset(shared.key_edges[shared.key_offsets[k]:
+                                          shared.key_offsets[k+1]].tolist())
+
+    def _base_supersets(self, edges):
+        """ Returns (key, transcript) index pairs for the known transcripts
+            that contain every edge in the provided frozenset """
+        shared = self.shared
+        if len(edges) == 0:
+            candidates = range(len(shared.key_tx))
+        else:
+            postings = []
+            for edge in edges:
+                i = np.searchsorted(shared.post_edges, edge)
+                if i == len(shared.post_edges) or shared.post_edges[i] != edge:
+                    return []
+                postings.append((shared.post_offsets[i], shared.post_offsets[i+1]))
+            lo, hi = min(postings, key = lambda x: x[1] - x[0])
+            candidates = shared.post_keys[lo:hi].tolist()
+        return [ (key, shared.key_tx[k]) for key, k in
+                 [ (self._base_key(k), k) for k in candidates ]
+                 if edges.issubset(key) ]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or \
+               any(match == key for match, t in self._base_supersets(key))
+
+    def __missing__(self, key):
+        for match, t in self._base_supersets(key):
+            if match == key:
+                return self.shared.transcript_record(t)
+        raise KeyError(key)
+
+    def find_supersets(self, edges):
+        return [ key for key, t in self._base_supersets(edges) ] + \
+               dstruct.TranscriptDict.find_supersets(self, edges)
+
+class SharedVertexGeneDict(dict):
+    """
+    Maps vertices to the set of (gene ID, strand) pairs they belong to. The
+    known assignments are in the shared arrays; a vertex's set is copied into
+    the dict the first time it is accessed, so that it can be added to.
+    """
+    def __init__(self, shared):
+        dict.__init__(self)
+        self.shared = shared
+
+    def _base_range(self, vertex):
+        if vertex == None:
+            return 0, 0
+        i = np.searchsorted(self.shared.vtx_ID, vertex, side = "left")
+        j = np.searchsorted(self.shared.vtx_ID, vertex, side = "right")
+        return i, j
+
+    def __contains__(self, vertex):
+        if dict.__contains__(self, vertex):
+            return True
+        i, j = self._base_range(vertex)
+        return j > i
+
+    def __missing__(self, vertex):
+        i, j = self._base_range(vertex)
+        if j == i:
+            raise KeyError(vertex)
+        genes = set(zip(self.shared.vtx_gene[i:j].tolist(),
+                        [ refpack.to_str(x) for x in
+                          self.shared.vtx_strand[i:j].tolist() ]))
+        self[vertex] = genes
+        return genes
+
+class SharedGeneLocations(dict):
+    """
+    Maps gene IDs to dstruct.PositionDicts of known start (or end) positions
+    -> vertex IDs, as in init_refs.make_gene_start_or_end_dict. Entries are
+    built from the shared arrays the first time they are accessed.
+    """
+    def __init__(self, shared, mode):
+        dict.__init__(self)
+        self.shared = shared
+        self.mode = mode
+
+    def _base_range(self, gene_ID):
+        if gene_ID == None:
+            return 0, 0
+        i = np.searchsorted(self.shared.known_gene, gene_ID, side = "left")
+        j = np.searchsorted(self.shared.known_gene, gene_ID, side = "right")
+        return i, j
+
+    def __contains__(self, gene_ID):
+        if dict.__contains__(self, gene_ID):
+            return True
+        i, j = self._base_range(gene_ID)
+        return j > i
+
+    def __missing__(self, gene_ID):
+        i, j = self._base_range(gene_ID)
+        if j == i:
+            raise KeyError(gene_ID)
+        locations = dstruct.PositionDict(zip(
+                             self.shared.known_pos[self.mode][i:j].tolist(),
+                             self.shared.known_vertex[self.mode][i:j].tolist()))
+        self[gene_ID] = locations
+        return locations
+
+def make_overlay_structures(shared, chrom, start, end):
+    """ Counterpart of init_refs.make_region_structures for a worker with a
+        SharedReference. Returns a dstruct.Struct with the same fields, along
+        with the gene records overlapping the region under 'genes'. Only the
+        monoexonic transcript and gene records are specific to the region;
+        the other structures are overlays on the whole build. """
+    timings = {}
+    region = dstruct.Struct()
+
+    t0 = time.time()
+    region.location_dict = { c: SharedPositionDict(shared.build, c,
+                                         shared.chrom_arrays[c]["loc_ID"],
+                                         shared.chrom_arrays[c]["loc_pos"])
+                             for c in shared.chroms }
+    timings["location_dict"] = time.time() - t0
+
+    t0 = time.time()
+    region.vertex_2_gene = SharedVertexGeneDict(shared)
+    timings["vertex_2_gene"] = time.time() - t0
+
+    t0 = time.time()
+    region.edge_dict = SharedEdgeDict(shared)
+    timings["edge_dict"] = time.time() - t0
+
+    t0 = time.time()
+    region.transcript_dict = SharedTranscriptDict(shared)
+    timings["transcript_dict"] = time.time() - t0
+
+    for mode in ["start", "end"]:
+        t0 = time.time()
+        region["gene_" + mode + "s"] = SharedGeneLocations(shared, mode)
+        timings["gene_" + mode + "s"] = time.time() - t0
+
+    t0 = time.time()
+    if chrom in shared.chrom_arrays:
+        region.monoexons = refpack.region_monoexons(shared.chrom_arrays[chrom],
+                                                    chrom, start, end)
+        region.genes = refpack.region_genes(shared.chrom_arrays[chrom],
+                                            chrom, start, end)
+    else:
+        region.monoexons = []
+        region.genes = []
+    timings["monoexons"] = time.time() - t0
+
+    region.timings = timings
+    return region
@@ -0,0 +1,192 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Staging database for the pipelined database update (talon --pipeline).
+# While the workers are still annotating, a writer process loads the shard
+# files of each finished interval into a separate SQLite database. Once every
+# interval is done, the staged rows are copied into the TALON database with
+# one INSERT ... SELECT per table instead of the outfiles being parsed by the
+# main process after the run. Each staged row carries a sequence number made
+# from the index of its interval and its line in the shard, so the rows reach
+# the database in the same (genomic) order as with merged outfiles.
+# ---------------------------------------------------------------------
+# create_staging_db
+# create_staged_table
+# writer
+# stage_shards
+# staged_IDs
+# rewrite_staged_table
+# count_staged_rows
+# merge_staged_tables
+# merge_staged_abundance
+
+import os
+import sqlite3
+
+ANNOT_COLUMNS = ["ID", "annot_name", "source", "attribute", "value"]
+
+# Outfile key -> (database table, columns of the outfile, insert statement,
+#                 columns where 'None' stands for NULL)
+STAGED_TABLES = {"genes": ("genes", ["gene_ID", "strand"],
+                           "INSERT OR IGNORE", []),
+                 "transcripts": ("transcripts",
+                                 ["transcript_ID", "gene_ID", "start_exon",
+                                  "jn_path", "end_exon", "start_vertex",
+                                  "end_vertex", "n_exons"],
+                                 "INSERT", ["jn_path"]),
+                 "edges": ("edge", ["edge_ID", "v1", "v2", "edge_type",
+                                    "strand"],
+                           "INSERT", []),
+                 "location": ("location", ["location_ID", "genome_build",
+                                           "chromosome", "position"],
+                              "INSERT", []),
+                 "v2g": ("vertex", ["vertex_ID", "gene_ID"],
+                         "INSERT OR IGNORE", []),
+                 "observed": ("observed",
+                              ["obs_ID", "gene_ID", "transcript_ID",
+                               "read_name", "dataset", "start_vertex",
+                               "end_vertex", "start_exon", "end_exon",
+                               "start_delta", "end_delta", "read_length",
+                               "fraction_As", "custom_label", "allelic_label",
+                               "start_support", "end_support"],
+                              "INSERT", ["start_delta", "end_delta",
+                                         "fraction_As", "custom_label",
+                                         "allelic_label", "start_support",
+                                         "end_support"]),
+                 "gene_annot": ("gene_annotations", ANNOT_COLUMNS,
+                                "INSERT OR IGNORE", []),
+                 "transcript_annot": ("transcript_annotations", ANNOT_COLUMNS,
+                                      "INSERT OR IGNORE", []),
+                 "exon_annot": ("exon_annotations", ANNOT_COLUMNS,
+                                "INSERT OR IGNORE", [])}
+
+# Sequence number of a staged row: (interval index << SEQ_SHIFT) + line
+SEQ_SHIFT = 32
+
+def create_staging_db(staging_db, database):
+    """ Creates an empty staging database with one table per staged outfile.
+        The columns have the same declared types as in the TALON database,
+        so that values are converted the same way when they are staged. """
+
+    if os.path.exists(staging_db):
+        os.remove(staging_db)
+
+    with sqlite3.connect(database) as conn:
+        types = {}
+        for key, (table, columns, insert, null_columns) in STAGED_TABLES.items():
+            declared = dict([ (row[1], row[2]) for row in
+                              conn.execute("PRAGMA table_info(%s)" % table) ])
+            types[key] = [ declared[col] for col in columns ]
+
+    conn = sqlite3.connect(staging_db)
+    cursor = conn.cursor()
+    for key in STAGED_TABLES:
+        create_staged_table(cursor, key, key, types[key])
+    conn.commit()
+    conn.close()
+    return
+
+def create_staged_table(cursor, name, key, types):
+    """ Creates a table for the rows of the outfile 'key', with the provided
+        declared column types and a leading sequence number column """
+
+    columns = STAGED_TABLES[key][1]
+    cursor.execute("CREATE TABLE %s (seq INTEGER, %s)" % \
+                   (name, ", ".join([ "%s %s" % (col, col_type) for
+                                      col, col_type in zip(columns, types) ])))
+    return
+
+def writer(queue, staging_db, outfiles):
+    """ Runs in its own process during a pipelined run. Takes (interval index,
+        shards) messages from the queue and stages the shards of each
+        interval as it arrives, until it gets None. """
+
+    conn = sqlite3.connect(staging_db)
+    # The staging database is rebuilt by every run, so it does not need to
+    # survive a crash
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = OFF")
+    cursor = conn.cursor()
+    while True:
+        msg = queue.get()
+        if msg is None:
+            break
+        index, shards = msg
+        stage_shards(cursor, index, shards, outfiles)
+        conn.commit()
+    conn.close()
+    return
+
+def stage_shards(cursor, index, shards, outfiles):
+    """ Loads the shard of each staged outfile written for the interval with
+        the provided index (in genomic order) and removes the shard files.
+        shards maps outfile paths to shard paths, as returned by
+        talon.parallel_talon. """
+
+    for key, (table, columns, insert, null_columns) in STAGED_TABLES.items():
+        shard = shards[outfiles[key]]
+        first_seq = index << SEQ_SHIFT
+        command = "INSERT INTO %s VALUES (%s)" % \
+                  (key, ",".join(["?"] * (len(columns) + 1)))
+        with open(shard, 'r') as f:
+            cursor.executemany(command,
+                               ( [first_seq + i] + line.strip().split("\t")
+                                 for i, line in enumerate(f) ))
+        os.remove(shard)
+    return
+
+def staged_IDs(cursor, key):
+    """ Yields the IDs in the first column of the staged outfile """
+
+    cursor.execute("SELECT %s FROM %s" % (STAGED_TABLES[key][1][0], key))
+    for row in cursor:
+        yield row[0]
+
+def rewrite_staged_table(conn, key, row_fn):
+    """ Replaces each staged row of the outfile with row_fn(row), where row
+        is a list of the outfile columns. The new rows are written to a new
+        table, which then takes the place of the old one. """
+
+    cursor = conn.cursor()
+    types = [ row[2] for row in
+              cursor.execute("PRAGMA table_info(%s)" % key).fetchall()[1:] ]
+    create_staged_table(cursor, "new_" + key, key, types)
+
+    n_columns = len(STAGED_TABLES[key][1])
+    rows = conn.execute("SELECT * FROM %s" % key)
+    cursor.executemany("INSERT INTO new_%s VALUES (%s)" % \
+                       (key, ",".join(["?"] * (n_columns + 1))),
+                       ( [row[0]] + row_fn(list(row[1:])) for row in rows ))
+    cursor.execute("DROP TABLE %s" % key)
+    cursor.execute("ALTER TABLE new_%s RENAME TO %s" % (key, key))
+    return
+
+def count_staged_rows(cursor, key):
+    """ Returns the number of staged rows of the outfile """
+
+    cursor.execute("SELECT COUNT(*) FROM staging.%s" % key)
+    return cursor.fetchone()[0]
+
+def merge_staged_tables(cursor, keys):
+    """ Copies the staged rows of each outfile into its table in the TALON
+        database, which must have the staging database attached as
+        'staging'. """
+
+    for key in keys:
+        table, columns, insert, null_columns = STAGED_TABLES[key]
+        values = [ "NULLIF(%s, 'None')" % col if col in null_columns else col
+                   for col in columns ]
+        cursor.execute("%s INTO %s (%s) SELECT %s FROM staging.%s ORDER BY seq" % \
+                       (insert, table, ", ".join(columns), ", ".join(values),
+                        key))
+    return
+
+def merge_staged_abundance(cursor):
+    """ Adds the abundance of each transcript in each dataset, counted from
+        the staged observed rows, to the abundance table """
+
+    cursor.execute(""" INSERT INTO abundance (transcript_ID, dataset, count)
+                       SELECT transcript_ID, dataset, COUNT(*)
+                       FROM staging.observed
+                       GROUP BY dataset, transcript_ID
+                       ORDER BY MIN(seq) """)
+    return
@@ -5,11 +5,13 @@
 # assigns them transcript and gene identifiers based on a GTF annotation.
 # Novel transcripts are assigned new identifiers.
 import argparse
+import json
 from functools import reduce
 import sqlite3
 import sys
 import operator
 import os
+import shutil
 from pathlib import Path
 import warnings
 from . import dstruct
@@ -17,6 +19,11 @@ from . import process_sams as procsams
 from . import transcript_utils as tutils
 from . import query_utils as qutils
 from . import init_refs as init_refs
+from . import extent_utils
+from . import reference_pack as refpack
+from . import shared_refs
+from . import staging
+from . import profiling
 from talon.post import get_read_annotations
 import pysam
 from string import Template
@@ -25,6 +32,7 @@ import queue
 from datetime import datetime, timedelta
 import time
 from itertools import repeat,islice
+from contextlib import ExitStack
 
 class Counter(object):
     def __init__(self, initval=0):
@@ -40,10 +48,100 @@ class Counter(object):
         with self.lock:
             return self.val.value
 
-def get_counters(database):
+class BlockCounter(Counter):
+    """ Counter that leases blocks of block_size consecutive IDs to each
+        process. The shared value is only locked when a process needs a new
+        block; IDs within a block are handed out locally. The unused tail of
+        each block is left as a gap, so once the run is over, compact() 
+        works out the offsets that close those gaps. """
+    def __init__(self, initval=0, block_size=1000):
+        Counter.__init__(self, initval)
+        self.initval = initval
+        self.block_size = block_size
+        self.pid = None
+        self.next_ID = 0
+        self.block_end = -1
+
+    def increment(self):
+        # A process forked after a lease was taken must not reuse that block
+        if self.pid != os.getpid() or self.next_ID > self.block_end:
+            with self.lock:
+                self.next_ID = self.val.value + 1
+                self.val.value += self.block_size
+            self.block_end = self.next_ID + self.block_size - 1
+            self.pid = os.getpid()
+        new_ID = self.next_ID
+        self.next_ID += 1
+        return new_ID
+
+    def compact(self, used_IDs):
+        """ Given all of the IDs that were handed out by this counter, return
+            a function that maps them onto consecutive IDs following the 
+            initial counter value (preserving their order). IDs at or below 
+            the initial value are left alone. Afterwards, the counter value 
+            is set to the last compacted ID. """
+        n_blocks = (self.val.value - self.initval) // self.block_size
+        used = [0] * n_blocks
+        for ID in used_IDs:
+            if ID > self.initval:
+                block, offset = divmod(ID - self.initval - 1, self.block_size)
+                used[block] = max(used[block], offset + 1)
+
+        # Amount to subtract from the IDs in each block
+        shifts = []
+        total = 0
+        for block in range(n_blocks):
+            shifts.append(block*self.block_size - total)
+            total += used[block]
+
+        with self.lock:
+            self.val.value = self.initval + total
+        self.pid = None
+
+        initval = self.initval
+        block_size = self.block_size
+        def remap(ID):
+            ID = int(ID)
+            if ID <= initval:
+                return ID
+            return ID - shifts[(ID - initval - 1) // block_size]
+        return remap
+
+class ShardWriter(object):
+    """ Stands in for the listener queue inside a worker. Each message
+        (filename, string) is written to a buffered shard file belonging to
+        the current interval instead of being sent across processes one line
+        at a time. The main process concatenates the shards once all of the
+        jobs are done. """
+    def __init__(self, outfiles, interval_id, shard_dir, buffer_size = 1048576):
+        os.makedirs(shard_dir, exist_ok = True)
+        self.shards = {}
+        self.open_files = {}
+        for fpath in outfiles.values():
+            shard = os.path.join(shard_dir, interval_id + "_" + 
+                                 os.path.basename(fpath))
+            self.shards[fpath] = shard
+            self.open_files[fpath] = open(shard, 'w', buffering = buffer_size)
+
+    def put(self, msg):
+        self.open_files[msg[0]].write(msg[1] + "\n")
+
+    def close(self):
+        for f in self.open_files.values():
+            f.close()
+        return self.shards
+
+def get_counters(database, block_size = 1):
     """ Fetch counter values from the database and create counter objects 
-        that will be accessible to all of the threads during the parallel run
+        that will be accessible to all of the threads during the parallel run.
+        If block_size is greater than 1, the gene, transcript, vertex, edge, 
+        and observed counters lease IDs to each process in blocks of that 
+        size, and the IDs must be compacted with compact_IDs after the run.
     """
+    def make_counter(initval):
+        if block_size > 1:
+            return BlockCounter(initval = initval, block_size = block_size)
+        return Counter(initval = initval)
 
     with sqlite3.connect(database) as conn:
         conn.row_factory = sqlite3.Row
@@ -52,23 +150,23 @@ def get_counters(database):
         # Fetch counter values
         cursor.execute("SELECT * FROM counters WHERE category == 'genes'")
         global gene_counter
-        gene_counter = Counter(initval = cursor.fetchone()['count'])
+        gene_counter = make_counter(cursor.fetchone()['count'])
 
         cursor.execute("SELECT * FROM counters WHERE category == 'transcripts'")
         global transcript_counter
-        transcript_counter = Counter(initval = cursor.fetchone()['count'])
+        transcript_counter = make_counter(cursor.fetchone()['count'])
 
         cursor.execute("SELECT * FROM counters WHERE category == 'vertex'")
         global vertex_counter
-        vertex_counter = Counter(initval = cursor.fetchone()['count'])
+        vertex_counter = make_counter(cursor.fetchone()['count'])
 
         cursor.execute("SELECT * FROM counters WHERE category == 'edge'")
         global edge_counter
-        edge_counter = Counter(initval = cursor.fetchone()['count'])
+        edge_counter = make_counter(cursor.fetchone()['count'])
 
         cursor.execute("SELECT * FROM counters WHERE category == 'observed'")
         global observed_counter
-        observed_counter = Counter(initval = cursor.fetchone()['count'])
+        observed_counter = make_counter(cursor.fetchone()['count'])
 
         cursor.execute("SELECT * FROM counters WHERE category == 'dataset'")
         global dataset_counter
@@ -76,6 +174,24 @@ def get_counters(database):
 
     return 
 
+# Known reference structures shared with forked workers (see shared_refs)
+shared_reference = None
+
+# Number of novel vertices, edges, genes, and transcripts created by this
+# process. Annotations reused by --collapse_reads are only valid while it stays
+# the same.
+n_created = 0
+
+def init_shared_reference(database, build, pack_dir = None):
+    """ Builds the shared reference arrays of the build, from the reference
+        pack if one is provided, or from the database otherwise. Must be
+        called before the worker pool is created. """
+    global shared_reference
+    if pack_dir != None:
+        shared_reference = shared_refs.SharedReference.from_pack(pack_dir, build)
+    else:
+        shared_reference = shared_refs.SharedReference.from_database(database, build)
+
 def get_args():
     """ Fetches the arguments for the program """
 
@@ -103,6 +219,75 @@ def get_args():
         type = float, default = 0.8)
     parser.add_argument("--o", dest = "outprefix", help = "Prefix for output files",
         type = str)
+    parser.add_argument("--use_queue", dest = "use_queue", action = "store_true",
+        help = "Send worker output through a single listener process instead " + \
+               "of having each worker write its own buffered shard files.")
+    parser.add_argument("--overlap_search", dest = "overlap_search",
+        choices = ["index", "sql"], default = "index",
+        help = "How to find the genes and monoexonic transcripts that " + \
+               "overlap a read: with in-memory interval indexes " + \
+               "(default), or by querying temporary SQL tables.")
+    parser.add_argument("--partition", dest = "partition",
+        choices = ["locus", "chromosome"], default = "locus",
+        help = "How to split the reads up for the workers: into intervals " + \
+               "made of neighbouring read clusters (default), or into one " + \
+               "interval per chromosome.")
+    parser.add_argument("--reads_per_interval", dest = "reads_per_interval",
+        type = int, default = None,
+        help = "Target number of reads per interval in locus mode.")
+    parser.add_argument("--n_intervals", dest = "n_intervals",
+        type = int, default = None,
+        help = "Target number of intervals in locus mode. Overrides " + \
+               "--reads_per_interval. If neither is set, the default is " + \
+               "four intervals per thread.")
+    parser.add_argument("--id_block_size", dest = "id_block_size",
+        type = int, default = 1000,
+        help = "Number of novel IDs of each type to hand to a worker at a " + \
+               "time. IDs are renumbered after the run to remove gaps. " + \
+               "Set to 1 to take a shared lock for every new ID. " + \
+               "Default = 1000")
+    parser.add_argument("--reference_pack", dest = "reference_pack",
+        type = str, default = None,
+        help = "Reference pack made with talon_build_reference_pack. It is " + \
+               "used in place of the database to load reference structures " + \
+               "as long as it is still current. Default: " + \
+               "<database>.<build>.refpack, if it exists.")
+    parser.add_argument("--shared_reference", dest = "shared_reference",
+        action = "store_true",
+        help = "Build the known reference structures once in the main " + \
+               "process and share them with the workers, which only keep " + \
+               "the novel entities of their intervals. Keeps memory use " + \
+               "nearly flat as --threads grows.")
+    parser.add_argument("--bulk_load", dest = "bulk_load", action = "store_true",
+        help = "Load the results into the database in bulk-load mode: one " + \
+               "transaction with syncing off and a large cache, and " + \
+               "indexes rebuilt at the end when the run adds many rows. " + \
+               "Faster for large runs, but the database can be corrupted " + \
+               "if the machine loses power during the load.")
+    parser.add_argument("--pipeline", dest = "pipeline", action = "store_true",
+        help = "Load the results of each interval into a staging database " + \
+               "as soon as the interval is done, while the others are " + \
+               "still being annotated. At the end, the staged rows are " + \
+               "copied into the database with one statement per table. " + \
+               "Not available with --use_queue.")
+    parser.add_argument("--collapse_reads", dest = "collapse_reads",
+        action = "store_true",
+        help = "Annotate each distinct read structure (chromosome, strand, " + \
+               "start, splice sites, and end) once per interval, and " + \
+               "give the other reads with that structure the same " + \
+               "assignment. Every read still gets its own entry.")
+    parser.add_argument("--deep_validate", dest = "deep_validate",
+        action = "store_true",
+        help = "Before committing, compare the number of rows in each " + \
+               "table with its counter. By default, only the rows added " + \
+               "by the run are checked against the counters, which does " + \
+               "not need to scan the tables.")
+    parser.add_argument("--profile", dest = "profile", action = "store_true",
+        help = "Time each stage of the run (reference loading, read QC, " + \
+               "vertex and edge matching, ISM search, gene overlap, " + \
+               "output, and database update) and write a summary with " + \
+               "the reads per second of every interval to " + \
+               "<outprefix>_profile.json.")
 
     args = parser.parse_args()
     return args
@@ -297,23 +482,34 @@ def permissive_match_with_gene_priority(chromosome, position, strand, sj_pos,
             search_window_start = sj_pos
             search_window_end = position + max_dist
 
-        # Compute distance to all of the gene positions on file
-        min_abs_dist = max_dist + 1
-        best_dist = None
-        closest_vertex = None
-        for known_location in gene_locs[gene_ID]:
-            if known_location < search_window_start or known_location > search_window_end:
-                continue
+        # Binary search over the sorted positions when they are available.
+        # The window is narrowed to the positions within the cutoff distance.
+        known_locations = gene_locs[gene_ID]
+        if isinstance(known_locations, dstruct.PositionDict):
+            known_location = known_locations.closest_in_window(position,
+                                      max(search_window_start, position - max_dist),
+                                      min(search_window_end, position + max_dist))
+            if known_location != None:
+                return known_locations[known_location], \
+                       compute_delta(known_location, position, strand), 1
+        else:
+            # Compute distance to all of the gene positions on file
+            min_abs_dist = max_dist + 1
+            best_dist = None
+            closest_vertex = None
+            for known_location in known_locations:
+                if known_location < search_window_start or known_location > search_window_end:
+                    continue
         
-            curr_dist = compute_delta(known_location, position, strand)
-            if abs(curr_dist) < min_abs_dist:
-                best_dist = curr_dist
-                min_abs_dist = abs(curr_dist)
-                closest_vertex = gene_locs[gene_ID][known_location]
+                curr_dist = compute_delta(known_location, position, strand)
+                if abs(curr_dist) < min_abs_dist:
+                    best_dist = curr_dist
+                    min_abs_dist = abs(curr_dist)
+                    closest_vertex = known_locations[known_location]
 
-        # If a valid match is found, return it
-        if min_abs_dist <= max_dist:
-            return closest_vertex, best_dist, 1
+            # If a valid match is found, return it
+            if min_abs_dist <= max_dist:
+                return closest_vertex, best_dist, 1
 
     # Otherwise, revert to permissive match approach.
     match, dist = permissive_vertex_search(chromosome, position, strand, 
@@ -363,6 +559,22 @@ def permissive_vertex_search(chromosome, position, strand, sj_pos, pos_type,
         search_window_start = sj_pos
         search_window_end = position + max_dist
 
+    # Binary search over the sorted positions when they are available. The
+    # window is narrowed to the positions that the loop below would visit.
+    if chromosome not in locations:
+        return None, None
+    chrom_locations = locations[chromosome]
+    if isinstance(chrom_locations, dstruct.PositionDict):
+        curr_pos = chrom_locations.find_closest(position,
+                                          max(search_window_start, position - max_dist),
+                                          min(search_window_end, position + max_dist),
+                                          direction_priority)
+        if curr_pos == None:
+            return None, None
+        match = chrom_locations[curr_pos]
+        dist = compute_delta(curr_pos, position, strand)
+        return match['location_ID'], dist
+
     for dist in range(1,max_dist):
         curr_pos = position + dist*direction_priority
         if curr_pos > search_window_start and curr_pos < search_window_end: 
@@ -382,6 +594,8 @@ def permissive_vertex_search(chromosome, position, strand, sj_pos, pos_type,
             
 def create_vertex(chromosome, position, location_dict, run_info):
     """ Creates a novel vertex and adds it to the location data structure. """
+    global n_created
+    n_created += 1
     new_ID = vertex_counter.increment()
     new_vertex = {'location_ID': new_ID,
                   'genome_build': run_info.build,
@@ -391,12 +605,14 @@ def create_vertex(chromosome, position, location_dict, run_info):
     try:
         location_dict[chromosome][position] = new_vertex
     except:
-        location_dict[chromosome] = { position: new_vertex }
+        location_dict[chromosome] = dstruct.PositionDict({ position: new_vertex })
 
     return new_vertex
 
 def create_edge(vertex_1, vertex_2, edge_type, strand, edge_dict): 
     """ Creates a novel edge and adds it to the edge data structure. """
+    global n_created
+    n_created += 1
     new_ID = edge_counter.increment()
     new_edge = {'edge_ID': new_ID,
                 'v1': vertex_1,
@@ -408,10 +624,19 @@ def create_edge(vertex_1, vertex_2, edge_type, strand, edge_dict):
     return new_edge
 
 def create_gene(chromosome, start, end, strand, memory_cursor, tmp_gene):
-    """ Create a novel gene and add it to the temporary table.
+    """ Create a novel gene and add it to the temporary table (or to the 
+        in-memory gene index, if that is what tmp_gene is).
     """
+    global n_created
+    n_created += 1
     new_ID = gene_counter.increment()
 
+    if isinstance(tmp_gene, dstruct.IntervalIndex):
+        tmp_gene.add({'gene_ID': new_ID, 'chromosome': chromosome,
+                      'start': min(start, end), 'end': max(start, end),
+                      'strand': strand})
+        return new_ID
+
     new_gene = ( new_ID, chromosome, min(start, end), max(start, end), strand )
     cols = ' ("gene_ID", "chromosome", "start", "end", "strand")' 
     command = 'INSERT INTO ' + tmp_gene + cols + ' VALUES ' + '(?,?,?,?,?)'
@@ -422,6 +647,8 @@ def create_transcript(chromosome, start_pos, end_pos, gene_ID, edge_IDs, vertex_
                       transcript_dict):
     """Creates a novel transcript and adds it to the transcript data structure.
     """
+    global n_created
+    n_created += 1
     new_ID = transcript_counter.increment()
     if len(edge_IDs) > 1:
         jn_path = ",".join(map(str, edge_IDs[1:-1]))
@@ -555,7 +782,13 @@ def search_for_ISM(edge_IDs, transcript_dict):
 
     edges = frozenset(edge_IDs)
 
-    ISM_matches = [ transcript_dict[x] for x in transcript_dict if edges.issubset(x)]
+    # Use the inverted edge index if the dict has one
+    if isinstance(transcript_dict, dstruct.TranscriptDict):
+        candidates = transcript_dict.find_supersets(edges)
+    else:
+        candidates = [ x for x in transcript_dict if edges.issubset(x) ]
+
+    ISM_matches = [ transcript_dict[x] for x in candidates ]
 
     if len(ISM_matches) > 0:
         return ISM_matches
@@ -570,27 +803,22 @@ def search_for_overlap_with_gene(chromosome, start, end, strand,
         more than one match, prioritize same-strand first and foremost. 
         If there is more than one same-strand option, prioritize amount of
         overlap. Antisense matches may be returned if there is no same strand
-        match. """
+        match. tmp_gene is either the name of the temporary gene table or an
+        in-memory gene index (dstruct.IntervalIndex). """
 
     min_start = min(start, end)
     max_end = max(start, end)
     query_interval = [min_start, max_end]
 
-    query = Template(""" SELECT gene_ID,
-                       chromosome,
-                       MIN(start) AS start,
-                       MAX(end) AS end,
-                       strand
-                FROM $tmp_gene
-                WHERE (chromosome = '$chrom') AND
-                      ((start <= $min_start AND end >= $max_end) OR
-                      (start >= $min_start AND end <= $max_end) OR
-                      (start >= $min_start AND start <= $max_end) OR
-                      (end >= $min_start AND end <= $max_end))
-                 GROUP BY gene_ID;""").substitute({'tmp_gene':tmp_gene, 'chrom':chromosome,
-                                     'min_start':min_start, 'max_end':max_end})  
-    cursor.execute(query)
-    matches = cursor.fetchall()
+    with profiling.stage("gene_overlap"):
+        if isinstance(tmp_gene, dstruct.IntervalIndex):
+            # Sort on gene ID to visit matches in the same order as the query
+            matches = sorted(tmp_gene.find_overlaps(chromosome, min_start,
+                                                    max_end),
+                             key = lambda x: x['gene_ID'])
+        else:
+            matches = query_gene_table(chromosome, min_start, max_end, cursor,
+                                       tmp_gene)
   
     if len(matches) == 0:
         return None, None
@@ -611,6 +839,26 @@ def search_for_overlap_with_gene(chromosome, start, end, strand,
 
     return best_match['gene_ID'], best_match['strand']
 
+def query_gene_table(chromosome, min_start, max_end, cursor, tmp_gene):
+    """ Fetch the genes in the temporary gene table that overlap the provided
+        interval. """
+
+    query = Template(""" SELECT gene_ID,
+                       chromosome,
+                       MIN(start) AS start,
+                       MAX(end) AS end,
+                       strand
+                FROM $tmp_gene
+                WHERE (chromosome = '$chrom') AND
+                      ((start <= $min_start AND end >= $max_end) OR
+                      (start >= $min_start AND end <= $max_end) OR
+                      (start >= $min_start AND start <= $max_end) OR
+                      (end >= $min_start AND end <= $max_end))
+                 GROUP BY gene_ID;""").substitute({'tmp_gene':tmp_gene, 'chrom':chromosome,
+                                     'min_start':min_start, 'max_end':max_end})  
+    cursor.execute(query)
+    return cursor.fetchall()
+
 def get_best_match(matches, query_interval):
     """ Given a set of gene matches and a query interval, return the match
         that has the greatest amount of overlap with the query."""
@@ -1212,11 +1460,14 @@ def identify_transcript(chrom, positions, strand, cursor, location_dict, edge_di
     gene_ID = None
  
     # Get vertex matches for the transcript positions
-    vertex_IDs, v_novelty = match_splice_vertices(chrom, positions, strand,
-                                                   location_dict, run_info)
+    with profiling.stage("vertex_matching"):
+        vertex_IDs, v_novelty = match_splice_vertices(chrom, positions, strand,
+                                                       location_dict, run_info)
 
     # Get edge matches for transcript exons and introns based on the vertices
-    edge_IDs, e_novelty = match_all_splice_edges(vertex_IDs, strand, edge_dict, run_info)
+    with profiling.stage("edge_matching"):
+        edge_IDs, e_novelty = match_all_splice_edges(vertex_IDs, strand,
+                                                     edge_dict, run_info)
 
     # Check novelty of exons and splice jns. This will help us categorize 
     # what type of novelty the transcript has
@@ -1228,7 +1479,8 @@ def identify_transcript(chrom, positions, strand, cursor, location_dict, edge_di
     # Look for FSM or ISM. 
     if all_SJs_known:
         # Get all FSM/ISM matches
-        all_matches = search_for_ISM(edge_IDs, transcript_dict)
+        with profiling.stage("ism_search"):
+            all_matches = search_for_ISM(edge_IDs, transcript_dict)
         if all_matches != None:
             # Look for FSM first
             gene_ID, transcript_ID, transcript_novelty, start_end_info = process_FSM(chrom,
@@ -1427,8 +1679,17 @@ def check_inputs(options):
                 else:
                     dataset_metadata.append(metadata)
                     curr_datasets.append(dataname)
-                    if not curr_sam.endswith(".sam"):
-                        raise ValueError('Last field in config file must be a .sam file')
+                    if not curr_sam.endswith((".sam", ".bam", ".cram")):
+                        raise ValueError('Last field in config file must be a ' + \
+                                         '.sam, .bam, or .cram file')
+                    # TALON has no reference option, so htslib has to find
+                    # the reference of a CRAM file on its own
+                    if curr_sam.endswith(".cram") and \
+                       not procsams.has_cram_reference(curr_sam):
+                        raise ValueError(("Cannot find the reference sequence "
+                               "of CRAM file '%s'. The UR fields of its @SQ "
+                               "header lines must point to the reference "
+                               "FASTA, or REF_PATH must be set.") % curr_sam)
                     sam_files.append(curr_sam)      
     if sam_files == []:
         raise RuntimeError(("All of the provided dataset names are already in "
@@ -1451,6 +1712,10 @@ def init_run_info(database, genome_build, min_coverage = 0.9, min_identity = 0,
         run_info.min_coverage = min_coverage
         run_info.min_identity = min_identity
         run_info.tmp_dir = tmp_dir
+        run_info.overlap_search = "index"
+        run_info.reference_pack = None
+        run_info.shared_reference = False
+        run_info.collapse_reads = False
         os.system("mkdir -p %s " % (tmp_dir)) 
 
         # Fetch information from run_info table
@@ -1512,53 +1777,62 @@ def init_outfiles(outprefix, tmp_dir = "talon_tmp/"):
 def prepare_data_structures(cursor, run_info, chrom = None, start = None, 
                             end = None, tmp_id = "1"):
     """ Initializes data structures needed for the run and organizes them
-        in a dictionary for more ease of use when passing them between functions
+        in a dictionary for more ease of use when passing them between functions.
+        The reference dicts are built by a single pass over the region (see
+        init_refs.make_region_structures), loaded from the reference pack
+        if the run has one, or layered on top of the shared reference arrays
+        if the run uses them (see shared_refs). The time taken to build each structure is 
+        recorded in the 'timings' field.
     """
     build = run_info.build
-    min_coverage = run_info.min_coverage
-    min_identity = run_info.min_identity
     struct_collection = dstruct.Struct()
 
-    struct_collection.tmp_gene = init_refs.make_temp_novel_gene_table(cursor, 
+    if run_info.get("shared_reference") and shared_reference != None and \
+       chrom != None:
+        region = shared_refs.make_overlay_structures(shared_reference, chrom,
+                                                     start, end)
+    elif run_info.get("reference_pack") != None and chrom != None:
+        region = refpack.load_region_structures(run_info.reference_pack, build,
+                                                chrom, start, end)
+    else:
+        region = init_refs.make_region_structures(cursor, build, chrom = chrom,
+                                                  start = start, end = end,
+                                                  tmp_id = tmp_id)
+    timings = region.timings
+
+    t0 = time.time()
+    if run_info.overlap_search == "sql":
+        struct_collection.tmp_gene = init_refs.make_temp_novel_gene_table(cursor, 
                                                         build, chrom = chrom, 
                                                     start = start, end = end, 
                                              tmp_tab = "temp_gene_" + tmp_id)
-    
-    struct_collection.tmp_monoexon = init_refs.make_temp_monoexonic_transcript_table(cursor, 
+    elif "genes" in region:
+        struct_collection.tmp_gene = dstruct.IntervalIndex(region.genes)
+    else:
+        struct_collection.tmp_gene = init_refs.make_novel_gene_index(cursor,
+                                                     build, chrom = chrom,
+                                                     start = start, end = end)
+    timings["tmp_gene"] = time.time() - t0
+
+    t0 = time.time()
+    if run_info.overlap_search == "sql":
+        struct_collection.tmp_monoexon = init_refs.make_temp_monoexonic_transcript_table(cursor, 
                                           build, chrom = chrom,
                                           start = start, end = end, 
                                           tmp_tab = "temp_monoexon_" + tmp_id)
-
-    location_dict = init_refs.make_location_dict(build, cursor, chrom = chrom, 
-                                                 start = start, end = end)
-
-    edge_dict = init_refs.make_edge_dict(cursor, build = build, chrom = chrom, 
-                                         start = start, end = end)
-
-    transcript_dict = init_refs.make_transcript_dict(cursor, build, chrom = chrom,
-                                           start = start, end = end)
-
-    vertex_2_gene = init_refs.make_vertex_2_gene_dict(cursor, build = build, 
-                                                      chrom = chrom, 
-                                                      start = start, end = end)
-
-    gene_starts = init_refs.make_gene_start_or_end_dict(cursor, 
-                                                        build, "start",
-                                                        chrom = chrom,
-                                                        start = start,
-                                                        end = end)   
-    gene_ends = init_refs.make_gene_start_or_end_dict(cursor,
-                                                      build, "end",
-                                                      chrom = chrom,
-                                                      start = start,
-                                                      end = end)
-
-    struct_collection.location_dict = location_dict
-    struct_collection.edge_dict = edge_dict
-    struct_collection.transcript_dict = transcript_dict
-    struct_collection.vertex_2_gene = vertex_2_gene 
-    struct_collection.gene_starts = gene_starts
-    struct_collection.gene_ends = gene_ends
+    else:
+        struct_collection.tmp_monoexon = dstruct.IntervalIndex(region.monoexons,
+                                                        start_key = 'min_pos',
+                                                        end_key = 'max_pos')
+    timings["tmp_monoexon"] = time.time() - t0 + timings.pop("monoexons")
+
+    struct_collection.location_dict = region.location_dict
+    struct_collection.edge_dict = region.edge_dict
+    struct_collection.transcript_dict = region.transcript_dict
+    struct_collection.vertex_2_gene = region.vertex_2_gene
+    struct_collection.gene_starts = region.gene_starts
+    struct_collection.gene_ends = region.gene_ends
+    struct_collection.timings = timings
 
     return struct_collection
 
@@ -1597,21 +1871,14 @@ def identify_monoexon_transcript(chrom, positions, strand, cursor, location_dict
     end = positions[-1]
     # First, look for a monoexonic transcript match that overlaps the current
     # transcript
-    query = Template(""" SELECT * 
-                    FROM $tmp_monoexon AS tm
-                    WHERE tm.chromosome = '$chrom'
-                    AND tm.strand = '$strand'
-                    AND ((min_pos <= $start AND max_pos >= $end)
-                      OR (min_pos >= $start AND max_pos <= $end)
-                      OR (min_pos >= $start AND min_pos <= $end)
-                      OR (max_pos >= $start AND max_pos <= $end))
-                    """).substitute({"tmp_monoexon": tmp_monoexon,
-                                     "chrom": chrom, "strand": strand, 
-                                     "start": min(start, end), 
-                                     "end": max(start, end)})
-                                    
-    cursor.execute(query)
-    matches = cursor.fetchall()
+    with profiling.stage("monoexon_overlap"):
+        if isinstance(tmp_monoexon, dstruct.IntervalIndex):
+            matches = tmp_monoexon.find_overlaps(chrom, min(start, end),
+                                                 max(start, end),
+                                                 strand = strand)
+        else:
+            matches = query_monoexon_table(chrom, start, end, strand, cursor,
+                                           tmp_monoexon)
 
     # If there is more than one match, apply a tiebreaker (pick the one with 
     # the most overlap
@@ -1636,7 +1903,8 @@ def identify_monoexon_transcript(chrom, positions, strand, cursor, location_dict
     # If there is no match, proceed to genomic/antisense style matching.
     else:
         # Start by performing vertex match               
-        vertex_IDs, v_novelty, diff_5p, diff_3p = match_monoexon_vertices(
+        with profiling.stage("vertex_matching"):
+            vertex_IDs, v_novelty, diff_5p, diff_3p = match_monoexon_vertices(
                                                                  chrom,
                                                                  positions,
                                                                  strand,
@@ -1644,13 +1912,15 @@ def identify_monoexon_transcript(chrom, positions, strand, cursor, location_dict
                                                                  run_info)
 
         # Get edge match (or create new edge)
-        edge_IDs, e_novelty = match_all_transcript_edges(vertex_IDs, strand,
-                                                     edge_dict, run_info)
+        with profiling.stage("edge_matching"):
+            edge_IDs, e_novelty = match_all_transcript_edges(vertex_IDs, strand,
+                                                         edge_dict, run_info)
 
         # If the exon is known, then this transcript must be ISM or NIC
         gene_ID = None
         if e_novelty[0] == 0:
-            all_matches = search_for_ISM(edge_IDs, transcript_dict)
+            with profiling.stage("ism_search"):
+                all_matches = search_for_ISM(edge_IDs, transcript_dict)
 
             if all_matches != None:
                 gene_ID, transcript_ID, transcript_novelty, info = process_ISM(chrom, positions, 
@@ -1735,12 +2005,18 @@ def identify_monoexon_transcript(chrom, positions, strand, cursor, location_dict
         new_mono = ( gene_ID, transcript_ID, chrom, start, end, strand, 
                      vertex_IDs[0], vertex_IDs[-1], edge_IDs[0],
                      min(start, end), max(start, end) )
-        cols = '("gene_ID", "transcript_ID", "chromosome", "start", "end",' + \
-                 '"strand", "start_vertex", "end_vertex", "exon_ID", "min_pos",' + \
-                  '"max_pos")'
-        command = 'INSERT INTO ' + tmp_monoexon + ' ' + cols + ' VALUES ' + \
-                  '(?,?,?,?,?,?,?,?,?,?,?)'
-        cursor.execute(command, new_mono)
+        if isinstance(tmp_monoexon, dstruct.IntervalIndex):
+            cols = ("gene_ID", "transcript_ID", "chromosome", "start", "end",
+                    "strand", "start_vertex", "end_vertex", "exon_ID",
+                    "min_pos", "max_pos")
+            tmp_monoexon.add(dict(zip(cols, new_mono)))
+        else:
+            cols = '("gene_ID", "transcript_ID", "chromosome", "start", "end",' + \
+                     '"strand", "start_vertex", "end_vertex", "exon_ID", "min_pos",' + \
+                      '"max_pos")'
+            command = 'INSERT INTO ' + tmp_monoexon + ' ' + cols + ' VALUES ' + \
+                      '(?,?,?,?,?,?,?,?,?,?,?)'
+            cursor.execute(command, new_mono)
 
     # Package annotation information
     annotations = dstruct.Struct()
@@ -1758,32 +2034,168 @@ def identify_monoexon_transcript(chrom, positions, strand, cursor, location_dict
 
     return annotations
 
-def update_database(database, batch_size, outfiles, datasets):
-    """ Adds new entries to the database. """
+def query_monoexon_table(chrom, start, end, strand, cursor, tmp_monoexon):
+    """ Fetch the transcripts in the temporary monoexon table that are on the
+        provided strand and overlap the interval. """
+
+    query = Template(""" SELECT *
+                    FROM $tmp_monoexon AS tm
+                    WHERE tm.chromosome = '$chrom'
+                    AND tm.strand = '$strand'
+                    AND ((min_pos <= $start AND max_pos >= $end)
+                      OR (min_pos >= $start AND max_pos <= $end)
+                      OR (min_pos >= $start AND min_pos <= $end)
+                      OR (max_pos >= $start AND max_pos <= $end))
+                    """).substitute({"tmp_monoexon": tmp_monoexon,
+                                     "chrom": chrom, "strand": strand,
+                                     "start": min(start, end),
+                                     "end": max(start, end)})
+
+    cursor.execute(query)
+    return cursor.fetchall()
+
+# Settings for bulk-load mode (see update_database). The page cache size is
+# in KiB. Secondary indexes of a table are rebuilt after the load instead of
+# being updated row by row when the load adds at least BULK_LOAD_DEFER_FRACTION
+# of the rows the table already has.
+BULK_LOAD_CACHE_KB = 262144
+BULK_LOAD_DEFER_FRACTION = 0.25
+
+def update_database(database, batch_size, outfiles, datasets, 
+                    bulk_load = False, staging_db = None, deep_validate = False):
+    """ Adds new entries to the database. If bulk_load is True, the update
+        runs as one explicit transaction with syncing off and a large page
+        cache, and the secondary indexes of the tables that receive many rows
+        are dropped for the load and rebuilt at the end (see begin_bulk_load).
+        If staging_db is provided, the new entries are copied from that
+        staging database (see staging) instead of being read from the
+        outfiles. In all modes, nothing is committed if the integrity check
+        fails. The check only covers the rows added by the update, unless
+        deep_validate is True (see check_database_integrity). """
 
     conn = sqlite3.connect(database)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    staged = staging_db != None
+    if staged:
+        cursor.execute("ATTACH DATABASE ? AS staging", (staging_db,))
+    if bulk_load:
+        deferred_indexes = begin_bulk_load(conn, outfiles, staged = staged)
 
-    batch_add_genes(cursor, outfiles.genes, batch_size)
-    batch_add_transcripts(cursor, outfiles.transcripts, batch_size) 
-    batch_add_edges(cursor, outfiles.edges, batch_size)
-    batch_add_locations(cursor, outfiles.location, batch_size)
-    batch_add_vertex2gene(cursor, outfiles.v2g, batch_size)
-    add_datasets(cursor, datasets)  
-    batch_add_observed(cursor, outfiles.observed, batch_size)
-    update_counter(cursor)
-    batch_add_annotations(cursor, outfiles.gene_annot, "gene", batch_size)
-    batch_add_annotations(cursor, outfiles.transcript_annot, "transcript",
-                          batch_size)
-    batch_add_annotations(cursor, outfiles.exon_annot, "exon", batch_size)
-
-    check_database_integrity(cursor)
-    conn.commit()
-    conn.close()
+    try:
+        prev_counters = get_counter_values(cursor)
+        with profiling.stage("db_structure_tables"):
+            if staged:
+                staging.merge_staged_tables(cursor, ["genes", "transcripts", 
+                                                     "edges", "location", "v2g"])
+            else:
+                batch_add_genes(cursor, outfiles.genes, batch_size)
+                batch_add_transcripts(cursor, outfiles.transcripts, batch_size) 
+                batch_add_edges(cursor, outfiles.edges, batch_size)
+                batch_add_locations(cursor, outfiles.location, batch_size)
+                batch_add_vertex2gene(cursor, outfiles.v2g, batch_size)
+        with profiling.stage("db_extents"):
+            update_extents(cursor, outfiles, staged = staged)
+        add_datasets(cursor, datasets)  
+        with profiling.stage("db_observed"):
+            if staged:
+                staging.merge_staged_tables(cursor, ["observed"])
+                staging.merge_staged_abundance(cursor)
+            else:
+                batch_add_observed(cursor, outfiles.observed, batch_size)
+        update_counter(cursor)
+        with profiling.stage("db_annotations"):
+            if staged:
+                staging.merge_staged_tables(cursor, ["gene_annot", 
+                                                     "transcript_annot",
+                                                     "exon_annot"])
+            else:
+                batch_add_annotations(cursor, outfiles.gene_annot, "gene", 
+                                      batch_size)
+                batch_add_annotations(cursor, outfiles.transcript_annot, 
+                                      "transcript", batch_size)
+                batch_add_annotations(cursor, outfiles.exon_annot, "exon", 
+                                      batch_size)
+
+        if bulk_load:
+            with profiling.stage("db_indexes"):
+                for name, sql in deferred_indexes:
+                    cursor.execute(sql)
+
+        with profiling.stage("db_integrity"):
+            check_database_integrity(cursor, prev_counters = prev_counters,
+                                     deep = deep_validate)
+        with profiling.stage("db_commit"):
+            conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
     return
- 
+
+def begin_bulk_load(conn, outfiles, staged = False):
+    """ Switches the connection to bulk-load settings and opens the
+        transaction that the update runs in:
+            - synchronous = OFF
+            - a page cache of BULK_LOAD_CACHE_KB
+            - temporary tables and index sorts kept in memory
+        The journal mode is left as it is. The load appends to the tables, and
+        the rollback journal only records pages that already existed, so it
+        stays small, while write-ahead logging would write every new page
+        twice. The rollback journal is what allows the load to be undone.
+        Then drops the secondary indexes of each table that the load adds at
+        least BULK_LOAD_DEFER_FRACTION of its current rows to, since
+        rebuilding them is cheaper than updating them row by row. Dropping
+        them is part of the transaction, so a rollback restores them.
+        The new rows are counted in the outfiles, or in the attached staging
+        database if staged is True. Returns the (name, sql) of each dropped
+        index.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA cache_size = -%d" % BULK_LOAD_CACHE_KB)
+    cursor.execute("PRAGMA temp_store = MEMORY")
+
+    # The transaction is managed explicitly from here on
+    conn.isolation_level = None
+    cursor.execute("BEGIN")
+
+    # Table -> outfile that its new rows come from
+    table_files = {"genes": "genes",
+                   "transcripts": "transcripts",
+                   "edge": "edges",
+                   "location": "location",
+                   "vertex": "v2g",
+                   "observed": "observed",
+                   "abundance": "observed",
+                   "gene_annotations": "gene_annot",
+                   "transcript_annotations": "transcript_annot",
+                   "exon_annotations": "exon_annot"}
+    n_new = {}
+    for table, key in table_files.items():
+        if staged:
+            n_new[table] = staging.count_staged_rows(cursor, key)
+        else:
+            with open(outfiles[key], 'r') as f:
+                n_new[table] = sum(1 for line in f)
+
+    deferred_indexes = []
+    cursor.execute("""SELECT name, tbl_name, sql FROM sqlite_master
+                      WHERE type = 'index' AND sql IS NOT NULL""")
+    for name, table, sql in cursor.fetchall():
+        if n_new.get(table, 0) == 0:
+            continue
+        # MAX(rowid) stands in for the row count without a table scan
+        cursor.execute("SELECT MAX(rowid) FROM %s" % table)
+        n_current = cursor.fetchone()[0] or 0
+        if n_new[table] >= BULK_LOAD_DEFER_FRACTION * n_current:
+            cursor.execute("DROP INDEX %s" % name)
+            deferred_indexes.append((name, sql))
+
+    return deferred_indexes
+
 def update_counter(cursor): #, n_datasets):
     """ Update the database counter using the global counter variables """
     
@@ -1830,6 +2242,32 @@ def batch_add_vertex2gene(cursor, v2g_file, batch_size):
                 sys.exit(1)
     return
 
+def update_extents(cursor, outfiles, staged = False):
+    """ Updates the stored extents of the genes that gained vertices in this
+        run (both novel genes and known genes with novel vertices) and adds
+        the extents of the novel transcripts. The IDs are read from the
+        outfiles, or from the attached staging database if staged is True.
+        Databases without extent tables are left as they are. """
+
+    if extent_utils.has_extents(cursor, "gene"):
+        if staged:
+            cursor.execute("SELECT DISTINCT gene_ID FROM staging.v2g")
+            gene_IDs = [ x[0] for x in cursor.fetchall() ]
+        else:
+            with open(outfiles.v2g, 'r') as f:
+                gene_IDs = set([ int(x.strip().split("\t")[1]) for x in f ])
+        extent_utils.update_gene_extents(cursor, gene_IDs)
+
+    if extent_utils.has_extents(cursor, "transcript"):
+        if staged:
+            cursor.execute("SELECT transcript_ID FROM staging.transcripts")
+            transcript_IDs = [ x[0] for x in cursor.fetchall() ]
+        else:
+            with open(outfiles.transcripts, 'r') as f:
+                transcript_IDs = [ int(x.strip().split("\t")[0]) for x in f ]
+        extent_utils.update_transcript_extents(cursor, transcript_IDs)
+    return
+
 def batch_add_locations(cursor, location_file, batch_size):
     """ Add new locations to database """
 
@@ -2059,8 +2497,29 @@ def batch_add_abundance(cursor, entries, batch_size):
             sys.exit(1)
     return 
 
-def check_database_integrity(cursor):
-    """ Perform some checks on the database. Run before committing changes"""
+# Counter category -> (table, ID column) compared by check_database_integrity
+COUNTER_TABLES = {"genes": ("genes", "gene_ID"),
+                  "transcripts": ("transcripts", "transcript_ID"),
+                  "vertex": ("location", "location_ID"),
+                  "edge": ("edge", "edge_ID"),
+                  "genome_build": ("genome_build", "build_ID"),
+                  "dataset": ("dataset", "dataset_ID"),
+                  "observed": ("observed", "obs_ID")}
+
+def get_counter_values(cursor):
+    """ Returns a dict of the counter values stored in the database """
+
+    cursor.execute("SELECT category, count FROM counters")
+    return dict([ (category, int(count)) for category, count in cursor.fetchall() ])
+
+def check_database_integrity(cursor, prev_counters = None, deep = False):
+    """ Perform some checks on the database. Run before committing changes.
+        If the counter values from before the update are provided, only the
+        rows added by the update are checked: for each category, the
+        highest ID must equal the counter, and the IDs above the previous
+        counter value must account for exactly the new rows. Both are
+        answered from the primary key index. Otherwise, or if deep is True,
+        every table is counted in full and compared with its counter. """
 
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     print("[ %s ] Validating database........" % (ts))
@@ -2071,24 +2530,40 @@ def check_database_integrity(cursor):
     counters = cursor.fetchall()
     fail = 0
 
-    for table_name, curr_counter in counters:
+    for category, curr_counter in counters:
         curr_counter = int(curr_counter)
+        table_name, ID_col = COUNTER_TABLES.get(category, (category, "rowid"))
+
+        if deep or prev_counters == None:
+            query = "select COUNT(*) from " + table_name
+            cursor.execute(query)
+            actual_count = int(cursor.fetchone()[0])
+
+            if actual_count != curr_counter:
+                fail = 1
+                print("Database counter for '" + table_name + \
+                      "' does not match the number of entries in the table." + \
+                      " Discarding changes to database and exiting...")
+                print("table_count: "  + str(actual_count))
+                print("counter_value: " + str(curr_counter))
+            continue
 
-        # Vertex case needs to be handled differently
-        if table_name == "vertex":
-            table_name = "location"
-
-        query = "select COUNT(*) from " + table_name
-        cursor.execute(query)
-        actual_count = int(cursor.fetchone()[0])
+        prev_counter = prev_counters.get(category, 0)
+        cursor.execute("SELECT MAX(%s) FROM %s" % (ID_col, table_name))
+        max_ID = cursor.fetchone()[0] or 0
+        cursor.execute("SELECT COUNT(*) FROM %s WHERE %s > ?" % \
+                       (table_name, ID_col), (prev_counter,))
+        n_new = cursor.fetchone()[0]
 
-        if actual_count != curr_counter:
+        if max_ID != curr_counter or n_new != curr_counter - prev_counter:
             fail = 1
             print("Database counter for '" + table_name + \
-                  "' does not match the number of entries in the table." + \
+                  "' does not match the entries added to the table." + \
                   " Discarding changes to database and exiting...")
-            print("table_count: "  + str(actual_count))
+            print("max_ID: " + str(max_ID))
+            print("new_entries: " + str(n_new))
             print("counter_value: " + str(curr_counter))
+            print("previous_counter_value: " + str(prev_counter))
 
     if fail == 1:
         raise RuntimeError("Discrepancy found in database. " + \
@@ -2096,116 +2571,181 @@ def check_database_integrity(cursor):
 
     return
 
-
 def parallel_talon(read_file, interval, database, run_info, queue):
     """ Manage TALON processing of a single chunk of the input. Initialize
         reference data structures covering only the provided interval region,
-        then send the read file to the annotation step. Once annotation is 
-        complete, return the data tuples generated so that they can be 
-        added to the database, OR alternately, pickle them and write to file
-        where they can be accessed later. """
+        then fetch the reads that start in the interval from the indexed read
+        file and send them to the annotation step. read_file may also be a
+        list of (file, dataset) pairs of sorted and indexed inputs, which are
+        merged on the fly. Output lines are
+        either sent to the listener via the queue, or, if queue is None,
+        written to buffered shard files for this interval. In the latter case,
+        the function returns a dict mapping each outfile to its shard. 
+        If run_info.profile is set, the time spent in each stage is written
+        to a report for the interval (see profiling). """
 
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     print("[ %s ] Annotating reads in interval %s:%d-%d..." % \
           (ts, interval[0], interval[1], interval[2]))
 
+    interval_id = "%s_%d_%d" % interval
+    if run_info.get("profile"):
+        profiling.enable()
+    if queue is None:
+        queue = ShardWriter(run_info.outfiles, interval_id,
+                            run_info.tmp_dir + "shards/")
+
     with sqlite3.connect(database) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
+        # Reads may be matched to vertices up to the cutoff distance away,
+        # so load the reference for a slightly larger region
+        pad = max(run_info.cutoff_5p, run_info.cutoff_3p)
         tmp_id = str(os.getpid())
-        struct_collection = prepare_data_structures(cursor, run_info,
+        with profiling.stage("reference_loading"):
+            struct_collection = prepare_data_structures(cursor, run_info,
                                                     chrom = interval[0], 
-                                                    start = interval[1], 
-                                                    end = interval[2], 
+                                                    start = max(interval[1] - pad, 0),
+                                                    end = interval[2] + pad,
                                                     tmp_id = tmp_id)
-         
-        interval_id = "%s_%d_%d" % interval
-
-        with pysam.AlignmentFile(read_file, "rb") as sam:
-            for record in sam:  # type: pysam.AlignedSegment
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        print("[ %s ] Loaded reference for interval %s:%d-%d (%s)" % \
+              (ts, interval[0], interval[1], interval[2],
+               ", ".join([ "%s: %.2fs" % item for item in 
+                           struct_collection.timings.items() ])))
+
+        # Reads with the same structure can share one annotation
+        collapse_cache = {} if run_info.get("collapse_reads") else None
+        n_reads = 0
+        n_annotated = 0
+        n_reused = 0
+
+        with ExitStack() as stack:
+            if isinstance(read_file, str):
+                sam = stack.enter_context(pysam.AlignmentFile(read_file, "rb"))
+                reads = procsams.fetch_interval_reads(sam, interval)
+            else:
+                reads = procsams.fetch_merged_interval_reads(read_file, interval)
+            for record in reads:  # type: pysam.AlignedSegment
+                n_reads += 1
                 # Check whether we should try annotating this read or not
-                qc_metrics = tutils.check_read_quality(record, run_info)
+                with profiling.stage("qc"):
+                    qc_metrics = tutils.check_read_quality(record, run_info)
 
                 passed_qc = qc_metrics[2]
                 qc_msg = (run_info.outfiles.qc, "\t".join([str(x) for x in qc_metrics]))
-                queue.put(qc_msg)
+                with profiling.stage("output"):
+                    queue.put(qc_msg)
 
                 if passed_qc:
-                    annotation_info = annotate_read(record, cursor, run_info, 
-                                                    struct_collection)
-                    unpack_observed(annotation_info, queue, 
+                    n_annotated += 1
+                    with profiling.stage("annotation"):
+                        annotation_info = annotate_read(record, cursor, run_info, 
+                                                    struct_collection,
+                                                    collapse_cache = collapse_cache)
+                    n_reused += annotation_info.reused
+
+                    with profiling.stage("output"):
+                        unpack_observed(annotation_info, queue, 
                                                   run_info.outfiles.observed)
                     
-                    # Update annotation records
-                    # TODO: there is no need for entry to be a list/tuple
-                    for entry in annotation_info.gene_novelty:
-                        msg = (run_info.outfiles.gene_annot, 
-                               "\t".join([str(x) for x in entry]))
-                        queue.put(msg)
-                    for entry in annotation_info.transcript_novelty:
-                        msg = (run_info.outfiles.transcript_annot,
-                               "\t".join([str(x) for x in entry]))
-                        queue.put(msg)
-                    for entry in annotation_info.exon_novelty:
-                        msg = (run_info.outfiles.exon_annot,
-                               "\t".join([str(x) for x in entry]))
-                        queue.put(msg)
-
-        # Write the temp_gene table to file
-        cursor.execute("SELECT gene_ID, strand FROM " + struct_collection.tmp_gene)
-        for row in cursor.fetchall():
-            msg = ((run_info.outfiles.genes, str(row['gene_ID'])+"\t"+ row['strand']))
-            queue.put(msg)
+                        # Update annotation records
+                        # TODO: there is no need for entry to be a list/tuple
+                        for entry in annotation_info.gene_novelty:
+                            msg = (run_info.outfiles.gene_annot, 
+                                   "\t".join([str(x) for x in entry]))
+                            queue.put(msg)
+                        for entry in annotation_info.transcript_novelty:
+                            msg = (run_info.outfiles.transcript_annot,
+                                   "\t".join([str(x) for x in entry]))
+                            queue.put(msg)
+                        for entry in annotation_info.exon_novelty:
+                            msg = (run_info.outfiles.exon_annot,
+                                   "\t".join([str(x) for x in entry]))
+                            queue.put(msg)
+
+        if collapse_cache != None and n_annotated > 0:
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            print(("[ %s ] Annotated %d reads in interval %s:%d-%d, %d of "
+                   "them from the annotation of an identical read "
+                   "(collapse ratio: %.2f)") % \
+                  (ts, n_annotated, interval[0], interval[1], interval[2],
+                   n_reused, n_annotated/(n_annotated - n_reused)))
+
+        with profiling.stage("novel_output"):
+            # Write the temp_gene table to file
+            if isinstance(struct_collection.tmp_gene, dstruct.IntervalIndex):
+                gene_rows = struct_collection.tmp_gene.entries()
+            else:
+                cursor.execute("SELECT gene_ID, strand FROM " + struct_collection.tmp_gene)
+                gene_rows = cursor.fetchall()
+            for row in gene_rows:
+                msg = ((run_info.outfiles.genes, str(row['gene_ID'])+"\t"+ row['strand']))
+                queue.put(msg)
 
     # Pass messages to output files
     # ========================================================================
-    # Write new transcripts to file
-    transcripts = struct_collection.transcript_dict
-    for transcript in list(transcripts.values()):
-        # Only write novel transcripts to file
-        if type(transcript) is dict:
-            entry = "\t".join([ str(x) for x in ( transcript['transcript_ID'],
-                                                 transcript['gene_ID'],
-                                                 transcript['start_exon'],
-                                                 transcript['jn_path'],
-                                                 transcript['end_exon'],
-                                                 transcript['start_vertex'],
-                                                 transcript['end_vertex'],
-                                                 transcript['n_exons'] ) ])
-            queue.put((run_info.outfiles.transcripts, entry))
-
-    # Write new edges to file
-    edges = struct_collection.edge_dict
-    for edge in list(edges.values()):
-        if type(edge) is dict:
-            entry = "\t".join([str(x) for x in [edge['edge_ID'], edge['v1'],
-                                                edge['v2'], edge['edge_type'],
-                                                edge['strand']]] )
-            queue.put((run_info.outfiles.edges, entry))
-
-    # Write locations to file
-    location_dict = struct_collection.location_dict
-    for chrom_dict in location_dict.values():
-        for loc in list(chrom_dict.values()):
-            if type(loc) is dict:
-                msg = (run_info.outfiles.location,
-                       "\t".join([ str(x) for x in (loc['location_ID'],
-                                                    loc['genome_build'],
-                                                    loc['chromosome'],
-                                                    loc['position'])]))
+    with profiling.stage("novel_output"):
+        # Write new transcripts to file
+        transcripts = struct_collection.transcript_dict
+        for transcript in list(transcripts.values()):
+            # Only write novel transcripts to file
+            if type(transcript) is dict:
+                entry = "\t".join([ str(x) for x in ( transcript['transcript_ID'],
+                                                     transcript['gene_ID'],
+                                                     transcript['start_exon'],
+                                                     transcript['jn_path'],
+                                                     transcript['end_exon'],
+                                                     transcript['start_vertex'],
+                                                     transcript['end_vertex'],
+                                                     transcript['n_exons'] ) ])
+                queue.put((run_info.outfiles.transcripts, entry))
+
+        # Write new edges to file
+        edges = struct_collection.edge_dict
+        for edge in list(edges.values()):
+            if type(edge) is dict:
+                entry = "\t".join([str(x) for x in [edge['edge_ID'], edge['v1'],
+                                                    edge['v2'], edge['edge_type'],
+                                                    edge['strand']]] )
+                queue.put((run_info.outfiles.edges, entry))
+
+        # Write locations to file
+        location_dict = struct_collection.location_dict
+        for chrom_dict in location_dict.values():
+            for loc in list(chrom_dict.values()):
+                if type(loc) is dict:
+                    msg = (run_info.outfiles.location,
+                           "\t".join([ str(x) for x in (loc['location_ID'],
+                                                        loc['genome_build'],
+                                                        loc['chromosome'],
+                                                        loc['position'])]))
+                    queue.put(msg)
+
+        # Write new vertex-gene combos to file
+        for vertex_ID, gene_set in struct_collection.vertex_2_gene.items():
+            for gene in gene_set:
+                msg = (run_info.outfiles.v2g, 
+                       "\t".join([ str(x) for x in (vertex_ID, gene[0])]))
                 queue.put(msg)
 
-    # Write new vertex-gene combos to file
-    for vertex_ID, gene_set in struct_collection.vertex_2_gene.items():
-        for gene in gene_set:
-            msg = (run_info.outfiles.v2g, 
-                   "\t".join([ str(x) for x in (vertex_ID, gene[0])]))
-            queue.put(msg)
-
     struct_collection = None
- 
-    return
+
+    if isinstance(queue, ShardWriter):
+        with profiling.stage("output"):
+            shards = queue.close()
+    else:
+        shards = None
+
+    if run_info.get("profile"):
+        profiling.write_report(profiling.report_path(run_info.tmp_dir,
+                                                     interval_id),
+                               interval = "%s:%d-%d" % interval,
+                               reads = n_reads, annotated = n_annotated,
+                               reused = n_reused)
+        profiling.disable()
+    return shards
 
 def parse_custom_SAM_tags(sam_record: pysam.AlignedSegment):
     """ Looks for the following tags in the read. Will be set to None if no tag
@@ -2240,10 +2780,18 @@ def parse_custom_SAM_tags(sam_record: pysam.AlignedSegment):
     return fraction_As, custom_label, allelic_label, start_support, end_support
 
 def annotate_read(sam_record: pysam.AlignedSegment, cursor, run_info, 
-                  struct_collection, mode = 1):            
+                  struct_collection, mode = 1, collapse_cache = None):            
     """ Accepts a pysam-formatted read as input, and compares it to the 
         annotations in struct_collection to assign it a gene and transcript
-        identity. Returns annotation_info, which is a dict that has the 
+        identity. If a collapse_cache dict is provided, the result is stored
+        in it under the structure of the read (chromosome, strand, and the
+        start, splice sites, and end), and later reads with the same
+        structure reuse it instead of being annotated again. A stored result
+        is only valid as long as the structures it was matched against stay
+        the same, so the cache is emptied whenever a read creates a novel
+        vertex, edge, gene, or transcript (e.g. a closer vertex for the ends
+        of the cached reads), and the result of that read is not stored.
+        Returns annotation_info, which is a dict that has the 
         following attributes:
             gene_ID
             transcript_ID
@@ -2261,6 +2809,7 @@ def annotate_read(sam_record: pysam.AlignedSegment, cursor, run_info,
             allelic_label
             start_support
             end_support
+            reused (True if the result was taken from the collapse_cache)
     """
     # Parse attributes to determine the chromosome, positions, and strand of the transcript
     read_ID = sam_record.query_name
@@ -2270,18 +2819,18 @@ def annotate_read(sam_record: pysam.AlignedSegment, cursor, run_info,
     sam_start = sam_record.reference_start + mode 
     sam_end = sam_record.reference_end
     read_length = sam_record.query_alignment_length 
-    cigar = sam_record.cigarstring
 
     # Parse custom TALON tags
     fraction_As, custom_label, allelic_label, start_support, \
     end_support = parse_custom_SAM_tags(sam_record)
 
-    intron_list = tutils.get_introns(sam_record, sam_start, cigar)
+    with profiling.stage("read_parsing"):
+        intron_list = tutils.get_read_introns(sam_record, sam_start)
 
-    # Adjust intron positions by 1 to get splice sites in exon terms
-    splice_sites = [x + 1 if i % 2 == 1 else x - 1 for i, x in
-                    enumerate(intron_list)]
-    positions = [sam_start] + splice_sites + [sam_end]
+        # Adjust intron positions by 1 to get splice sites in exon terms
+        splice_sites = [x + 1 if i % 2 == 1 else x - 1 for i, x in
+                        enumerate(intron_list)]
+        positions = [sam_start] + splice_sites + [sam_end]
 
     # Flip the positions' order if the read is on the minus strand
     if strand == "-":
@@ -2296,23 +2845,36 @@ def annotate_read(sam_record: pysam.AlignedSegment, cursor, run_info,
     gene_ends = struct_collection.gene_ends
 
     n_exons = int(len(positions)/2)
-    if n_exons > 1:
-        annotation_info = identify_transcript(chrom, positions, strand,
-                                              cursor, location_dict,
-                                              edge_dict, transcript_dict,
-                                              vertex_2_gene,
-                                              gene_starts, gene_ends,
-                                              run_info, 
-                                              struct_collection.tmp_gene)
+    structure = (chrom, strand, tuple(positions))
+    reused = collapse_cache != None and structure in collapse_cache
+    n_created_before = n_created
+    if reused:
+        annotation_info = dstruct.Struct(**collapse_cache[structure])
+    elif n_exons > 1:
+        with profiling.stage("identify_transcript"):
+            annotation_info = identify_transcript(chrom, positions, strand,
+                                                  cursor, location_dict,
+                                                  edge_dict, transcript_dict,
+                                                  vertex_2_gene,
+                                                  gene_starts, gene_ends,
+                                                  run_info, 
+                                                  struct_collection.tmp_gene)
     else:
-        annotation_info = identify_monoexon_transcript(chrom, positions, strand,
-                                          cursor, location_dict,
+        with profiling.stage("identify_monoexon"):
+            annotation_info = identify_monoexon_transcript(chrom, positions,
+                                          strand, cursor, location_dict,
                                           edge_dict, transcript_dict,
                                           vertex_2_gene,
                                           gene_starts, gene_ends,
                                           run_info, struct_collection.tmp_gene,
                                           struct_collection.tmp_monoexon)
+    if collapse_cache != None and not reused:
+        if n_created != n_created_before:
+            collapse_cache.clear()
+        else:
+            collapse_cache[structure] = dstruct.Struct(**annotation_info)
     
+    annotation_info.reused = reused
     annotation_info.read_ID = read_ID
     annotation_info.dataset = dataset
     annotation_info.location = "%s:%d-%d" % (chrom, sam_start, sam_end)
@@ -2377,6 +2939,116 @@ def listener(queue, outfiles, QC_header, timeout = 72):
         open_files[msg_fname].write(msg_value + "\n")
         open_files[msg_fname].flush()
 
+def run_interval_job(job):
+    """ Runs parallel_talon on an (interval index, job arguments) pair and
+        returns the index along with the shards, so that jobs finishing out
+        of order can be matched up with their interval. """
+    index, args = job
+    return index, parallel_talon(*args)
+
+def merge_shard_files(outfiles, shard_groups, QC_header, fpaths = None):
+    """ Concatenate the shard files written by each worker into the run-level
+        outfiles, one interval after the other. shard_groups is a list of
+        dicts (one per interval) mapping outfile paths to shard paths. If
+        fpaths is provided, only those outfiles are merged. """
+
+    if fpaths == None:
+        fpaths = outfiles.values()
+    for fpath in fpaths:
+        with open(fpath, 'w') as out:
+            if fpath == outfiles.qc:
+                out.write(QC_header + "\n")
+            for shards in shard_groups:
+                with open(shards[fpath], 'r') as shard:
+                    shutil.copyfileobj(shard, out, 1048576)
+                os.remove(shards[fpath])
+    return
+
+def compact_IDs(outfiles, run_info, staging_db = None):
+    """ When IDs were leased to the workers in blocks (see BlockCounter),
+        the unused end of each block leaves a gap in the novel IDs. This
+        function renumbers the gene, transcript, vertex, edge, and observed
+        IDs in the outfiles so that they are consecutive again, and sets the
+        counters to match. Gene and transcript names derived from the IDs
+        are regenerated as well. If staging_db is provided, the staged rows
+        of a pipelined run are renumbered instead of the outfiles. """
+
+    if staging_db == None:
+        def read_IDs(fname):
+            with open(fname, 'r') as f:
+                for line in f:
+                    yield int(line.split("\t", 1)[0])
+    else:
+        conn = sqlite3.connect(staging_db)
+        staged_keys = dict([ (fpath, key) for key, fpath in outfiles.items() ])
+        def read_IDs(fname):
+            return staging.staged_IDs(conn.cursor(), staged_keys[fname])
+
+    gene = gene_counter.compact(read_IDs(outfiles.genes))
+    transcript = transcript_counter.compact(read_IDs(outfiles.transcripts))
+    vertex = vertex_counter.compact(read_IDs(outfiles.location))
+    edge = edge_counter.compact(read_IDs(outfiles.edges))
+    observed = observed_counter.compact(read_IDs(outfiles.observed))
+
+    def edge_path(jn_path):
+        if jn_path == "None":
+            return jn_path
+        return ",".join([ str(edge(x)) for x in jn_path.split(",") ])
+
+    def transcript_list(IDs):
+        return ",".join([ str(transcript(x)) for x in IDs.split(",") ])
+
+    def gene_annot(row):
+        if row[3] == "gene_antisense_to_IDs":
+            row[4] = str(gene(row[4]))
+        elif row[3] in ["gene_name", "gene_id"]:
+            row[4] = construct_names(row[0], 0, row[1], run_info.n_places)[0]
+        return row
+
+    def transcript_annot(row):
+        if row[3] in ["ISM_to_IDs", "ISM-prefix_to_IDs", "ISM-suffix_to_IDs"]:
+            row[4] = transcript_list(row[4])
+        elif row[3] in ["transcript_name", "transcript_id"]:
+            row[4] = construct_names(0, row[0], row[1], run_info.n_places)[1]
+        return row
+
+    # Outfile -> (column -> remap function, function applied to whole row)
+    ID_columns = {
+        outfiles.genes: ({0: gene}, None),
+        outfiles.transcripts: ({0: transcript, 1: gene, 2: edge, 3: edge_path,
+                                4: edge, 5: vertex, 6: vertex}, None),
+        outfiles.edges: ({0: edge, 1: vertex, 2: vertex}, None),
+        outfiles.v2g: ({0: vertex, 1: gene}, None),
+        outfiles.location: ({0: vertex}, None),
+        outfiles.observed: ({0: observed, 1: gene, 2: transcript, 5: vertex,
+                             6: vertex, 7: edge, 8: edge}, None),
+        outfiles.gene_annot: ({0: gene}, gene_annot),
+        outfiles.transcript_annot: ({0: transcript}, transcript_annot),
+        outfiles.exon_annot: ({0: edge}, None) }
+
+    def remap_row(row, columns, row_fn):
+        for i, remap in columns.items():
+            row[i] = remap(row[i])
+        if row_fn != None:
+            row = row_fn(row)
+        return row
+
+    for fname, (columns, row_fn) in ID_columns.items():
+        if staging_db != None:
+            staging.rewrite_staged_table(conn, staged_keys[fname],
+                lambda row: remap_row(row, columns, row_fn))
+            continue
+        with open(fname, 'r') as f, open(fname + ".compact", 'w') as out:
+            for line in f:
+                row = remap_row(line.rstrip("\n").split("\t"), columns, row_fn)
+                out.write("\t".join([ str(x) for x in row ]) + "\n")
+        os.replace(fname + ".compact", fname)
+
+    if staging_db != None:
+        conn.commit()
+        conn.close()
+    return
+
 def make_QC_header(coverage, identity, length):
     """ Create a header for the read QC file """
    
@@ -2408,13 +3080,47 @@ def main():
     min_identity = float(options.min_identity)
     outprefix = options.outprefix
 
+    # The workers start their own profilers for each interval
+    if options.profile:
+        profiling.enable()
+
     # Set globally accessible counters
-    get_counters(database)
+    get_counters(database, block_size = options.id_block_size)
+
+    # Use the reference pack if there is one that matches the database
+    pack_dir = options.reference_pack
+    if pack_dir == None and os.path.isdir(refpack.default_path(database, build)):
+        pack_dir = refpack.default_path(database, build)
+    if pack_dir != None:
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        if refpack.is_current(pack_dir, database, build):
+            print("[ %s ] Loading reference structures from %s" % (ts, pack_dir))
+        else:
+            print(("[ %s ] Reference pack %s does not match the database. "
+                   "Loading reference structures from the database.") % \
+                   (ts, pack_dir))
+            pack_dir = None
+
+    # The shared reference has to exist before the workers are forked
+    if options.shared_reference:
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        if mp.get_start_method() == "fork":
+            print("[ %s ] Building shared reference structures" % (ts))
+            with profiling.stage("shared_reference"):
+                init_shared_reference(database, build, pack_dir = pack_dir)
+        else:
+            print(("[ %s ] Shared reference structures need the 'fork' start "
+                   "method. Each worker will load its own.") % (ts))
 
     # Initialize worker pool
     with mp.Pool(processes=threads) as pool:
         run_info = init_run_info(database, build, min_coverage, min_identity)
         run_info.outfiles = init_outfiles(options.outprefix)
+        run_info.overlap_search = options.overlap_search
+        run_info.reference_pack = pack_dir
+        run_info.shared_reference = shared_reference != None
+        run_info.collapse_reads = options.collapse_reads
+        run_info.profile = options.profile
 
         # Create annotation entry for each dataset
         datasets = []
@@ -2425,51 +3131,156 @@ def main():
             dataset_db_entries.append((d_id, d_name, description, platform))
 
         # Partition the reads
-        read_groups, intervals, header_file = procsams.partition_reads(sam_files, datasets)
-        read_files = procsams.write_reads_to_file(read_groups, intervals, header_file)
+        n_intervals = options.n_intervals
+        if n_intervals == None and options.reads_per_interval == None:
+            n_intervals = 4*threads
+        gene_spans = None
+        if options.partition == "locus":
+            with sqlite3.connect(database) as conn:
+                conn.row_factory = sqlite3.Row
+                gene_spans = init_refs.make_gene_span_dict(conn.cursor(), build)
+        # Sorted and indexed inputs are read directly. Otherwise, they are 
+        # sorted and merged into one file first.
+        if all([ procsams.is_sorted_and_indexed(x) for x in sam_files ]):
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            print("[ %s ] Input files are sorted and indexed" % (ts))
+            interval_files = sam_files
+            read_files = list(zip(sam_files, datasets))
+        else:
+            read_files = procsams.preprocess_sam(sam_files, datasets)
+            interval_files = [read_files]
+        with profiling.stage("partitioning"):
+            intervals, n_reads = procsams.get_read_intervals(interval_files,
+                            by_locus = options.partition == "locus",
+                            min_gap = max(run_info.cutoff_5p, run_info.cutoff_3p),
+                            gene_spans = gene_spans,
+                            reads_per_interval = options.reads_per_interval,
+                            n_intervals = n_intervals)
         ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-        print("[ %s ] Split reads into %d intervals" % (ts, len(read_groups)))
+        print("[ %s ] Split reads into %d intervals" % (ts, len(intervals)))
 
-        # Set up a queue specifically for writing to outfiles
-        manager = mp.Manager()
-        queue = manager.Queue()
+        QC_header = make_QC_header(run_info.min_coverage, run_info.min_identity, 
+                                   run_info.min_length)
 
-        # Create job tuples to submit
+        # Unless the queue was requested, each worker writes its own shards
+        queue = None
+        if options.use_queue:
+            manager = mp.Manager()
+            queue = manager.Queue()
+
+        # In a pipelined run, the shards of each finished interval are staged
+        # by a writer process while the other intervals are annotated
+        staging_db = None
+        if options.pipeline and options.use_queue:
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            print(("[ %s ] The pipelined update needs the worker shards, so "
+                   "it is not available with --use_queue. The database will "
+                   "be updated after the run.") % (ts))
+        elif options.pipeline:
+            staging_db = os.path.join(os.path.dirname(run_info.outfiles.genes),
+                                      "staging.db")
+            staging.create_staging_db(staging_db, database)
+            staging_queue = mp.Queue()
+            writer = mp.Process(target = staging.writer,
+                                args = (staging_queue, staging_db,
+                                        run_info.outfiles),
+                                daemon = True)
+            writer.start()
+
+        # Create job tuples to submit. The largest intervals go first so that
+        # a big one doesn't end up running on its own at the end.
         jobs = []
-        for read_file, interval in zip(read_files, intervals):
-            jobs.append((read_file, interval, database, run_info, queue))
+        for interval in intervals:
+            jobs.append((read_files, interval, database, run_info, queue))
+        job_order = sorted(range(len(jobs)), 
+                           key = lambda i: n_reads[i], reverse = True)
 
         ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
         print("[ %s ] Launching parallel annotation jobs" % (ts))
 
         # Start running listener, which will monitor queue for messages
-        QC_header = make_QC_header(run_info.min_coverage, run_info.min_identity, 
-                                   run_info.min_length)
-        pool.apply_async(listener, (queue, run_info.outfiles, QC_header)) 
-
-        # Now launch the parallel TALON jobs
-        pool.starmap(parallel_talon, jobs)
+        if options.use_queue:
+            pool.apply_async(listener, (queue, run_info.outfiles, QC_header)) 
+
+        # Now launch the parallel TALON jobs, and put the shards back in 
+        # genomic order
+        shard_groups = [None]*len(jobs)
+        with profiling.stage("annotation"):
+            if staging_db != None:
+                for i, shards in pool.imap_unordered(run_interval_job,
+                                                     [ (i, jobs[i]) for i in job_order ],
+                                                     chunksize = 1):
+                    shard_groups[i] = shards
+                    staging_queue.put((i, shards))
+                staging_queue.put(None)
+            else:
+                results = pool.starmap(parallel_talon, 
+                                       [ jobs[i] for i in job_order ],
+                                       chunksize = 1)
+                for i, shards in zip(job_order, results):
+                    shard_groups[i] = shards
 
         # Now we are done, kill the listener
-        msg_done = (None, 'complete')
-        queue.put(msg_done)
+        if options.use_queue:
+            msg_done = (None, 'complete')
+            queue.put(msg_done)
         pool.close()
         pool.join()
 
+    if staging_db != None:
+        # The writer has staged and removed all but the QC and abundance shards
+        with profiling.stage("staging_wait"):
+            writer.join()
+        if writer.exitcode != 0:
+            raise RuntimeError("Staging the worker output failed. " + \
+                               "The database was not changed.")
+        with profiling.stage("merge_shards"):
+            merge_shard_files(run_info.outfiles, shard_groups, QC_header,
+                              fpaths = [ fpath for key, fpath in run_info.outfiles.items()
+                                         if key not in staging.STAGED_TABLES ])
+    elif not options.use_queue:
+        with profiling.stage("merge_shards"):
+            merge_shard_files(run_info.outfiles, shard_groups, QC_header)
+
+    # Remove the gaps left by leasing IDs in blocks
+    if options.id_block_size > 1:
+        with profiling.stage("compact_IDs"):
+            compact_IDs(run_info.outfiles, run_info, staging_db = staging_db)
+
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     print("[ %s ] All jobs complete. Starting database update." % (ts))
 
     # Update the database
     batch_size = 10000
-    update_database(database, batch_size, run_info.outfiles, dataset_db_entries)
+    with profiling.stage("db_update"):
+        update_database(database, batch_size, run_info.outfiles,
+                        dataset_db_entries, bulk_load = options.bulk_load,
+                        staging_db = staging_db,
+                        deep_validate = options.deep_validate)
+    if staging_db != None:
+        os.remove(staging_db)
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     print("[ %s ] Database update complete." % (ts))
 
     # Write output reads file
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     print("[ %s ] Creating read-wise annotation file." % (ts))
-    get_read_annotations.make_read_annot_file(database, build,  
-                                              outprefix, datasets = datasets)
+    with profiling.stage("read_annot_file"):
+        get_read_annotations.make_read_annot_file(database, build,  
+                                                  outprefix, datasets = datasets)
+
+    # Combine the stage timings of the intervals with those of the main process
+    if options.profile:
+        summary = profiling.merge_reports(
+                      [ profiling.report_path(run_info.tmp_dir, "%s_%d_%d" % x)
+                        for x in intervals ],
+                      driver_report = profiling.make_report(reads = sum(n_reads),
+                                                            threads = threads))
+        with open(outprefix + "_profile.json", 'w') as f:
+            json.dump(summary, f, indent = 2)
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        print("[ %s ] Wrote stage timings to %s_profile.json" % (ts, outprefix))
+        profiling.print_summary(summary)
 
     ## For debugging
     #print("Genes: %d" % gene_counter.value())
@@ -7,12 +7,19 @@ import itertools
 import re
 import pysam
 
+# CIGAR operations (as in pysam's integer cigartuples) that consume the
+# reference, and those that clip the read
+REF_CONSUMING_OPS = (pysam.CMATCH, pysam.CDEL, pysam.CREF_SKIP, pysam.CEQUAL,
+                     pysam.CDIFF)
+CLIPPING_OPS = (pysam.CSOFT_CLIP, pysam.CHARD_CLIP)
+
+MD_MATCHES = re.compile(r"[0-9]+")
+MD_DELETIONS = re.compile(r"\^[A-Za-z]+")
+
 def check_read_quality(sam_record: pysam.AlignedSegment, run_info):
     """ Process an individual sam read and return quality attributes. """
     read_ID = sam_record.query_name
     flag = sam_record.flag
-    cigar = sam_record.cigarstring
-    seq = sam_record.query
     read_length = sam_record.query_length
     dataset = sam_record.get_tag('RG')
  
@@ -32,8 +39,9 @@ def check_read_quality(sam_record: pysam.AlignedSegment, run_info):
 
     # Only use reads where alignment coverage and identity exceed
     # cutoffs
-    coverage = compute_alignment_coverage(cigar)
-    identity = compute_alignment_identity(md_tag, seq)
+    coverage = parse_cigar_tuples(sam_record.reference_start + 1,
+                                  sam_record.cigartuples)[0]
+    identity = compute_MD_identity(md_tag, sam_record.query_alignment_length)
 
     if coverage < run_info.min_coverage or \
        identity < run_info.min_identity:
@@ -58,6 +66,49 @@ def compute_alignment_coverage(CIGAR):
 
     return (total_bases - unaligned_bases)/total_bases
 
+def parse_cigar_tuples(start, cigar_tuples):
+    """ Computes the alignment coverage, end position, and introns of a read
+        in a single pass over its CIGAR operations, given as the integer
+        (operation, length) tuples that pysam provides in cigartuples. This
+        avoids parsing the CIGAR string of every read.
+        Args:
+            start: The start position of the transcript with respect to the
+            forward strand
+            cigar_tuples: pysam cigartuples of the read
+        Returns:
+            coverage: same as compute_alignment_coverage
+            end: position of the last aligned base in the reference genome
+            intron_list: intron starts and ends in a list (sorted order),
+            as in get_introns
+    """
+    total_bases = 0
+    unaligned_bases = 0
+    pos = start
+    intron_list = []
+    for op, ct in cigar_tuples:
+        if op == pysam.CREF_SKIP:
+            intron_list.append(pos)
+            intron_list.append(pos + ct - 1)
+        else:
+            total_bases += ct
+            if op in CLIPPING_OPS:
+                unaligned_bases += ct
+        if op in REF_CONSUMING_OPS:
+            pos += ct
+
+    return (total_bases - unaligned_bases)/total_bases, pos - 1, intron_list
+
+def compute_MD_identity(MD_tag, aligned_length):
+    """ Equivalent of compute_alignment_identity that takes the number of
+        aligned read bases (pysam's query_alignment_length) in place of the
+        aligned sequence, and finds the matches and deletions in the MD tag
+        with regular expressions instead of splitting it. """
+
+    matches = sum(map(int, MD_MATCHES.findall(MD_tag)))
+    deleted = sum(len(x) - 1 for x in MD_DELETIONS.findall(MD_tag))
+
+    return matches/(aligned_length + deleted)
+
 def compute_alignment_identity(MD_tag, SEQ):
     """ This function computes what fraction of the read matches the reference
         genome."""
@@ -165,7 +216,7 @@ def compute_jI(start, cigar):
             jI.append(str(intronStart))
             jI.append(str(intronEnd))
 
-        if op not in ["S", "I"]:
+        if op in ["M", "D", "N", "=", "X"]:
             genomePos += ct
 
     # If the transcript has no introns, add -1 to the tag
@@ -204,3 +255,11 @@ def get_introns(sam_record: pysam.AlignedSegment, start, cigar):
         return []
     else:
         return intron_list
+
+def get_read_introns(sam_record: pysam.AlignedSegment, start):
+    """ Same as get_introns, but if the read has no jI field, the introns
+        are computed from its integer CIGAR tuples (see parse_cigar_tuples)
+        instead of the CIGAR string. """
+    if sam_record.has_tag("jI"):
+        return get_introns(sam_record, start, None)
+    return parse_cigar_tuples(start, sam_record.cigartuples)[2]
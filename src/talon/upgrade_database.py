@@ -0,0 +1,81 @@
+# TALON: Techonology-Agnostic Long Read Analysis Pipeline
+# -----------------------------------------------------------------------------
+# Brings an existing TALON database up to date with the current
+# talon_initialize_database layout without changing its contents. At present
+# this adds the secondary indexes that newer databases are created with and
+# refreshes the query planner statistics (ANALYZE).
+# ---------------------------------------------------------------------
+# get_schema_version
+# upgrade_database
+
+import argparse
+import os
+import sqlite3
+import time
+from . import initialize_talon_database as init_db
+from . import extent_utils
+
+SUPPORTED_VERSIONS = ["v5.0"]
+
+def get_args():
+    """ Fetches the arguments for the program """
+
+    program_desc = """Adds the gene and transcript extents and the indexes of
+                      the current database layout to an existing TALON
+                      database and updates its query planner statistics."""
+    parser = argparse.ArgumentParser(description=program_desc)
+    parser.add_argument('--db', dest = 'database', metavar='FILE,', type = str,
+        help='TALON database to upgrade. Created using talon_initialize_database')
+
+    return parser.parse_args()
+
+def get_schema_version(database):
+    """ Returns the schema version recorded in the run_info table """
+
+    with sqlite3.connect(database) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT value FROM run_info
+                          WHERE item = 'schema_version'""")
+        return cursor.fetchone()[0]
+
+def upgrade_database(database):
+    """ Adds the missing gene and transcript extent tables and indexes to
+        the database, then runs ANALYZE. Returns the names of the tables and
+        indexes that were added. """
+
+    if not os.path.isfile(database):
+        raise ValueError("Database file '%s' does not exist!" % database)
+
+    version = get_schema_version(database)
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError("Database version %s cannot be upgraded. Supported: %s" \
+                         % (version, ", ".join(SUPPORTED_VERSIONS)))
+
+    added = []
+    with sqlite3.connect(database) as conn:
+        cursor = conn.cursor()
+        missing = [ kind for kind in ["gene", "transcript"]
+                    if not extent_utils.has_extents(cursor, kind) ]
+    if len(missing) > 0:
+        # Existing extents are recomputed as well, which gives the same values
+        init_db.add_extents(database)
+        added += [ kind + "_extent" for kind in missing ]
+
+    return added + init_db.add_indexes(database)
+
+def main():
+    options = get_args()
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    print("[ %s ] Upgrading database %s" % (ts, options.database))
+
+    added = upgrade_database(options.database)
+    for name in added:
+        print("\tAdded %s" % name)
+    if len(added) == 0:
+        print("\tThe database is already up to date")
+
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    print("[ %s ] Done. Updated query planner statistics." % ts)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
+import os
+import shutil
 import sqlite3
+import pysam
 
 def fetch_correct_ID(name, feature_type, cursor):
     """ Given the name of a transcript or gene, find its TALON ID in the
@@ -31,6 +34,14 @@ def get_db_cursor():
     cursor = conn.cursor()
     return conn, cursor
 
+def copy_toy_db(subdir, name):
+    """ Copies the toy database to scratch/<subdir>/<name>.db and returns the
+        path of the copy """
+    os.makedirs("scratch/" + subdir, exist_ok = True)
+    database = "scratch/%s/%s.db" % (subdir, name)
+    shutil.copy("scratch/toy.db", database)
+    return database
+
 def fetch_counter(cursor, category):
     """ Get the coutner value for the provided category from the database counter
         table """
@@ -38,3 +49,12 @@ def fetch_counter(cursor, category):
     cursor.execute("SELECT * FROM counters WHERE category == '%s'" % (category))   
     counter = cursor.fetchone()['count']
     return counter
+
+def get_read(name):
+    """ Fetch a read from the toy SAM file and give it a dataset """
+    sam_file = "input_files/toy_transcript/toy_reads_for_partition_test.sam"
+    with pysam.AlignmentFile(sam_file) as sam:
+        for record in sam:
+            if record.query_name == name:
+                record.set_tag("RG", "toy")
+                return record
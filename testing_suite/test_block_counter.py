@@ -0,0 +1,42 @@
+import pytest
+from talon import talon
+@pytest.mark.unit
+
+class TestBlockCounter(object):
+
+    def test_lease_and_compact(self):
+        """ IDs are handed out from blocks of consecutive IDs. If the same 
+            counter is used from a new process, it takes a new block. 
+            Compaction should close the gaps left at the end of each block
+            while preserving the order of the IDs. """
+
+        counter = talon.BlockCounter(initval = 10, block_size = 5)
+        first = [ counter.increment() for i in range(7) ]
+        assert first == [ 11, 12, 13, 14, 15, 16, 17 ]
+        assert counter.value() == 20
+
+        # Pretend that we are in a forked process: the rest of the second
+        # block must not be reused.
+        counter.pid = -1
+        second = [ counter.increment() for i in range(2) ]
+        assert second == [ 21, 22 ]
+
+        remap = counter.compact(first + second)
+        assert [ remap(x) for x in first + second ] == list(range(11, 20))
+        assert remap(3) == 3
+        assert counter.value() == 19
+
+    def test_unused_blocks(self):
+        """ Blocks that were leased but never used are skipped over """
+
+        counter = talon.BlockCounter(initval = 0, block_size = 4)
+        counter.increment()
+        counter.pid = -1
+        counter.increment()
+        counter.pid = -1
+        counter.increment()
+
+        remap = counter.compact([1, 9])
+        assert remap(1) == 1
+        assert remap(9) == 2
+        assert counter.value() == 2
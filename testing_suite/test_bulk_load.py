@@ -0,0 +1,64 @@
+import pytest
+import sqlite3
+from talon import talon
+from .helper_fns import copy_toy_db
+
+def make_update(name, n_observed):
+    """ Copies the toy database and writes outfiles that add n_observed reads
+        of transcript 1 to it """
+    database = copy_toy_db("bulk_load", name)
+    outfiles = talon.init_outfiles("scratch/bulk_load/" + name,
+                                   tmp_dir = "scratch/bulk_load/%s_tmp/" % name)
+    with open(outfiles.observed, 'w') as f:
+        for i in range(1, n_observed + 1):
+            f.write("\t".join([str(i), "1", "1", "read_%d" % i, "bulk", "1",
+                               "6", "1", "5", "0", "0", "1000", "None", "None",
+                               "None", "None", "None"]) + "\n")
+    return database, outfiles
+
+def get_index_sql(database):
+    with sqlite3.connect(database) as conn:
+        return conn.execute("""SELECT name, sql FROM sqlite_master
+                               WHERE type = 'index' AND sql IS NOT NULL
+                               ORDER BY name""").fetchall()
+
+@pytest.mark.dbunit
+class TestBulkLoad(object):
+    def test_bulk_load(self):
+        """ A bulk load should add the rows and rebuild any indexes it
+            dropped """
+
+        database, outfiles = make_update("bulk", 50)
+        indexes = get_index_sql(database)
+
+        talon.get_counters(database)
+        datasets = [ (talon.dataset_counter.increment(), "bulk", "bulk", "bulk") ]
+        for i in range(50): talon.observed_counter.increment()
+        talon.update_database(database, 10, outfiles, datasets,
+                              bulk_load = True)
+
+        assert get_index_sql(database) == indexes
+        with sqlite3.connect(database) as conn:
+            assert conn.execute("""SELECT COUNT(*) FROM observed
+                                   WHERE dataset = 'bulk'""").fetchone()[0] == 50
+            assert conn.execute("""SELECT count FROM abundance
+                                   WHERE dataset = 'bulk'""").fetchall() == [(50,)]
+
+    def test_rollback_on_integrity_failure(self):
+        """ If the counters do not match the tables, the bulk load should be
+            rolled back entirely, including the dropped indexes """
+
+        database, outfiles = make_update("bulk_fail", 50)
+        indexes = get_index_sql(database)
+
+        # The observed counter is not advanced, so the check fails
+        talon.get_counters(database)
+        datasets = [ (talon.dataset_counter.increment(), "bulk", "bulk", "bulk") ]
+        with pytest.raises(RuntimeError):
+            talon.update_database(database, 10, outfiles, datasets,
+                                  bulk_load = True)
+
+        assert get_index_sql(database) == indexes
+        with sqlite3.connect(database) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM observed").fetchone()[0] == 0
+            assert conn.execute("SELECT COUNT(*) FROM dataset").fetchone()[0] == 0
@@ -0,0 +1,62 @@
+import pytest
+import pysam
+from talon import transcript_utils as tu
+
+def make_record(start, cigar, md = None, jI = None):
+    """ Builds a pysam record with the provided 0-based start, CIGAR string,
+        and optional MD and jI tags """
+    header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "chr1",
+                                                      "LN": 200000000}]})
+    record = pysam.AlignedSegment(header)
+    record.query_name = "read"
+    record.reference_id = 0
+    record.reference_start = start
+    record.cigarstring = cigar
+    record.query_sequence = "A" * record.infer_query_length()
+    if md != None:
+        record.set_tag("MD", md)
+    if jI != None:
+        record.set_tag("jI", jI)
+    return record
+
+@pytest.mark.unit
+class TestCigarTuples(object):
+    def test_matches_string_functions(self):
+        """ Coverage, identity, and introns computed from the CIGAR tuples
+            should match the string-based functions """
+
+        examples = [(1081826, "2557M97N26M1371N135M1126N66M297N96M2755N" + \
+                              "76M1043N94M425N113=23956N38=", "3301"),
+                    (99, "5S100M2I50M3D10M200N40M7S", "20A129^TTT50C0"),
+                    (0, "300M", "300"),
+                    (9, "20S30X100N10=", "0A0C38")]
+
+        for start, cigar, md in examples:
+            record = make_record(start, cigar, md = md)
+            coverage, end, introns = tu.parse_cigar_tuples(start + 1,
+                                                           record.cigartuples)
+            jI = [ int(x) for x in tu.compute_jI(start + 1, cigar).split(",")[1:] ]
+            assert coverage == tu.compute_alignment_coverage(cigar)
+            assert end == record.reference_end
+            assert introns == ([] if jI == [-1] else jI)
+            assert introns == tu.get_read_introns(record, start + 1)
+            assert tu.compute_MD_identity(md, record.query_alignment_length) == \
+                   tu.compute_alignment_identity(md, record.query)
+
+    def test_hard_clipped_read(self):
+        """ Hard-clipped bases do not consume the reference, so they should
+            not shift the introns """
+
+        record = make_record(99, "10H50M100N50M10H")
+        introns = [150, 249]
+        assert tu.parse_cigar_tuples(100, record.cigartuples)[2] == introns
+        assert tu.compute_jI(100, "10H50M100N50M10H") == "jI:B:i,150,249"
+        assert tu.parse_cigar_tuples(100, record.cigartuples)[0] == 100/120
+
+    def test_jI_tag_is_used(self):
+        """ If the read has a jI tag, its introns are taken from it """
+
+        record = make_record(99, "50M100N50M", jI = [1, 2])
+        assert tu.get_read_introns(record, 100) == [1, 2]
+        record = make_record(99, "100M", jI = [-1])
+        assert tu.get_read_introns(record, 100) == []
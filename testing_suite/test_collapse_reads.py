@@ -0,0 +1,115 @@
+import pytest
+import pysam
+from talon import talon
+from .helper_fns import get_db_cursor, get_read
+
+def make_read(name, start, cigar):
+    """ Make a chr1 read on the + strand with the provided alignment """
+    header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "chr1",
+                                                      "LN": 100000}]})
+    record = pysam.AlignedSegment(header)
+    record.query_name = name
+    record.reference_id = 0
+    record.reference_start = start - 1
+    record.cigarstring = cigar
+    record.query_sequence = "G" * record.query_length
+    record.mapping_quality = 40
+    record.set_tag("RG", "toy")
+    return record
+
+def annotation_summary(annotation_info):
+    return [ annotation_info[x] for x in ["gene_ID", "transcript_ID",
+                                          "start_vertex", "end_vertex",
+                                          "start_delta", "end_delta"] ]
+
+@pytest.mark.integration
+class TestCollapseReads(object):
+    def test_known_structure(self):
+        """ A read that matches a known transcript is annotated once, and
+            identical reads reuse the result """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        talon.get_counters(database)
+        run_info = talon.init_run_info(database, build)
+        struct_collection = talon.prepare_data_structures(cursor, run_info)
+
+        cache = {}
+        read = get_read("read_1")
+        first = talon.annotate_read(read, cursor, run_info, struct_collection,
+                                    collapse_cache = cache)
+        second = talon.annotate_read(read, cursor, run_info, struct_collection,
+                                     collapse_cache = cache)
+        assert first.transcript_ID == 1
+        assert not first.reused
+        assert second.reused
+        assert annotation_summary(second) == annotation_summary(first)
+        assert second.read_ID == "read_1"
+        assert len(cache) == 1
+        conn.close()
+
+    def test_novel_structure(self):
+        """ The first read with a novel structure creates the novel entities.
+            It is not reused, since the next identical read is matched to
+            what it created. That result is then reused. """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        talon.get_counters(database)
+        run_info = talon.init_run_info(database, build)
+        struct_collection = talon.prepare_data_structures(cursor, run_info)
+
+        cache = {}
+        read = get_read("read_5")
+        results = [ talon.annotate_read(read, cursor, run_info,
+                                        struct_collection,
+                                        collapse_cache = cache)
+                    for i in range(3) ]
+
+        assert results[0].transcript_novelty != []
+        assert [ x.reused for x in results ] == [False, False, True]
+        assert results[1].transcript_novelty == []
+        assert annotation_summary(results[2]) == annotation_summary(results[1])
+        assert results[1].transcript_ID == results[0].transcript_ID
+        conn.close()
+
+    def test_novel_vertex_between_identical_reads(self):
+        """ A read that creates a vertex closer to the start of an earlier
+            read should empty the cache, so that the next read with the
+            earlier structure is matched to the closer vertex, as it would
+            be without the cache """
+
+        reads = [ make_read("read_b", 40, "61M399N101M299N105M"),
+                  make_read("read_a", 45, "56M399N101M299N105M"),
+                  make_read("read_c", 1, "44M455N101M299N105M"),
+                  make_read("read_a", 45, "56M399N101M299N105M") ]
+
+        results = {}
+        for mode in ["full", "collapsed"]:
+            conn, cursor = get_db_cursor()
+            database = "scratch/toy.db"
+            talon.get_counters(database)
+            run_info = talon.init_run_info(database, "toy_build")
+            # No known start is close enough, so the read starts are matched
+            # to any vertex nearby
+            run_info.cutoff_5p = 10
+            struct_collection = talon.prepare_data_structures(cursor, run_info)
+
+            cache = {} if mode == "collapsed" else None
+            results[mode] = [ talon.annotate_read(read, cursor, run_info,
+                                                  struct_collection,
+                                                  collapse_cache = cache)
+                              for read in reads ]
+            conn.close()
+
+        full = results["full"]
+        collapsed = results["collapsed"]
+        assert [ annotation_summary(x) for x in collapsed ] == \
+               [ annotation_summary(x) for x in full ]
+        assert not any([ x.reused for x in collapsed ])
+
+        # The vertex created by read_c is the closer match for read_a
+        assert full[3].start_vertex != full[1].start_vertex
+        assert abs(full[3].start_delta) < abs(full[1].start_delta)
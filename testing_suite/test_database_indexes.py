@@ -0,0 +1,86 @@
+import pytest
+import sqlite3
+from talon import init_refs, upgrade_database
+from talon import initialize_talon_database as init_db
+from .helper_fns import get_db_cursor, copy_toy_db
+
+def get_plan(cursor, query):
+    """ Returns the EXPLAIN QUERY PLAN details of the query as one string """
+    cursor.execute("EXPLAIN QUERY PLAN " + query)
+    return "\n".join([ row[-1] for row in cursor.fetchall() ])
+
+@pytest.mark.dbunit
+class TestDatabaseIndexes(object):
+    def test_indexes_created_at_init(self):
+        """ A freshly initialized database should have every index in the
+            designed set, along with planner statistics """
+
+        conn, cursor = get_db_cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = set([ x[0] for x in cursor.fetchall() ])
+        for name, table, columns in init_db.INDEXES:
+            assert name in indexes
+
+        cursor.execute("SELECT COUNT(*) FROM sqlite_stat1")
+        assert cursor.fetchone()[0] > 0
+        conn.close()
+
+    def test_query_plans_use_indexes(self):
+        """ The main reference, post-processing, and annotation queries should
+            search the indexes rather than scan their tables """
+
+        conn, cursor = get_db_cursor()
+
+        plan = get_plan(cursor, """SELECT * FROM location
+                                   WHERE genome_build = 'toy_build'
+                                   AND chromosome = 'chr1'
+                                   AND position >= 1 AND position <= 1000""")
+        assert "location_build_chrom_pos_idx" in plan
+
+        plan = get_plan(cursor, "SELECT * FROM edge WHERE v1 = 2 AND v2 = 3")
+        assert "edge_v1_v2_idx" in plan
+
+        plan = get_plan(cursor, "SELECT * FROM transcripts WHERE start_vertex = 1")
+        assert "transcripts_start_vertex_idx" in plan
+        plan = get_plan(cursor, "SELECT * FROM transcripts WHERE end_vertex = 1")
+        assert "transcripts_end_vertex_idx" in plan
+
+        plan = get_plan(cursor, "SELECT * FROM observed WHERE dataset = 'toy'")
+        assert "observed_dataset_idx" in plan
+        plan = get_plan(cursor, "SELECT * FROM abundance WHERE dataset = 'toy'")
+        assert "abundance_dataset_idx" in plan
+
+        plan = get_plan(cursor, """SELECT ID FROM transcript_annotations
+                                   WHERE attribute = 'transcript_status'
+                                   AND value = 'KNOWN'""")
+        assert "transcript_annotations_attr_value_idx" in plan
+
+        # No full scan of the location table when loading a region
+        plan = get_plan(cursor, init_refs.region_transcript_query("toy_build",
+                                                     "chr1", 1, 1000))
+        assert "SCAN loc1" not in plan and "SCAN loc2" not in plan
+        conn.close()
+
+    def test_upgrade_database(self):
+        """ Upgrading a database without the indexes and extents should
+            add them (once) and leave its contents unchanged """
+
+        database = copy_toy_db("upgrade", "toy_no_index")
+        with sqlite3.connect(database) as conn:
+            for name, table, columns in init_db.INDEXES:
+                conn.execute("DROP INDEX %s" % name)
+            for table in ["gene_extent_rtree", "gene_extent",
+                          "transcript_extent_rtree", "transcript_extent",
+                          "extent_chromosome"]:
+                conn.execute("DROP TABLE %s" % table)
+            conn.execute("DROP TABLE sqlite_stat1")
+            before = conn.execute("SELECT * FROM location").fetchall()
+
+        added = upgrade_database.upgrade_database(database)
+        assert sorted(added) == sorted(["gene_extent", "transcript_extent"] + \
+                                       [ x[0] for x in init_db.INDEXES ])
+        assert upgrade_database.upgrade_database(database) == []
+
+        with sqlite3.connect(database) as conn:
+            assert conn.execute("SELECT * FROM location").fetchall() == before
+            assert conn.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
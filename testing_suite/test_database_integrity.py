@@ -0,0 +1,63 @@
+import pytest
+import sqlite3
+from talon import talon
+from .helper_fns import get_db_cursor, copy_toy_db
+
+def copy_db(name):
+    """ Copies the toy database and returns a cursor on the copy """
+    database = copy_toy_db("integrity", name)
+    conn = sqlite3.connect(database)
+    return conn, conn.cursor()
+
+def add_observed(cursor, obs_IDs, counter_value):
+    """ Adds a read of transcript 1 for each ID and sets the counter """
+    cursor.executemany("""INSERT INTO observed (obs_ID, gene_ID, transcript_ID,
+                                                read_name, dataset)
+                          VALUES (?, 1, 1, ?, 'integrity')""",
+                       [ (x, "read_%d" % x) for x in obs_IDs ])
+    cursor.execute("""UPDATE counters SET count = ?
+                      WHERE category = 'observed'""", (counter_value,))
+
+@pytest.mark.dbunit
+class TestDatabaseIntegrity(object):
+    def test_new_rows_match_counters(self):
+        """ The check passes when the rows added since the previous counter
+            values account for the counters exactly """
+
+        conn, cursor = copy_db("match")
+        prev_counters = talon.get_counter_values(cursor)
+        add_observed(cursor, range(1, 11), 10)
+        talon.check_database_integrity(cursor, prev_counters = prev_counters)
+        talon.check_database_integrity(cursor, deep = True)
+        conn.close()
+
+    def test_missing_and_extra_rows(self):
+        """ A counter that is ahead of the new rows, or new rows that fill in
+            a gap and reach past the counter, should fail the check """
+
+        conn, cursor = copy_db("missing")
+        prev_counters = talon.get_counter_values(cursor)
+        add_observed(cursor, range(1, 10), 10)
+        with pytest.raises(RuntimeError):
+            talon.check_database_integrity(cursor, prev_counters = prev_counters)
+        conn.close()
+
+        conn, cursor = copy_db("gap")
+        prev_counters = talon.get_counter_values(cursor)
+        add_observed(cursor, [1, 2, 3, 5], 4)
+        with pytest.raises(RuntimeError):
+            talon.check_database_integrity(cursor, prev_counters = prev_counters)
+        conn.close()
+
+    def test_no_table_scan(self):
+        """ The check of the new observed rows should be answered from the
+            primary key instead of scanning the table """
+
+        conn, cursor = get_db_cursor()
+        table, ID_col = talon.COUNTER_TABLES["observed"]
+        for query in ["SELECT MAX(%s) FROM %s" % (ID_col, table),
+                      "SELECT COUNT(*) FROM %s WHERE %s > 5" % (table, ID_col)]:
+            cursor.execute("EXPLAIN QUERY PLAN " + query)
+            plan = "\n".join([ x[-1] for x in cursor.fetchall() ])
+            assert "SCAN" not in plan
+        conn.close()
@@ -0,0 +1,66 @@
+import pytest
+import sqlite3
+from talon import init_refs, extent_utils
+from .helper_fns import get_db_cursor, copy_toy_db
+@pytest.mark.dbunit
+
+class TestGeneExtents(object):
+    def test_extents_match_gene_spans(self):
+        """ The stored extents should give the same genes as computing each
+            gene's span from its vertices, for the whole build and for
+            regions """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        assert extent_utils.has_extents(cursor)
+
+        for chrom, start, end in [(None, None, None), ("chr1", 1, 1000),
+                                  ("chr1", 500, 1500), ("chr1", 10000, 20000),
+                                  ("chr2", 1, 3000), ("chr4", 1000, 2000),
+                                  ("chrX", 1, 1000)]:
+            cursor.execute(init_refs.gene_interval_query(build, chrom, start, end))
+            expected = [ dict(x) for x in cursor.fetchall() ]
+            cursor.execute(extent_utils.gene_extent_query(build, chrom, start, end))
+            assert [ dict(x) for x in cursor.fetchall() ] == expected
+
+        # Regional lookups use the R*Tree
+        cursor.execute("EXPLAIN QUERY PLAN " + \
+                       extent_utils.gene_extent_query(build, "chr1", 1, 1000))
+        plan = "\n".join([ x[-1] for x in cursor.fetchall() ])
+        assert "VIRTUAL TABLE" in plan
+        conn.close()
+
+    def test_incremental_update(self):
+        """ A gene that gains a vertex outside of its span should have its
+            stored extent extended, without touching other genes """
+
+        database = copy_toy_db("extents", "toy_extents")
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        build = "toy_build"
+
+        cursor.execute(extent_utils.gene_extent_query(build))
+        before = { x["gene_ID"]: dict(x) for x in cursor.fetchall() }
+        cursor.execute(extent_utils.gene_extent_query(build, "chr1", 50000, 60000))
+        assert cursor.fetchall() == []
+
+        cursor.execute("SELECT MAX(location_ID) FROM location")
+        vertex_ID = cursor.fetchone()[0] + 1
+        cursor.execute("INSERT INTO location VALUES (?,?,?,?)",
+                       (vertex_ID, build, "chr1", 55000))
+        cursor.execute("INSERT INTO vertex VALUES (?,?)", (vertex_ID, 1))
+        extent_utils.update_gene_extents(cursor, [1])
+
+        cursor.execute(extent_utils.gene_extent_query(build))
+        after = { x["gene_ID"]: dict(x) for x in cursor.fetchall() }
+        assert after[1]["start"] == before[1]["start"]
+        assert after[1]["end"] == 55000
+        assert { k: v for k,v in after.items() if k != 1 } == \
+               { k: v for k,v in before.items() if k != 1 }
+
+        cursor.execute(extent_utils.gene_extent_query(build, "chr1", 50000, 60000))
+        assert [ x["gene_ID"] for x in cursor.fetchall() ] == [1]
+        cursor.execute("SELECT COUNT(*) FROM gene_extent_rtree")
+        assert cursor.fetchone()[0] == len(after)
+        conn.close()
@@ -0,0 +1,98 @@
+import pytest
+from .helper_fns import get_db_cursor
+from talon import talon, init_refs, dstruct
+import sqlite3
+
+@pytest.mark.unit
+
+class TestRegionStructures(object):
+    def test_matches_separate_queries(self):
+        """ The single-pass loader should build the same structures as the
+            individual make_* functions, both for the whole build and for
+            intervals. """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+
+        for region in [(None, None, None), ("chr1", 1, 1000),
+                       ("chr1", 500, 1500), ("chr2", 1, 3000),
+                       ("chr4", 1000, 2000)]:
+            chrom, start, end = region
+            structs = init_refs.make_region_structures(cursor, build,
+                                                       chrom = chrom,
+                                                       start = start,
+                                                       end = end)
+
+            location_dict = init_refs.make_location_dict(build, cursor,
+                                                         chrom = chrom,
+                                                         start = start,
+                                                         end = end)
+            assert structs.location_dict.keys() == location_dict.keys()
+            for c in location_dict:
+                assert structs.location_dict[c].positions == \
+                       location_dict[c].positions
+                assert [ tuple(structs.location_dict[c][p]) for p in location_dict[c] ] == \
+                       [ tuple(location_dict[c][p]) for p in location_dict[c] ]
+
+            edge_dict = init_refs.make_edge_dict(cursor, build = build,
+                                                 chrom = chrom, start = start,
+                                                 end = end)
+            assert { k: tuple(v) for k,v in structs.edge_dict.items() } == \
+                   { k: tuple(v) for k,v in edge_dict.items() }
+
+            transcript_dict = init_refs.make_transcript_dict(cursor, build,
+                                                             chrom = chrom,
+                                                             start = start,
+                                                             end = end)
+            assert { k: v["transcript_ID"] for k,v in structs.transcript_dict.items() } == \
+                   { k: v["transcript_ID"] for k,v in transcript_dict.items() }
+
+            vertex_2_gene = init_refs.make_vertex_2_gene_dict(cursor,
+                                                              build = build,
+                                                              chrom = chrom,
+                                                              start = start,
+                                                              end = end)
+            assert structs.vertex_2_gene == vertex_2_gene
+
+            for mode in ["start", "end"]:
+                gene_dict = init_refs.make_gene_start_or_end_dict(cursor, build,
+                                                                  mode,
+                                                                  chrom = chrom,
+                                                                  start = start,
+                                                                  end = end)
+                assert structs["gene_" + mode + "s"] == gene_dict
+
+            cursor.execute(init_refs.monoexon_interval_query(build, chrom,
+                                                             start, end))
+            assert structs.monoexons == [ dict(x) for x in cursor.fetchall() ]
+
+            assert set(structs.timings.keys()) == set(["location_dict",
+                                                       "edge_dict",
+                                                       "transcript_dict",
+                                                       "vertex_2_gene",
+                                                       "gene_starts",
+                                                       "gene_ends",
+                                                       "monoexons"])
+        conn.close()
+
+    def test_known_entities_are_compact_records(self):
+        """ Known locations, edges, and transcripts are stored as records,
+            which can be told apart from novel (dict) entities and share one
+            copy of their repeated string values. """
+
+        conn, cursor = get_db_cursor()
+        structs = init_refs.make_region_structures(cursor, "toy_build",
+                                                   chrom = "chr1", start = 1,
+                                                   end = 1000)
+        conn.close()
+
+        locations = list(structs.location_dict["chr1"].values())
+        assert all(isinstance(x, dstruct.LocationRecord) for x in locations)
+        assert all(type(x) is not dict for x in locations)
+        assert locations[0]["chromosome"] is locations[1]["chromosome"]
+        assert locations[0]["position"] == locations[0][3]
+
+        edges = list(structs.edge_dict.values())
+        assert all(isinstance(x, dstruct.EdgeRecord) for x in edges)
+        assert all(isinstance(x, dstruct.TranscriptRecord)
+                   for x in structs.transcript_dict.values())
@@ -204,3 +204,48 @@ class TestIdentifyMonoexonic(object):
         assert "antisense_transcript" in t_novelty_types
 
         conn.close() 
+
+    def test_index_matches_sql(self):
+        """ Annotating a series of monoexonic reads should give the same 
+            results whether the monoexon and gene lookups use the in-memory
+            indexes or the temporary tables. Later reads overlap the novel 
+            transcripts created for earlier ones. """
+
+        build = "toy_build"
+        database = "scratch/toy.db"
+        reads = [ ("chr4", "-", (3900, 1100)), ("chr4", "+", (1000, 3000)),
+                  ("chr4", "+", (1200, 2500)), ("chr4", "-", (3900, 2900)),
+                  ("chr1", "+", (7000, 8000)), ("chr1", "+", (7500, 9000)),
+                  ("chr1", "-", (8500, 7200)), ("chr1", "+", (7100, 7900)) ]
+
+        results = []
+        for mode in ["sql", "index"]:
+            conn, cursor = get_db_cursor()
+            talon.get_counters(database)
+            if mode == "sql":
+                tmp_gene = init_refs.make_temp_novel_gene_table(cursor, build)
+                tmp_monoexon = init_refs.make_temp_monoexonic_transcript_table(cursor, build)
+            else:
+                tmp_gene = init_refs.make_novel_gene_index(cursor, build)
+                tmp_monoexon = init_refs.make_monoexon_index(cursor, build)
+            edge_dict = init_refs.make_edge_dict(cursor)
+            location_dict = init_refs.make_location_dict(build, cursor)
+            run_info = talon.init_run_info(database, build)
+            transcript_dict = init_refs.make_transcript_dict(cursor, build)
+            vertex_2_gene = init_refs.make_vertex_2_gene_dict(cursor)
+            gene_starts = init_refs.make_gene_start_or_end_dict(cursor, build, "start")
+            gene_ends = init_refs.make_gene_start_or_end_dict(cursor, build, "end")
+
+            annotations = []
+            for chrom, strand, positions in reads:
+                annotation = talon.identify_monoexon_transcript(chrom, positions,
+                                               strand, cursor,
+                                               location_dict, edge_dict,
+                                               transcript_dict, vertex_2_gene,
+                                               gene_starts, gene_ends, run_info,
+                                               tmp_gene, tmp_monoexon)
+                annotations.append(dict(annotation))
+            results.append(annotations)
+            conn.close()
+
+        assert results[0] == results[1]
@@ -1,30 +1,32 @@
 import pytest
-import pysam
 from talon import process_sams as procsam
 @pytest.mark.unit
 
 class TestPartitionReads(object):
-    def test_partition_reads(self):
-        """ Given a set of toy transcripts, find the minimum number of
-            non-overlapping intervals to contain them. 
-            Expected read groups:
-            - read_1 and read_2 (they are in interval chr1:1-1000)
-            - read_3 (interval chr2:1-100)
-        """
+    def test_pack_clusters(self):
+        """ Neighbouring read clusters are packed together until there are
+            enough reads in the interval. Intervals never span two 
+            chromosomes, and are not closed between clusters that overlap 
+            the same gene. """
 
-        sams = ["input_files/preprocess_sam/read1.sam",
-                "input_files/preprocess_sam/read2.sam"]
-        datasets = ["dataset1", "dataset2"]
-        tmp_dir = "scratch/test_read_partition/"
+        clusters = [("chr1", 0, 100, 2), ("chr1", 500, 600, 1),
+                    ("chr1", 1000, 1100, 3), ("chr1", 2000, 2100, 1),
+                    ("chr1", 3000, 3100, 2), ("chr2", 0, 100, 1), 
+                    ("chr2", 500, 600, 1)]
 
-        read_groups, intervals, merged_bam = procsam.partition_reads(sams, datasets, tmp_dir = tmp_dir)
+        intervals = procsam.pack_clusters(clusters, None, 3)
+        assert intervals == [("chr1", 0, 600, 3), ("chr1", 1000, 1100, 3), 
+                             ("chr1", 2000, 3100, 3), ("chr2", 0, 600, 2)]
 
-        # Check length and membership of read groups
-        assert len(read_groups) == 2 
+        # A gene that covers the last base of cluster 3 and the first base of 
+        # cluster 4 keeps them together
+        gene_spans = {"chr1": [(1050, 1500), (1100, 2001)]}
+        intervals = procsam.pack_clusters(clusters, gene_spans, 3)
+        assert intervals == [("chr1", 0, 600, 3), ("chr1", 1000, 2100, 4), 
+                             ("chr1", 3000, 3100, 2), ("chr2", 0, 600, 2)]
 
-        assert [ entry.query_name for entry in read_groups[0] ] == ["read_1", "read_2"]
-        assert [ entry.query_name for entry in read_groups[1] ] == ["read_3"]
-        
-        # Check the intervals 
-        assert intervals[0] == ("chr1", 1, 1004)
-        assert intervals[1] == ("chr2", 1, 100)
+        # A gene that ends right before the next cluster does not
+        gene_spans = {"chr1": [(1100, 2000)]}
+        intervals = procsam.pack_clusters(clusters, gene_spans, 3)
+        assert intervals == [("chr1", 0, 600, 3), ("chr1", 1000, 1100, 3), 
+                             ("chr1", 2000, 3100, 3), ("chr2", 0, 600, 2)]
@@ -1,5 +1,5 @@
 import pytest
-from talon import talon, init_refs
+from talon import talon, init_refs, dstruct
 from .helper_fns import fetch_correct_vertex_ID, get_db_cursor
 @pytest.mark.dbunit
 
@@ -154,3 +154,72 @@ class TestPermissiveMatch(object):
 
         assert start_match == 3
         assert end_match == 4
+
+    def test_sorted_search_matches_scan(self):
+        """ The binary search over sorted vertex positions should return the
+            same match and delta as probing the dict one position at a time,
+            including ties between vertices on either side of the read end.
+        """
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        location_dict = init_refs.make_location_dict(build, cursor)
+        run_info = talon.init_run_info(database, build)
+        run_info.cutoff_5p = 300
+        run_info.cutoff_3p = 300
+
+        chrom = "chr1"
+        plain_dict = { chrom: dict(location_dict[chrom]) }
+        positions = sorted(location_dict[chrom])
+        for position in range(1, max(positions) + 400, 7):
+            for strand in ["+", "-"]:
+                for pos_type in ["start", "end"]:
+                    for sj_pos in [position - 200, position + 200]:
+                        args = (chrom, position, strand, sj_pos, pos_type)
+                        expected = talon.permissive_vertex_search(*args,
+                                                     plain_dict, run_info)
+                        assert talon.permissive_vertex_search(*args,
+                                    location_dict, run_info) == expected
+        conn.close()
+
+    def test_gene_priority_sorted_search_matches_scan(self):
+        """ The binary search over the sorted start/end positions of a gene
+            should return the same vertex and delta as scanning all of them,
+            and break ties in favour of the position that was added first.
+        """
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        location_dict = init_refs.make_location_dict(build, cursor)
+        run_info = talon.init_run_info(database, build)
+        run_info.cutoff_5p = 300
+        run_info.cutoff_3p = 300
+
+        chrom = "chr1"
+        for mode in ["start", "end"]:
+            gene_locs = init_refs.make_gene_start_or_end_dict(cursor, build,
+                                                              mode)
+            plain_locs = { x: dict(y) for x, y in gene_locs.items() }
+            for gene_ID in gene_locs:
+                positions = sorted(gene_locs[gene_ID])
+                for position in range(1, max(positions) + 400, 7):
+                    for strand in ["+", "-"]:
+                        for sj_pos in [position - 200, position + 200]:
+                            args = (chrom, position, strand, sj_pos, mode,
+                                    gene_ID)
+                            expected = talon.permissive_match_with_gene_priority(
+                                       *args, plain_locs, location_dict, run_info)
+                            assert talon.permissive_match_with_gene_priority(
+                                   *args, gene_locs, location_dict,
+                                   run_info) == expected
+        conn.close()
+
+        # Two known ends 10 bp either side of the read end
+        for gene_locs, expected in [({1: {110: "A", 90: "B"}}, "A"),
+                                    ({1: {90: "B", 110: "A"}}, "B")]:
+            sorted_locs = { 1: dstruct.PositionDict(gene_locs[1]) }
+            for locs in [gene_locs, sorted_locs]:
+                match = talon.permissive_match_with_gene_priority(chrom, 100,
+                                     "+", 1, "end", 1, locs, {}, run_info)
+                assert match[0] == expected
+                assert match[2] == 1
@@ -0,0 +1,125 @@
+import pytest
+import os
+import sqlite3
+from talon import talon, staging
+from .helper_fns import get_db_cursor, copy_toy_db
+
+def write_shards(outfiles, interval_id, lines):
+    """ Writes a shard of each outfile for the interval, containing the
+        provided lines (outfile key -> list of lines) """
+    shards = {}
+    for key, fpath in outfiles.items():
+        shards[fpath] = "scratch/pipeline/shards/%s_%s" % \
+                        (interval_id, os.path.basename(fpath))
+        with open(shards[fpath], 'w') as f:
+            for line in lines.get(key, []):
+                f.write(line + "\n")
+    return shards
+
+def observed_line(obs_ID):
+    return "\t".join([str(obs_ID), "1", "1", "read_%d" % obs_ID, "pipeline",
+                      "1", "6", "1", "5", "0", "None", "1000", "None", "None",
+                      "None", "None", "None"])
+
+def interval_lines(gene_ID, obs_IDs):
+    """ Outfile lines for an interval with one novel gene and some reads of
+        transcript 1 """
+    return {"genes": ["%d\t+" % gene_ID],
+            "gene_annot": ["%d\tTALON\tTALON\tgene_status\tNOVEL" % gene_ID,
+                           "%d\tTALON\tTALON\tgene_name\tTALONG%d" % \
+                           (gene_ID, gene_ID)],
+            "observed": [ observed_line(x) for x in obs_IDs ]}
+
+def dump(database):
+    with sqlite3.connect(database) as conn:
+        return [ conn.execute("SELECT * FROM %s" % table).fetchall() for table
+                 in ["genes", "gene_annotations", "observed", "abundance"] ]
+
+@pytest.mark.dbunit
+class TestPipelinedUpdate(object):
+    def test_staged_update_matches_outfiles(self):
+        """ Staging the shards as the intervals finish (in any order) and
+            merging them should give the same database as merging the shards
+            into outfiles and reading them in """
+
+        os.system("mkdir -p scratch/pipeline/shards")
+        conn, cursor = get_db_cursor()
+        cursor.execute("SELECT MAX(gene_ID) FROM genes")
+        gene_ID = cursor.fetchone()[0] + 1
+        conn.close()
+        lines = [ interval_lines(gene_ID, range(1, 4)),
+                  interval_lines(gene_ID + 1, range(4, 6)) ]
+
+        results = {}
+        for mode in ["outfiles", "staged"]:
+            database = copy_toy_db("pipeline", mode)
+            outfiles = talon.init_outfiles("scratch/pipeline/" + mode,
+                                           tmp_dir = "scratch/pipeline/%s_tmp/" % mode)
+            shard_groups = [ write_shards(outfiles, "%s_%d" % (mode, i), x)
+                             for i, x in enumerate(lines) ]
+
+            staging_db = None
+            if mode == "staged":
+                staging_db = "scratch/pipeline/staging.db"
+                staging.create_staging_db(staging_db, database)
+                staging_conn = sqlite3.connect(staging_db)
+                for i in [1, 0]:
+                    staging.stage_shards(staging_conn.cursor(), i,
+                                         shard_groups[i], outfiles)
+                staging_conn.commit()
+                staging_conn.close()
+                assert not os.path.exists(shard_groups[0][outfiles.observed])
+            else:
+                talon.merge_shard_files(outfiles, shard_groups, "#")
+
+            talon.get_counters(database)
+            talon.gene_counter.increment()
+            talon.gene_counter.increment()
+            for i in range(5): talon.observed_counter.increment()
+            datasets = [ (talon.dataset_counter.increment(), "pipeline",
+                          "pipeline", "pipeline") ]
+            talon.update_database(database, 10, outfiles, datasets,
+                                  staging_db = staging_db)
+            results[mode] = dump(database)
+
+        assert results["staged"] == results["outfiles"]
+        genes, annotations, observed, abundance = results["staged"]
+        assert (gene_ID + 1, "+") in genes
+        assert [ x[0] for x in observed ] == [1, 2, 3, 4, 5]
+        assert observed[0][10] == None
+        assert abundance == [(1, "pipeline", 5)]
+
+    def test_compact_staged_IDs(self):
+        """ IDs leased in blocks should be compacted in the staged rows the
+            same way as in the outfiles """
+
+        os.system("mkdir -p scratch/pipeline/shards")
+        database = copy_toy_db("pipeline", "compact")
+        outfiles = talon.init_outfiles("scratch/pipeline/compact",
+                                       tmp_dir = "scratch/pipeline/compact_tmp/")
+        run_info = talon.init_run_info(database, "toy_build")
+
+        # Each interval uses the start of a different block of IDs
+        talon.get_counters(database, block_size = 10)
+        first = talon.observed_counter.value()
+        obs_IDs = [ [ talon.observed_counter.increment() for i in range(2) ] ]
+        talon.observed_counter.pid = -1
+        obs_IDs.append([ talon.observed_counter.increment() for i in range(2) ])
+        assert obs_IDs[1][0] == first + 11
+
+        staging_db = "scratch/pipeline/compact_staging.db"
+        staging.create_staging_db(staging_db, database)
+        staging_conn = sqlite3.connect(staging_db)
+        for i, IDs in enumerate(obs_IDs):
+            shards = write_shards(outfiles, "compact_%d" % i,
+                                  {"observed": [ observed_line(x) for x in IDs ]})
+            staging.stage_shards(staging_conn.cursor(), i, shards, outfiles)
+        staging_conn.commit()
+
+        talon.compact_IDs(outfiles, run_info, staging_db = staging_db)
+        assert talon.observed_counter.value() == first + 4
+        staged = staging_conn.execute("""SELECT obs_ID, read_name
+                                         FROM observed ORDER BY seq""").fetchall()
+        assert staged == [ (first + i, "read_%d" % x) for i, x in
+                           enumerate(obs_IDs[0] + obs_IDs[1], 1) ]
+        staging_conn.close()
@@ -0,0 +1,62 @@
+import pytest
+from talon import talon, profiling
+from .helper_fns import get_db_cursor, get_read
+
+@pytest.mark.integration
+class TestProfiling(object):
+    def test_disabled(self):
+        """ Without a profiler, stages are not recorded """
+        profiling.disable()
+        with profiling.stage("qc"):
+            pass
+        assert profiling.stage("qc") is profiling.NO_STAGE
+
+    def test_annotation_stages(self):
+        """ Annotating a spliced read with profiling on should time the read
+            parsing and the steps of identify_transcript """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        talon.get_counters(database)
+        run_info = talon.init_run_info(database, build)
+        struct_collection = talon.prepare_data_structures(cursor, run_info)
+
+        profiler = profiling.enable()
+        for i in range(2):
+            talon.annotate_read(get_read("read_1"), cursor, run_info,
+                                struct_collection)
+        profiling.disable()
+        conn.close()
+
+        for name in ["read_parsing", "identify_transcript", "vertex_matching",
+                     "edge_matching", "ism_search"]:
+            assert profiler.calls[name] == 2
+        assert "identify_monoexon" not in profiler.calls
+        assert profiler.seconds["identify_transcript"] >= \
+               profiler.seconds["vertex_matching"]
+
+    def test_merge_reports(self):
+        """ Interval reports are added up, and each keeps its throughput """
+
+        tmp_dir = "scratch/profiling/"
+        paths = []
+        for interval_id, n_reads in [("chr1_1_100", 10), ("chr2_1_100", 30)]:
+            profiling.enable()
+            with profiling.stage("qc"):
+                pass
+            with profiling.stage("qc"):
+                pass
+            paths.append(profiling.report_path(tmp_dir, interval_id))
+            profiling.write_report(paths[-1], reads = n_reads)
+        profiling.disable()
+
+        summary = profiling.merge_reports(paths + [tmp_dir + "missing.json"])
+        intervals = summary["intervals"]
+        assert [ x["reads"] for x in intervals ] == [10, 30]
+        assert all([ x["reads_per_sec"] > 0 for x in intervals ])
+        annotation = summary["annotation"]
+        assert annotation["intervals"] == 2
+        assert annotation["reads"] == 40
+        assert annotation["stages"]["qc"]["calls"] == 4
+        assert summary["driver"] == None
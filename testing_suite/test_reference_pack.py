@@ -0,0 +1,66 @@
+import pytest
+import os
+import sqlite3
+from talon import init_refs, dstruct
+from talon import reference_pack as refpack
+from .helper_fns import get_db_cursor, copy_toy_db
+@pytest.mark.dbunit
+
+class TestReferencePack(object):
+    def test_pack_matches_database(self):
+        """ Structures loaded from the reference pack should match the ones
+            built from the database for the same region. """
+
+        pack_dir = "scratch/reference_pack/toy.refpack"
+        os.system("mkdir -p scratch/reference_pack")
+        build = "toy_build"
+        refpack.write_reference_pack("scratch/toy.db", build, pack_dir)
+        assert refpack.is_current(pack_dir, "scratch/toy.db", build)
+        assert not refpack.is_current(pack_dir, "scratch/toy.db", "hg38")
+
+        conn, cursor = get_db_cursor()
+        for chrom, start, end in [("chr1", 1, 1000), ("chr1", 500, 1500),
+                                  ("chr2", 1, 3000), ("chr4", 1000, 2000),
+                                  ("chrX", 1, 1000)]:
+            from_db = init_refs.make_region_structures(cursor, build,
+                                                       chrom = chrom,
+                                                       start = start,
+                                                       end = end)
+            from_pack = refpack.load_region_structures(pack_dir, build, chrom,
+                                                       start, end)
+
+            assert from_pack.location_dict.keys() == from_db.location_dict.keys()
+            for c in from_db.location_dict:
+                assert [ tuple(x) for x in from_pack.location_dict[c].values() ] == \
+                       [ tuple(x) for x in from_db.location_dict[c].values() ]
+            assert { k: tuple(v) for k,v in from_pack.edge_dict.items() } == \
+                   { k: tuple(v) for k,v in from_db.edge_dict.items() }
+            assert { k: tuple(v) for k,v in from_pack.transcript_dict.items() } == \
+                   { k: tuple(v) for k,v in from_db.transcript_dict.items() }
+            assert from_pack.vertex_2_gene == from_db.vertex_2_gene
+            assert from_pack.gene_starts == from_db.gene_starts
+            assert from_pack.gene_ends == from_db.gene_ends
+            assert from_pack.monoexons == from_db.monoexons
+
+            cursor.execute(init_refs.gene_interval_query(build, chrom, start, end))
+            assert from_pack.genes == [ dict(x) for x in cursor.fetchall() ]
+
+            # Known records are not mistaken for novel ones
+            for transcript in from_pack.transcript_dict.values():
+                assert type(transcript) is not dict
+                assert isinstance(transcript, dstruct.TranscriptRecord)
+        conn.close()
+
+    def test_pack_goes_stale(self):
+        """ Once the database counters change, the pack should no longer be
+            used """
+
+        database = copy_toy_db("reference_pack", "toy_copy")
+        pack_dir = "scratch/reference_pack/toy_copy.refpack"
+        refpack.write_reference_pack(database, "toy_build", pack_dir)
+        assert refpack.is_current(pack_dir, database, "toy_build")
+
+        with sqlite3.connect(database) as conn:
+            conn.execute("""UPDATE counters SET count = count + 1
+                            WHERE category = 'genes'""")
+        assert not refpack.is_current(pack_dir, database, "toy_build")
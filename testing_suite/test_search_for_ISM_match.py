@@ -53,3 +53,25 @@ class TestSearchForISM(object):
         assert matches[0]["gene_ID"] == correct_gene_ID
         conn.close()
 
+    def test_index_matches_full_scan(self):
+        """ The edge index should give the same matches, in the same order,
+            as scanning every key of the dict. It must also pick up novel
+            transcripts added by create_transcript. """
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        database = "scratch/toy.db"
+        talon.get_counters(database)
+        transcript_dict = init_refs.make_transcript_dict(cursor, build)
+        conn.close()
+
+        talon.create_transcript("chr1", 1, 1000, 1, (1, 2, 3, 90, 91),
+                                (1, 2, 3, 4, 5, 6), transcript_dict)
+
+        for edges in [ (2, 3), (14, ), (2, 3, 90), (21, 22, 23), (100, 200) ]:
+            matches = talon.search_for_ISM(edges, transcript_dict)
+            scan_matches = talon.search_for_ISM(edges, dict(transcript_dict))
+            assert matches == scan_matches
+
+        matches = talon.search_for_ISM((3, 90), transcript_dict)
+        assert len(matches) == 1
+        assert matches[0]["jn_path"] == "2,3,90"
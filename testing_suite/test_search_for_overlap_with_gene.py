@@ -161,3 +161,34 @@ class TestSearchForOverlapWithGene(object):
         conn.close() 
 
 
+    def test_index_matches_sql(self):
+        """ The in-memory gene index should pick the same gene as the 
+            temporary table query, including after novel genes are added. """
+
+        database = "scratch/toy.db"
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        talon.get_counters(database)
+        init_refs.make_temp_novel_gene_table(cursor, "toy_build")
+        gene_index = init_refs.make_novel_gene_index(cursor, "toy_build")
+        run_info = talon.init_run_info(database, build)
+
+        # Add the same novel genes to both, overlapping the known ones
+        for start, end, strand in [(2200, 1450, "-"), (0, 800, "+"),
+                                   (3000, 5000, "+"), (900, 1550, "-")]:
+            gene_ID = talon.create_gene("chr1", start, end, strand, cursor,
+                                        "temp_gene")
+            gene_index.add({'gene_ID': gene_ID, 'chromosome': "chr1",
+                            'start': min(start, end), 'end': max(start, end),
+                            'strand': strand})
+
+        for start in range(0, 5200, 150):
+            for length in [0, 100, 450, 1200]:
+                for strand in ["+", "-"]:
+                    args = ("chr1", start, start + length, strand, cursor,
+                            run_info)
+                    expected = talon.search_for_overlap_with_gene(*args,
+                                                                  "temp_gene")
+                    assert talon.search_for_overlap_with_gene(*args,
+                                                   gene_index) == expected
+        conn.close()
@@ -0,0 +1,38 @@
+import pytest
+import os
+from talon import talon
+@pytest.mark.unit
+
+class TestShardWriter(object):
+
+    def test_shards_merged_in_interval_order(self):
+        """ Write messages for two intervals to shard files, then merge them
+            into the run-level outfiles. Lines from the first interval
+            should come first, and the QC file should get its header. """
+
+        tmp_dir = "scratch/shard_writer/"
+        os.system("mkdir -p %s" % tmp_dir)
+        outfiles = talon.init_outfiles(tmp_dir + "test", tmp_dir = tmp_dir)
+
+        shard_groups = []
+        for interval in [("chr1", 1, 100), ("chr2", 1, 100)]:
+            interval_id = "%s_%d_%d" % interval
+            writer = talon.ShardWriter(outfiles, interval_id,
+                                       tmp_dir + "shards/")
+            writer.put((outfiles.qc, interval[0] + "\tread_1"))
+            writer.put((outfiles.observed, interval[0] + "\tobs_1"))
+            writer.put((outfiles.observed, interval[0] + "\tobs_2"))
+            shard_groups.append(writer.close())
+
+        talon.merge_shard_files(outfiles, shard_groups, "# header")
+
+        with open(outfiles.qc) as f:
+            assert f.read() == "# header\nchr1\tread_1\nchr2\tread_1\n"
+        with open(outfiles.observed) as f:
+            assert f.read().split("\n")[:-1] == ["chr1\tobs_1", "chr1\tobs_2",
+                                                 "chr2\tobs_1", "chr2\tobs_2"]
+        with open(outfiles.genes) as f:
+            assert f.read() == ""
+
+        # Shards are removed once they have been merged
+        assert os.listdir(tmp_dir + "shards/") == []
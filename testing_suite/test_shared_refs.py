@@ -0,0 +1,65 @@
+import pytest
+from talon import init_refs, shared_refs
+from .helper_fns import get_db_cursor
+@pytest.mark.dbunit
+
+class TestSharedRefs(object):
+    def test_overlay_matches_region_structures(self):
+        """ Lookups against the shared reference should return the same
+            known entities as the structures built for the region. """
+
+        build = "toy_build"
+        shared = shared_refs.SharedReference.from_database("scratch/toy.db",
+                                                           build)
+        conn, cursor = get_db_cursor()
+        for chrom, start, end in [("chr1", 1, 1000), ("chr2", 1, 3000),
+                                  ("chr4", 1000, 2000), ("chrX", 1, 1000)]:
+            region = init_refs.make_region_structures(cursor, build,
+                                                      chrom = chrom,
+                                                      start = start, end = end)
+            overlay = shared_refs.make_overlay_structures(shared, chrom,
+                                                          start, end)
+
+            for c, locations in region.location_dict.items():
+                for pos, loc in locations.items():
+                    assert pos in overlay.location_dict[c]
+                    assert tuple(overlay.location_dict[c][pos]) == tuple(loc)
+            for key, edge in region.edge_dict.items():
+                assert tuple(overlay.edge_dict[key]) == tuple(edge)
+            for key, transcript in region.transcript_dict.items():
+                assert tuple(overlay.transcript_dict[key]) == tuple(transcript)
+                assert overlay.transcript_dict.find_supersets(key) == \
+                       region.transcript_dict.find_supersets(key)
+            for vertex, genes in region.vertex_2_gene.items():
+                assert overlay.vertex_2_gene[vertex] == genes
+            for mode in ["gene_starts", "gene_ends"]:
+                for gene_ID, locations in region[mode].items():
+                    assert gene_ID in overlay[mode]
+                    assert overlay[mode][gene_ID] == locations
+            assert overlay.monoexons == region.monoexons
+
+            # Entities that are not in the database are not found
+            assert (0, 0, "exon") not in overlay.edge_dict
+            assert frozenset([0]) not in overlay.transcript_dict
+            assert 0 not in overlay.vertex_2_gene
+        conn.close()
+
+    def test_novel_entities_stay_in_overlay(self):
+        """ Novel entities are added to the overlay only, and are found by
+            lookups alongside the known ones. """
+
+        shared = shared_refs.SharedReference.from_database("scratch/toy.db",
+                                                           "toy_build")
+        overlay = shared_refs.make_overlay_structures(shared, "chr1", 1, 1000)
+        locations = overlay.location_dict["chr1"]
+        known = locations.find_closest(550, 1, 1000, -1)
+        assert known == 500
+
+        locations[549] = {'location_ID': 1000, 'genome_build': "toy_build",
+                          'chromosome': "chr1", 'position': 549}
+        assert locations.find_closest(550, 1, 1000, -1) == 549
+        assert [ type(x) for x in locations.values() ] == [dict]
+
+        # A fresh overlay does not see the novel vertex
+        overlay = shared_refs.make_overlay_structures(shared, "chr1", 1, 1000)
+        assert 549 not in overlay.location_dict["chr1"]
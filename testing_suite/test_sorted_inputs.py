@@ -0,0 +1,89 @@
+import pytest
+import os
+import pysam
+from talon import process_sams as procsam
+@pytest.mark.unit
+
+class TestSortedInputs(object):
+
+    def test_sorted_and_indexed(self):
+        """ SAM files always need preprocessing. A coordinate-sorted BAM only
+            counts as ready to use once it has been indexed. """
+
+        tmp_dir = "scratch/sorted_inputs/"
+        os.system("mkdir -p %s" % tmp_dir)
+        sam = "input_files/preprocess_sam/read1.sam"
+        bam = tmp_dir + "read1.bam"
+        pysam.sort("-o", bam, sam)
+        if os.path.exists(bam + ".bai"):
+            os.remove(bam + ".bai")
+
+        assert procsam.is_sorted_and_indexed(sam) == False
+        assert procsam.is_sorted_and_indexed(bam) == False
+        pysam.index(bam)
+        assert procsam.is_sorted_and_indexed(bam) == True
+
+    def test_stale_index(self):
+        """ A BAM that was replaced after it was indexed needs preprocessing,
+            because its index no longer matches it. """
+
+        tmp_dir = "scratch/sorted_inputs/"
+        os.system("mkdir -p %s" % tmp_dir)
+        bam = tmp_dir + "stale.bam"
+        pysam.sort("-o", bam, "input_files/preprocess_sam/read1.sam")
+        pysam.index(bam)
+        assert procsam.is_sorted_and_indexed(bam) == True
+
+        # Replace the BAM, and make sure the index is older than it
+        pysam.sort("-o", bam, "input_files/preprocess_sam/read2.sam")
+        index_time = os.path.getmtime(bam) - 10
+        os.utime(bam + ".bai", (index_time, index_time))
+        assert procsam.is_sorted_and_indexed(bam) == False
+
+        pysam.index(bam)
+        assert procsam.is_sorted_and_indexed(bam) == True
+
+    def test_merged_interval_reads(self):
+        """ Reads from several sorted BAM files come out in coordinate order, 
+            tagged with the name of their dataset. Reads at the same position
+            are taken from the files in order. """
+
+        tmp_dir = "scratch/sorted_inputs/"
+        os.system("mkdir -p %s" % tmp_dir)
+        bam = tmp_dir + "read1.bam"
+        pysam.sort("-o", bam, "input_files/preprocess_sam/read1.sam")
+        pysam.index(bam)
+        read_files = [(bam, "dataset_a"), (bam, "dataset_b")]
+
+        reads = list(procsam.fetch_merged_interval_reads(read_files, 
+                                                         ("chr1", 1, 1004)))
+        assert [ x.query_name for x in reads ] == ["read_1", "read_1", 
+                                                   "read_2", "read_2"]
+        assert [ x.get_tag("RG") for x in reads ] == ["dataset_a", "dataset_b",
+                                                      "dataset_a", "dataset_b"]
+
+        # Reads that start before the interval belong to an earlier one
+        reads = list(procsam.fetch_merged_interval_reads(read_files,
+                                                         ("chr1", 500, 1004)))
+        assert [ x.query_name for x in reads ] == ["read_2", "read_2"]
+
+    def test_cram_reference(self, monkeypatch):
+        """ A CRAM file can only be read if htslib can find its reference,
+            here through the UR field of its header """
+
+        monkeypatch.delenv("REF_PATH", raising = False)
+        monkeypatch.delenv("REF_CACHE", raising = False)
+        tmp_dir = "scratch/sorted_inputs/"
+        os.system("mkdir -p %s" % tmp_dir)
+        fasta = tmp_dir + "SIRV.fa"
+        cram = tmp_dir + "empty.cram"
+        os.system("cp ../example/SIRV.fa %s" % fasta)
+        header = pysam.AlignmentHeader.from_dict({"HD": {"SO": "coordinate"},
+                                   "SQ": [{"SN": "SIRV1", "LN": 12643}]})
+        with pysam.AlignmentFile(cram, "wc", header = header,
+                                 reference_filename = fasta):
+            pass
+
+        assert procsam.has_cram_reference(cram) == True
+        os.remove(fasta)
+        assert procsam.has_cram_reference(cram) == False
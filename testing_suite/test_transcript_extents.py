@@ -0,0 +1,64 @@
+import pytest
+import sqlite3
+from talon import init_refs, extent_utils
+from .helper_fns import get_db_cursor, copy_toy_db
+@pytest.mark.dbunit
+
+class TestTranscriptExtents(object):
+    def test_regional_queries_match(self):
+        """ Selecting the candidate transcripts with the stored extents should
+            not change the results of the regional transcript queries """
+
+        conn, cursor = get_db_cursor()
+        build = "toy_build"
+        assert extent_utils.has_extents(cursor, "transcript")
+
+        for chrom, start, end in [("chr1", 1, 1000), ("chr1", 500, 1500),
+                                  ("chr1", 10000, 20000), ("chr2", 1, 3000),
+                                  ("chr4", 1000, 2000), ("chrX", 1, 1000),
+                                  ("chr_none", 1, 1000)]:
+            for make_query in [init_refs.region_transcript_query,
+                               init_refs.monoexon_interval_query]:
+                cursor.execute(make_query(build, chrom, start, end))
+                expected = [ tuple(x) for x in cursor.fetchall() ]
+                cursor.execute(make_query(build, chrom, start, end,
+                                          extents = True))
+                assert [ tuple(x) for x in cursor.fetchall() ] == expected
+
+        # The transcripts table is no longer scanned
+        cursor.execute("EXPLAIN QUERY PLAN " + \
+                       init_refs.region_transcript_query(build, "chr1", 1, 1000,
+                                                         extents = True))
+        plan = "\n".join([ x[-1] for x in cursor.fetchall() ])
+        assert "VIRTUAL TABLE" in plan
+        assert "SCAN t\n" not in plan + "\n"
+        conn.close()
+
+    def test_new_transcript(self):
+        """ A transcript added after initialization is found in its region
+            once its extent is stored """
+
+        database = copy_toy_db("extents", "toy_transcript_extents")
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        build = "toy_build"
+
+        cursor.execute("SELECT MAX(location_ID) FROM location")
+        v1 = cursor.fetchone()[0] + 1
+        v2 = v1 + 1
+        cursor.executemany("INSERT INTO location VALUES (?,?,?,?)",
+                           [(v1, build, "chr1", 50000), (v2, build, "chr1", 51000)])
+        cursor.execute("SELECT MAX(transcript_ID) FROM transcripts")
+        transcript_ID = cursor.fetchone()[0] + 1
+        cursor.execute("INSERT INTO transcripts VALUES (?,?,?,?,?,?,?,?)",
+                       (transcript_ID, 1, 1000, None, 1000, v1, v2, 1))
+        query = init_refs.monoexon_interval_query(build, "chr1", 50500, 50600,
+                                                  extents = True)
+        cursor.execute(query)
+        assert cursor.fetchall() == []
+
+        extent_utils.update_transcript_extents(cursor, [transcript_ID])
+        cursor.execute(query)
+        assert [ x["transcript_ID"] for x in cursor.fetchall() ] == [transcript_ID]
+        conn.close()